@@ -0,0 +1,93 @@
+"""Event loop stall time of FetchDataService.sync_project, with and without the DB writer thread.
+
+Usage: python -m benchmarks.bench_event_loop_stall --pipelines 200 --latency 0.02
+
+A ticker task sleeps for `--tick` seconds in a loop while the project syncs.
+Whatever it oversleeps is time the event loop was blocked and couldn't
+serve the requests in flight.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from typing import List
+
+from benchmarks.bench_sync_project import (
+    create_dbsession,
+    get_benchmark_config,
+    run_benchmark,
+)
+from benchmarks.fake_circleci import FakeCircleCIServer, SyntheticHistory
+
+
+async def measure_stalls(tick: float, stalls: List[float]) -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(tick)
+        stalls.append(max(time.perf_counter() - start - tick, 0.0))
+
+
+def summarize_stalls(stalls: List[float]) -> dict:
+    stalls = sorted(stalls)
+    if not stalls:
+        return dict(ticks=0, max=0.0, p99=0.0, total=0.0)
+    return dict(
+        ticks=len(stalls),
+        max=stalls[-1],
+        p99=stalls[min(int(len(stalls) * 0.99), len(stalls) - 1)],
+        total=sum(stalls),
+    )
+
+
+async def run(args, db_writer_thread: bool) -> dict:
+    history = SyntheticHistory(
+        pipelines=args.pipelines,
+        workflows_per_pipeline=args.workflows,
+        jobs_per_workflow=args.jobs,
+    )
+    server = FakeCircleCIServer(history, latency=args.latency)
+    with tempfile.TemporaryDirectory() as directory:
+        dbsession = create_dbsession(os.path.join(directory, "benchmark.sqlite"))
+        async with server:
+            config = get_benchmark_config(
+                server.base_url, db_writer_thread=db_writer_thread
+            )
+            stalls = []
+            ticker = asyncio.create_task(measure_stalls(args.tick, stalls))
+            try:
+                results = await run_benchmark(server, dbsession, config)
+            finally:
+                ticker.cancel()
+        dbsession.close()
+    return dict(wall_time=results["wall_time"], **summarize_stalls(stalls))
+
+
+async def main(args):
+    print(
+        f"{args.pipelines} pipelines x {args.workflows} workflows x {args.jobs} jobs, "
+        + f"{args.latency * 1000:.0f}ms latency"
+    )
+    for db_writer_thread in (False, True):
+        results = await run(args, db_writer_thread)
+        label = "writer thread" if db_writer_thread else "inline"
+        print(
+            f"  {label:<13} wall {results['wall_time']:.2f}s  "
+            + f"stall max {results['max'] * 1000:.1f}ms  "
+            + f"p99 {results['p99'] * 1000:.1f}ms  "
+            + f"total {results['total']:.2f}s over {results['ticks']} ticks"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pipelines", type=int, default=200)
+    parser.add_argument("--workflows", type=int, default=2, help="Per pipeline")
+    parser.add_argument("--jobs", type=int, default=10, help="Per workflow")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds")
+    parser.add_argument("--tick", type=float, default=0.001, help="Seconds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
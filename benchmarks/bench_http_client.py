@@ -0,0 +1,68 @@
+"""Compares a fresh httpx.AsyncClient per request with the pooled client.
+
+Usage: python -m benchmarks.bench_http_client [requests] [concurrency]
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+
+from benchmarks.fake_circleci import FakeCircleCIServer
+from services.fetch_data.datasources.circleci import CircleCIDatasource
+
+
+async def run_client_per_request(base_url: str, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def do_request():
+        async with semaphore:
+            # This is what CircleCIDatasource used to do for every page
+            async with httpx.AsyncClient(base_url=base_url) as client:
+                response = await client.request("GET", "/pipeline/pipeline-1/workflow")
+                return response.json()
+
+    await asyncio.gather(*[do_request() for _ in range(requests)])
+
+
+async def run_pooled_client(base_url: str, requests: int, concurrency: int):
+    config = {
+        "datasources": {
+            "circleci": {
+                "api_token": "benchmark",
+                "base_url": base_url,
+                "http": {"max_connections": concurrency},
+            }
+        }
+    }
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def do_request(datasource):
+        async with semaphore:
+            return await datasource._execute_request(
+                "GET", "/pipeline/pipeline-1/workflow"
+            )
+
+    async with CircleCIDatasource(config) as datasource:
+        await asyncio.gather(*[do_request(datasource) for _ in range(requests)])
+
+
+async def main(requests: int, concurrency: int):
+    for name, runner in [
+        ("client per request", run_client_per_request),
+        ("pooled client", run_pooled_client),
+    ]:
+        async with FakeCircleCIServer() as server:
+            start = time.perf_counter()
+            await runner(server.base_url, requests, concurrency)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>20}: {requests / elapsed:8.0f} req/s "
+                + f"({server.connection_count} connections, {elapsed:.2f}s)"
+            )
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    asyncio.run(main(requests, concurrency))
@@ -0,0 +1,214 @@
+"""pytest-benchmark suite of the hot paths of fetching and processing.
+
+Usage:
+    # Save a baseline, on the machine the comparisons will run on
+    pytest benchmarks/bench_micro.py --benchmark-storage=benchmarks/baselines --benchmark-save=baseline
+    # Compare against the latest saved run, optionally failing on regressions
+    pytest benchmarks/bench_micro.py --benchmark-storage=benchmarks/baselines --benchmark-compare [--benchmark-compare-fail=median:20%]
+(`make benchmark-baseline` / `make benchmark [BENCHMARK_COMPARE_FAIL=median:20%]`)
+Baselines are machine specific, so they aren't committed.
+
+Benchmarks run against a synthetic dataset of BENCHMARK_PIPELINES pipelines
+(default 1000) with 10 workflows of 5 jobs each, generated once per run.
+Set BENCHMARK_PIPELINES=10000 for production-size numbers.
+The file isn't named test_*, so the regular test run leaves it out.
+"""
+import itertools
+import os
+
+import pytest
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import Session
+
+from benchmarks.fake_circleci import SyntheticHistory
+from benchmarks.synthetic_dataset import create_project, generate_dataset
+from database import models
+from database.models.base import Base
+from database.models.enums import JobKinds
+from services.fetch_data import FetchDataService, UpdateFields
+from services.fetch_data.datasources.circleci import CircleCIDataDriver
+from services.process_data import ProcessDataService
+
+BENCHMARK_PIPELINES = int(os.environ.get("BENCHMARK_PIPELINES", 1000))
+# Jobs in a page from CircleCI
+PAGE_SIZE = 100
+
+
+@pytest.fixture(scope="module")
+def dataset_engine(tmp_path_factory):
+    path = tmp_path_factory.mktemp("benchmarks") / "dataset.sqlite"
+    engine = create_engine(f"sqlite:///{path}", echo=False)
+    Base.metadata.create_all(engine)
+    dbsession = Session(bind=engine)
+    project = create_project(dbsession)
+    generate_dataset(dbsession, project, pipelines=BENCHMARK_PIPELINES)
+    dbsession.commit()
+    dbsession.close()
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def dataset_session(dataset_engine):
+    """Session on the dataset. Whatever a benchmark writes is rolled back"""
+    connection = dataset_engine.connect()
+    transaction = connection.begin()
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+    yield session
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture
+def project(dataset_session):
+    return dataset_session.query(models.Project).one()
+
+
+def restore_each_round(dbsession: Session, prepare=None):
+    """pedantic `setup` that undoes the previous round's writes,
+    then runs `prepare`"""
+    savepoints = []
+
+    def setup():
+        if savepoints:
+            savepoints.pop().rollback()
+        savepoints.append(dbsession.begin_nested())
+        if prepare is not None:
+            prepare()
+
+    return setup
+
+
+def synced_metrics(dbsession: Session, project: models.Project):
+    ProcessDataService(dbsession).sync_project_metrics(project, full=True)
+    dbsession.flush()
+
+
+class TestFetchBenchmarks(object):
+    job_fields_to_update = [
+        UpdateFields("status", "status"),
+        UpdateFields("stopped_at", "stopped_at"),
+        UpdateFields("kind", "kind"),
+    ]
+
+    def _job_pages(self, dbsession: Session):
+        """Endless pages of new jobs, as CircleCIDatasource hands them over"""
+        workflow = dbsession.query(models.Workflow).first()
+        history = SyntheticHistory(pipelines=1, jobs_per_workflow=PAGE_SIZE)
+        for page in itertools.count():
+            jobs = []
+            for idx in range(PAGE_SIZE):
+                job = history.get_job(1, 0, idx)
+                job["id"] = f"benchmark-{page}-{idx}"
+                job["workflow"] = workflow
+                job["kind"] = JobKinds.regular_tests
+                jobs.append(job)
+            yield jobs
+
+    def test_sync_model_insert(self, benchmark, dataset_session):
+        service = FetchDataService(dataset_session)
+        pages = self._job_pages(dataset_session)
+        synced = benchmark.pedantic(
+            service._sync_model,
+            setup=lambda: (
+                (
+                    next(pages),
+                    models.Job,
+                    CircleCIDataDriver(),
+                    self.job_fields_to_update,
+                ),
+                {},
+            ),
+            rounds=50,
+        )
+        assert len(synced) == PAGE_SIZE
+
+    def test_sync_model_unchanged(self, benchmark, dataset_session):
+        service = FetchDataService(dataset_session)
+        page = next(self._job_pages(dataset_session))
+        args = (page, models.Job, CircleCIDataDriver(), self.job_fields_to_update)
+        service._sync_model(*args)
+        synced = benchmark(service._sync_model, *args)
+        assert synced == []
+
+
+class TestProcessBenchmarks(object):
+    def test_sync_project_metrics_full(self, benchmark, dataset_session, project):
+        service = ProcessDataService(dataset_session)
+        benchmark.pedantic(
+            service.sync_project_metrics,
+            args=(project,),
+            kwargs=dict(full=True),
+            setup=restore_each_round(dataset_session),
+            rounds=3,
+        )
+        assert project.totals.regular_tests_success_count > 0
+
+    def test_sync_project_metrics_incremental(
+        self, benchmark, dataset_session, project
+    ):
+        synced_metrics(dataset_session, project)
+        # 1% of the workflows synced again
+        dirty_ids = select(models.Workflow.id).where(models.Workflow.id % 100 == 0)
+        service = ProcessDataService(dataset_session)
+        benchmark.pedantic(
+            service.sync_project_metrics,
+            args=(project,),
+            setup=restore_each_round(
+                dataset_session,
+                lambda: dataset_session.execute(
+                    update(models.Workflow)
+                    .where(models.Workflow.id.in_(dirty_ids))
+                    .values(metrics_dirty=True)
+                ),
+            ),
+            rounds=5,
+        )
+        assert (
+            dataset_session.query(models.Workflow)
+            .filter(models.Workflow.metrics_dirty)
+            .count()
+            == 0
+        )
+
+    @pytest.fixture
+    def workflow_runs(self, dataset_session, project):
+        service = ProcessDataService(dataset_session)
+        return [
+            workflow_run
+            for workflow_runs in service.calculate_project_workflow_run_durations(
+                project
+            ).values()
+            for workflow_run in workflow_runs
+        ]
+
+    def test_calculate_totals(self, benchmark, dataset_session, project, workflow_runs):
+        service = ProcessDataService(dataset_session)
+        totals = benchmark(service.calculate_totals, project, workflow_runs)
+        assert totals.label_analysis_success_count > 0
+
+    def test_calculate_statistics(self, benchmark, dataset_session, workflow_runs):
+        service = ProcessDataService(dataset_session)
+        durations = [
+            workflow_run["regular_tests_duration_seconds"]
+            for workflow_run in workflow_runs
+            if workflow_run.get("regular_tests_success")
+        ]
+        statistics = benchmark(service.calculate_statistics, durations)
+        assert statistics["p90_duration"] > statistics["median_duration"]
+
+    @pytest.mark.parametrize("points", [False, True])
+    def test_plot_workflow_durations(
+        self, benchmark, dataset_session, project, tmp_path, points
+    ):
+        synced_metrics(dataset_session, project)
+        service = ProcessDataService(dataset_session)
+        output_path = tmp_path / "workflow_durations.png"
+        benchmark.pedantic(
+            service.plot_workflow_durations,
+            args=(project,),
+            kwargs=dict(output_path=str(output_path), points=points),
+            rounds=5,
+        )
+        assert output_path.stat().st_size > 0
@@ -0,0 +1,135 @@
+"""End to end benchmark of FetchDataService.sync_project against FakeCircleCIServer.
+
+Usage: python -m benchmarks.bench_sync_project --pipelines 500 --latency 0.01
+
+The fake server runs in the same process, so wall time and peak RSS include it.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+
+from benchmarks.fake_circleci import FakeCircleCIServer, SyntheticHistory
+from database import models
+from database.models.base import Base
+from database.models.enums import CiProviders, GitProviders
+from services.fetch_data import FetchDataService
+
+
+def create_dbsession(path: str) -> Session:
+    engine = create_engine(f"sqlite:///{path}", echo=False)
+    Base.metadata.create_all(engine)
+    return Session(bind=engine)
+
+
+def create_project(dbsession: Session) -> models.Project:
+    organization = models.Organization(name="codecov")
+    project = models.Project(
+        ci_provider=CiProviders.circleci,
+        git_provider=GitProviders.github,
+        name="worker",
+        organization=organization,
+        label_analysis_job_name="ATS",
+        regular_tests_job_name="test",
+    )
+    dbsession.add_all([organization, project])
+    dbsession.flush()
+    return project
+
+
+def get_benchmark_config(base_url: str, **fetch_config) -> dict:
+    return {
+        "datasources": {
+            "circleci": {
+                "api_token": "benchmark",
+                "base_url": base_url,
+                "http": {"max_connections": 50},
+                "scheduler": {"max_concurrency": 50},
+                "retry": {"backoff_base": 0.01, "retry_after_max": 0.1},
+                "circuit_breaker": {"reset_timeout": 0.1},
+            }
+        },
+        "fetch": fetch_config,
+    }
+
+
+async def run_benchmark(
+    server: FakeCircleCIServer, dbsession: Session, config: dict
+) -> dict:
+    project = create_project(dbsession)
+    fetch_service = FetchDataService(dbsession, config)
+    start = time.perf_counter()
+    await fetch_service.sync_project(project)
+    dbsession.commit()
+    wall_time = time.perf_counter() - start
+
+    rows = sum(
+        dbsession.query(func.count(model.id)).scalar()
+        for model in (models.Pipeline, models.Workflow, models.Job)
+    )
+    return dict(
+        wall_time=wall_time,
+        pages=server.request_count,
+        pages_per_second=server.request_count / wall_time,
+        rows=rows,
+        rows_per_second=rows / wall_time,
+        responses_by_status=server.responses_by_status,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+
+
+async def main(args):
+    history = SyntheticHistory(
+        pipelines=args.pipelines,
+        workflows_per_pipeline=args.workflows,
+        jobs_per_workflow=args.jobs,
+    )
+    server = FakeCircleCIServer(
+        history,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=0,
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        dbsession = create_dbsession(os.path.join(directory, "benchmark.sqlite"))
+        async with server:
+            config = get_benchmark_config(
+                server.base_url,
+                workflow_workers=args.workflow_workers,
+                job_workers=args.job_workers,
+            )
+            results = await run_benchmark(server, dbsession, config)
+        dbsession.close()
+
+    print(
+        f"{args.pipelines} pipelines, {history.workflow_count} workflows, "
+        + f"{history.job_count} jobs"
+    )
+    print(f"  wall time: {results['wall_time']:.2f}s")
+    print(f"  pages:     {results['pages']} ({results['pages_per_second']:.0f}/s)")
+    print(f"  rows:      {results['rows']} ({results['rows_per_second']:.0f}/s)")
+    print(f"  responses: {results['responses_by_status']}")
+    print(f"  peak RSS:  {results['peak_rss_mb']:.0f}MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pipelines", type=int, default=200)
+    parser.add_argument("--workflows", type=int, default=2, help="Per pipeline")
+    parser.add_argument("--jobs", type=int, default=10, help="Per workflow")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--workflow-workers", type=int, default=10)
+    parser.add_argument("--job-workers", type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import random
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class SyntheticHistory(object):
+    """Deterministic CI history of a single project.
+
+    Nothing is stored: every pipeline / workflow / job is derived from its
+    position, so histories of any size cost no memory.
+    Pipeline `i` (1-indexed, `pipelines` is the newest) has workflows
+    `workflow-i-w` and those have jobs `job-i-w-j`.
+    """
+
+    def __init__(
+        self,
+        pipelines: int = 100,
+        workflows_per_pipeline: int = 2,
+        jobs_per_workflow: int = 10,
+        job_names: Tuple[str, ...] = ("ATS", "test"),
+        page_size: int = 20,
+        start: datetime = datetime(2023, 1, 1),
+        pipeline_interval: timedelta = timedelta(minutes=30),
+        seed: int = 0,
+    ) -> None:
+        self.pipelines = pipelines
+        self.workflows_per_pipeline = workflows_per_pipeline
+        self.jobs_per_workflow = jobs_per_workflow
+        # The first jobs of every workflow use these names, the others are filler
+        self.job_names = job_names
+        self.page_size = page_size
+        self.start = start
+        self.pipeline_interval = pipeline_interval
+        self.seed = seed
+
+    @property
+    def workflow_count(self) -> int:
+        return self.pipelines * self.workflows_per_pipeline
+
+    @property
+    def job_count(self) -> int:
+        return self.workflow_count * self.jobs_per_workflow
+
+    def _random(self, *key) -> random.Random:
+        return random.Random(f"{self.seed}-{key}")
+
+    @staticmethod
+    def _format_date(date: datetime) -> str:
+        return date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    def _pipeline_created_at(self, number: int) -> datetime:
+        return self.start + number * self.pipeline_interval
+
+    def get_pipeline(self, number: int) -> dict:
+        return {
+            "id": f"pipeline-{number}",
+            "number": number,
+            "state": "created",
+            "created_at": self._format_date(self._pipeline_created_at(number)),
+            "errors": [],
+            "trigger": {},
+            "vcs": {},
+        }
+
+    def get_workflow(self, number: int, workflow: int) -> dict:
+        created_at = self._pipeline_created_at(number) + timedelta(seconds=workflow)
+        duration = self._random("workflow", number, workflow).randint(300, 1800)
+        failed = self._random("workflow-status", number, workflow).random() < 0.1
+        return {
+            "id": f"workflow-{number}-{workflow}",
+            "pipeline_id": f"pipeline-{number}",
+            "pipeline_number": number,
+            "name": f"workflow-{workflow}",
+            "status": "failed" if failed else "success",
+            "created_at": self._format_date(created_at),
+            "stopped_at": self._format_date(created_at + timedelta(seconds=duration)),
+        }
+
+    def get_job(self, number: int, workflow: int, job: int) -> dict:
+        rng = self._random("job", number, workflow, job)
+        started_at = (
+            self._pipeline_created_at(number)
+            + timedelta(seconds=workflow)
+            + timedelta(seconds=rng.randint(0, 120))
+        )
+        stopped_at = started_at + timedelta(seconds=rng.randint(30, 900))
+        name = self.job_names[job] if job < len(self.job_names) else f"job-{job}"
+        return {
+            "id": f"job-{number}-{workflow}-{job}",
+            "job_number": (number * self.workflows_per_pipeline + workflow)
+            * self.jobs_per_workflow
+            + job,
+            "name": name,
+            "status": "failed" if rng.random() < 0.1 else "success",
+            "type": "build",
+            "dependencies": [],
+            "started_at": self._format_date(started_at),
+            "stopped_at": self._format_date(stopped_at),
+        }
+
+    def _page(self, items: List[dict], offset: int, total: int) -> dict:
+        next_offset = offset + len(items)
+        return {
+            "items": items,
+            "next_page_token": str(next_offset) if next_offset < total else None,
+        }
+
+    def list_pipelines(self, offset: int) -> dict:
+        # Newest first, like the real API
+        newest = self.pipelines - offset
+        oldest = max(newest - self.page_size, 0)
+        items = [self.get_pipeline(number) for number in range(newest, oldest, -1)]
+        return self._page(items, offset, self.pipelines)
+
+    def list_workflows(self, number: int, offset: int) -> dict:
+        end = min(offset + self.page_size, self.workflows_per_pipeline)
+        items = [self.get_workflow(number, idx) for idx in range(offset, end)]
+        return self._page(items, offset, self.workflows_per_pipeline)
+
+    def list_jobs(self, number: int, workflow: int, offset: int) -> dict:
+        end = min(offset + self.page_size, self.jobs_per_workflow)
+        items = [self.get_job(number, workflow, idx) for idx in range(offset, end)]
+        return self._page(items, offset, self.jobs_per_workflow)
+
+
+class FakeCircleCIServer(object):
+    """Minimal local HTTP/1.1 stand-in for the CircleCI v2 API.
+
+    Serves the pipelines, workflows and jobs of a `SyntheticHistory`, with
+    page tokens, over keep-alive connections. It can inject latency, 5xx
+    errors and 429s to exercise the datasources' retry logic.
+    """
+
+    PIPELINES_PATH = re.compile(r"^/project/.+/pipeline$")
+    WORKFLOWS_PATH = re.compile(r"^/pipeline/pipeline-(\d+)/workflow$")
+    JOBS_PATH = re.compile(r"^/workflow/workflow-(\d+)-(\d+)/job$")
+
+    def __init__(
+        self,
+        history: SyntheticHistory = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: int = 1,
+        seed: int = 0,
+    ) -> None:
+        self.history = history if history is not None else SyntheticHistory()
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.request_count = 0
+        self.connection_count = 0
+        self.responses_by_status: Dict[int, int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _json_response(self, status: int, data: dict, headers: dict = None) -> Response:
+        headers = {**(headers or {}), "Content-Type": "application/json"}
+        return status, headers, json.dumps(data).encode()
+
+    async def handle(self, method: str, path: str, query: Dict[str, list]) -> Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit_rate and self._random.random() < self.rate_limit_rate:
+            return self._json_response(
+                429,
+                {"message": "Rate limit exceeded"},
+                {"Retry-After": str(self.retry_after)},
+            )
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._json_response(502, {"message": "Bad Gateway"})
+
+        offset = int(query.get("page-token", ["0"])[0])
+        if self.PIPELINES_PATH.match(path):
+            return self._json_response(200, self.history.list_pipelines(offset))
+        match = self.WORKFLOWS_PATH.match(path)
+        if match:
+            number = int(match.group(1))
+            return self._json_response(200, self.history.list_workflows(number, offset))
+        match = self.JOBS_PATH.match(path)
+        if match:
+            number, workflow = int(match.group(1)), int(match.group(2))
+            return self._json_response(
+                200, self.history.list_jobs(number, workflow, offset)
+            )
+        return self._json_response(404, {"message": "Not found"})
+
+    async def _handle_connection(self, reader, writer) -> None:
+        self.connection_count += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                keep_alive = True
+                content_length = 0
+                while True:
+                    header_line = await reader.readline()
+                    if header_line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header_line.decode("latin-1").partition(":")
+                    name, value = name.strip().lower(), value.strip().lower()
+                    if name == "connection" and value == "close":
+                        keep_alive = False
+                    elif name == "content-length":
+                        content_length = int(value)
+                if content_length:
+                    await reader.readexactly(content_length)
+
+                self.request_count += 1
+                url = urlsplit(target)
+                status, headers, body = await self.handle(
+                    method, url.path, parse_qs(url.query)
+                )
+                self.responses_by_status[status] = (
+                    self.responses_by_status.get(status, 0) + 1
+                )
+                head = [f"HTTP/1.1 {status} X"]
+                headers = {
+                    **headers,
+                    "Content-Length": str(len(body)),
+                    "Connection": "keep-alive" if keep_alive else "close",
+                }
+                head.extend(f"{name}: {value}" for name, value in headers.items())
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,240 @@
+"""Bulk-creates a synthetic CI history of a project straight into the database.
+
+Usage: python -m benchmarks.synthetic_dataset dataset.sqlite --pipelines 10000
+
+Unlike the factories, nothing goes through the ORM: rows are generated as
+NumPy columns and written with the SQLite driver's executemany, so the
+default 10k pipelines, 100k workflows and 500k jobs take seconds. Workflows are left with
+`metrics_dirty` set and without durations, as if they had just been synced.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import Session
+
+from database import models
+from database.models.base import Base
+from database.models.enums import CiProviders, GitProviders, JobKinds
+from services.job_classifier import JobClassifier
+
+
+def create_project(
+    dbsession: Session, organization_name: str = "codecov", project_name: str = "worker"
+) -> models.Project:
+    organization = models.Organization(name=organization_name)
+    project = models.Project(
+        ci_provider=CiProviders.circleci,
+        git_provider=GitProviders.github,
+        name=project_name,
+        organization=organization,
+        label_analysis_job_name="ATS",
+        regular_tests_job_name="test",
+    )
+    dbsession.add_all([organization, project])
+    dbsession.flush()
+    return project
+
+
+def _next_id(dbsession: Session, model) -> int:
+    return (dbsession.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _insert(dbsession: Session, model, columns: dict) -> None:
+    # Straight to the driver's executemany: SQLAlchemy's processing of the
+    # parameters would take most of the time with this many rows
+    names = list(columns)
+    statement = (
+        f"INSERT INTO {model.__tablename__} ({', '.join(names)})"
+        f" VALUES ({', '.join('?' * len(names))})"
+    )
+    rows = list(zip(*(columns[name] for name in names)))
+    dbsession.connection().exec_driver_sql(statement, rows)
+
+
+def _to_datetimes(values: np.ndarray) -> List[str]:
+    # As SQLAlchemy's DateTime stores them in SQLite
+    return np.char.replace(
+        np.datetime_as_string(values.astype("datetime64[us]")), "T", " "
+    ).tolist()
+
+
+def generate_dataset(
+    dbsession: Session,
+    project: models.Project,
+    pipelines: int = 10000,
+    workflows_per_pipeline: int = 10,
+    jobs_per_workflow: int = 5,
+    job_names: Optional[Sequence[str]] = None,
+    start: datetime = datetime(2023, 1, 1),
+    pipeline_interval_seconds: int = 1800,
+    failure_rate: float = 0.05,
+    seed: int = 0,
+) -> dict:
+    """Adds `pipelines` pipelines to `project`, each with `workflows_per_pipeline`
+    workflows of `jobs_per_workflow` jobs.
+
+    Jobs are named after `job_names` in order (by default the project's label
+    analysis job, its regular tests job in 2 shards, then filler jobs) and
+    classified like the fetch service does. Pipelines are about
+    `pipeline_interval_seconds` apart. Job durations are log-normal, slowly
+    drifting over the history, and `failure_rate` of the jobs fail.
+    Returns the number of rows created by table."""
+    if dbsession.get_bind().dialect.name != "sqlite":
+        raise ValueError("Synthetic datasets can only be generated into SQLite")
+    rng = np.random.default_rng(seed)
+    if job_names is None:
+        job_names = [
+            project.label_analysis_job_name,
+            project.regular_tests_job_name,
+            project.regular_tests_job_name,
+        ]
+    job_names = [
+        *job_names[:jobs_per_workflow],
+        *(f"job-{idx}" for idx in range(len(job_names), jobs_per_workflow)),
+    ]
+    job_classifier = JobClassifier.for_project(project)
+    job_kinds = [job_classifier.classify(name) for name in job_names]
+
+    # Pipelines
+    first_pipeline_id = _next_id(dbsession, models.Pipeline)
+    pipeline_ids = np.arange(first_pipeline_id, first_pipeline_id + pipelines)
+    number_offset = (
+        dbsession.query(func.max(models.Pipeline.number))
+        .filter(models.Pipeline.project_id == project.id)
+        .scalar()
+        or 0
+    )
+    jitter = rng.integers(0, pipeline_interval_seconds // 2 + 1, pipelines)
+    pipeline_created_at = np.datetime64(start, "s") + (
+        np.arange(pipelines) * pipeline_interval_seconds + jitter
+    ).astype("timedelta64[s]")
+
+    # Jobs, as a (workflow, job) grid. Workflows start when their pipeline is
+    # created, and their jobs a bit later. Regular tests get slower over time.
+    workflow_count = pipelines * workflows_per_pipeline
+    drift = np.repeat(np.linspace(1, 1.5, pipelines), workflows_per_pipeline)
+    median_seconds = np.array(
+        [120 if kind == JobKinds.label_analysis else 600 for kind in job_kinds]
+    )
+    job_seconds = np.maximum(
+        1,
+        (
+            median_seconds
+            * drift[:, np.newaxis]
+            * rng.lognormal(0, 0.3, (workflow_count, jobs_per_workflow))
+        ).astype(np.int64),
+    )
+    workflow_started_at = np.repeat(
+        pipeline_created_at, workflows_per_pipeline
+    ) + rng.integers(0, 60, workflow_count).astype("timedelta64[s]")
+    job_started_at = workflow_started_at[:, np.newaxis] + rng.integers(
+        0, 120, (workflow_count, jobs_per_workflow)
+    ).astype("timedelta64[s]")
+    job_stopped_at = job_started_at + job_seconds.astype("timedelta64[s]")
+    job_failed = rng.random((workflow_count, jobs_per_workflow)) < failure_rate
+    workflow_failed = job_failed.any(axis=1)
+    if jobs_per_workflow:
+        workflow_stopped_at = job_stopped_at.max(axis=1)
+    else:
+        workflow_stopped_at = workflow_started_at
+
+    _insert(
+        dbsession,
+        models.Pipeline,
+        dict(
+            id=pipeline_ids.tolist(),
+            external_id=[
+                f"pipeline-{project.id}-{pipeline_id}"
+                for pipeline_id in pipeline_ids.tolist()
+            ],
+            number=(number_offset + 1 + np.arange(pipelines)).tolist(),
+            status=["created"] * pipelines,
+            created_at=_to_datetimes(pipeline_created_at),
+            project_id=[project.id] * pipelines,
+        ),
+    )
+
+    first_workflow_id = _next_id(dbsession, models.Workflow)
+    workflow_ids = np.arange(first_workflow_id, first_workflow_id + workflow_count)
+    _insert(
+        dbsession,
+        models.Workflow,
+        dict(
+            id=workflow_ids.tolist(),
+            external_id=[
+                f"workflow-{workflow_id}" for workflow_id in workflow_ids.tolist()
+            ],
+            name=[f"workflow-{idx}" for idx in range(workflows_per_pipeline)]
+            * pipelines,
+            started_at=_to_datetimes(workflow_started_at),
+            stopped_at=_to_datetimes(workflow_stopped_at),
+            status=np.where(workflow_failed, "failed", "success").tolist(),
+            metrics_dirty=[1] * workflow_count,
+            pipeline_id=np.repeat(pipeline_ids, workflows_per_pipeline).tolist(),
+        ),
+    )
+
+    job_count = workflow_count * jobs_per_workflow
+    first_job_id = _next_id(dbsession, models.Job)
+    job_ids = np.arange(first_job_id, first_job_id + job_count)
+    _insert(
+        dbsession,
+        models.Job,
+        dict(
+            id=job_ids.tolist(),
+            external_id=[f"job-{job_id}" for job_id in job_ids.tolist()],
+            number=(job_ids - first_job_id).tolist(),
+            status=np.where(job_failed.ravel(), "failed", "success").tolist(),
+            name=job_names * workflow_count,
+            kind=[None if kind is None else kind.name for kind in job_kinds]
+            * workflow_count,
+            started_at=_to_datetimes(job_started_at.ravel()),
+            stopped_at=_to_datetimes(job_stopped_at.ravel()),
+            workflow_id=np.repeat(workflow_ids, jobs_per_workflow).tolist(),
+        ),
+    )
+    dbsession.flush()
+    return dict(pipelines=pipelines, workflows=workflow_count, jobs=job_count)
+
+
+def main(args):
+    if os.path.exists(args.path):
+        os.remove(args.path)
+    engine = create_engine(f"sqlite:///{args.path}", echo=False)
+    Base.metadata.create_all(engine)
+    dbsession = Session(bind=engine)
+    start = time.perf_counter()
+    project = create_project(dbsession)
+    counts = generate_dataset(
+        dbsession,
+        project,
+        pipelines=args.pipelines,
+        workflows_per_pipeline=args.workflows,
+        jobs_per_workflow=args.jobs,
+        seed=args.seed,
+    )
+    dbsession.commit()
+    dbsession.close()
+    print(
+        f"{counts['pipelines']} pipelines, {counts['workflows']} workflows, "
+        + f"{counts['jobs']} jobs in {time.perf_counter() - start:.2f}s"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="SQLite file, replaced if it exists")
+    parser.add_argument("--pipelines", type=int, default=10000)
+    parser.add_argument("--workflows", type=int, default=10, help="Per pipeline")
+    parser.add_argument("--jobs", type=int, default=5, help="Per workflow")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,37 @@
+import logging
+import os
+
+from database.engine import engine, get_dbsession
+from database.maintenance import delete_orphaned_totals, vacuum
+from utils.logging_config import LOGGER_NAME, configure_logger
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def _database_size():
+    if engine.dialect.name != "sqlite" or not engine.url.database:
+        return None
+    return os.path.getsize(engine.url.database)
+
+
+def compact() -> None:
+    size_before = _database_size()
+    dbsession = get_dbsession()
+    deleted_totals = delete_orphaned_totals(dbsession)
+    dbsession.commit()
+    vacuum(engine)
+    logger.info(
+        "Compacted database",
+        extra=dict(
+            extra_log_attributes=dict(
+                deleted_totals=deleted_totals,
+                size_before=size_before,
+                size_after=_database_size(),
+            )
+        ),
+    )
+
+
+if __name__ == "__main__":
+    configure_logger(logger=logger)
+    compact()
@@ -3,11 +3,17 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 from database.models.base import Base
+from database.query_counter import QueryCounter
 
 
 @pytest.fixture
 def engine():
-    engine = create_engine("sqlite:///:memory:", echo=False)
+    # FetchDataService writes from its own thread while syncing a project
+    engine = create_engine(
+        "sqlite:///:memory:",
+        echo=False,
+        connect_args={"check_same_thread": False},
+    )
     return engine
 
 
@@ -30,3 +36,9 @@ def dbsession(engine, db):
     session.close()
     connection_transaction.rollback()
     connection.close()
+
+
+@pytest.fixture
+def query_counter(engine):
+    """Counts the statements run inside `with query_counter:`"""
+    return QueryCounter(engine)
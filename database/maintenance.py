@@ -0,0 +1,100 @@
+from sqlalchemy import bindparam, delete, func, select, text, update
+
+from database import models
+
+
+def delete_orphaned_totals(dbsession) -> int:
+    """Deletes the totals no pipeline or project points to.
+    ProcessDataService used to create new totals on every run instead of
+    updating them, leaving the previous ones behind.
+    Returns how many were deleted."""
+    referenced_ids = (
+        select(models.Pipeline.totals_id)
+        .where(models.Pipeline.totals_id.isnot(None))
+        .union(
+            select(models.Project.totals_id).where(models.Project.totals_id.isnot(None))
+        )
+    )
+    result = dbsession.execute(
+        delete(models.Totals)
+        .where(models.Totals.id.not_in(referenced_ids))
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+_pipelines = models.Pipeline.__table__
+_workflows = models.Workflow.__table__
+_jobs = models.Job.__table__
+
+# Tables with external ids, parents first: the columns pointing to them, and
+# the workflows whose metrics change when rows are merged into `ids`
+_EXTERNAL_ID_TABLES = [
+    (
+        _pipelines,
+        [(_workflows, "pipeline_id")],
+        lambda ids: _workflows.c.pipeline_id.in_(ids),
+    ),
+    (
+        _workflows,
+        [(_jobs, "workflow_id")],
+        lambda ids: _workflows.c.id.in_(ids),
+    ),
+    (
+        _jobs,
+        [],
+        lambda ids: _workflows.c.id.in_(
+            select(_jobs.c.workflow_id).where(_jobs.c.id.in_(ids))
+        ),
+    ),
+]
+
+
+def delete_duplicate_external_ids(connection) -> dict:
+    """Keeps a single pipeline, workflow and job per external id (the oldest).
+    Concurrent syncs used to insert the same CI object more than once, which
+    the unique indexes on external_id don't allow. Rows pointing to a deleted
+    duplicate are moved to the one that's kept, and the workflows involved
+    have their metrics recalculated.
+    Returns how many rows were deleted by table."""
+    deleted = {}
+    for table, children, affected_workflows in _EXTERNAL_ID_TABLES:
+        kept = (
+            select(table.c.external_id, func.min(table.c.id).label("kept_id"))
+            .where(table.c.external_id.isnot(None))
+            .group_by(table.c.external_id)
+            .having(func.count() > 1)
+            .subquery()
+        )
+        rows = connection.execute(
+            select(table.c.id.label("duplicate_id"), kept.c.kept_id)
+            .join(kept, table.c.external_id == kept.c.external_id)
+            .where(table.c.id != kept.c.kept_id)
+        ).all()
+        deleted[table.name] = len(rows)
+        if not rows:
+            continue
+        for child, column in children:
+            connection.execute(
+                update(child)
+                .where(child.c[column] == bindparam("duplicate_id"))
+                .values({column: bindparam("kept_id")}),
+                [row._asdict() for row in rows],
+            )
+        connection.execute(
+            update(_workflows)
+            .where(affected_workflows(sorted({row.kept_id for row in rows})))
+            .values(metrics_dirty=True)
+        )
+        connection.execute(
+            delete(table).where(table.c.id.in_([row.duplicate_id for row in rows]))
+        )
+    return deleted
+
+
+def vacuum(engine) -> None:
+    """Gives the space of deleted rows back, and refreshes the query planner's
+    statistics. VACUUM can't run inside a transaction."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM"))
+        connection.execute(text("ANALYZE"))
@@ -1,6 +1,9 @@
+from database.models.duration_rollup import DurationRollup
 from database.models.job import Job
+from database.models.job_classification import JobClassification
 from database.models.organization import Organization
 from database.models.pipeline import Pipeline
 from database.models.project import Project
+from database.models.sync_cursor import SyncCursor
 from database.models.totals import Totals
 from database.models.workflow import Workflow
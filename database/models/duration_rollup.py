@@ -0,0 +1,51 @@
+import math
+
+from sqlalchemy import Column, ForeignKey, UniqueConstraint, types
+from sqlalchemy.orm import relationship
+
+from database.models.base import Base
+from database.models.enums import JobKinds, RollupGranularities
+
+
+class DurationRollup(Base):
+    """Totals of one kind of job, for the workflow runs of a project that
+    started in a time bucket (hour, day or week starting on Monday).
+    Kept up to date by ProcessDataService as workflows are processed."""
+
+    __tablename__ = "duration_rollups"
+    __table_args__ = (
+        UniqueConstraint("project_id", "granularity", "bucket_start", "kind"),
+    )
+
+    id = Column("id", types.Integer, primary_key=True)
+    project_id = Column(
+        "project_id", types.Integer, ForeignKey("projects.id"), nullable=False
+    )
+    project = relationship("Project")
+    granularity = Column(types.Enum(RollupGranularities), nullable=False)
+    bucket_start = Column(types.DateTime, nullable=False)
+    kind = Column(types.Enum(JobKinds), nullable=False)
+
+    success_count = Column(types.Integer, nullable=False, default=0)
+    failure_count = Column(types.Integer, nullable=False, default=0)
+    # Of the successful runs' durations
+    duration_count = Column(types.Integer, nullable=False, default=0)
+    duration_sum = Column(types.Float, nullable=False, default=0)
+    duration_sum_of_squares = Column(types.Float, nullable=False, default=0)
+    # Serialized DurationSketch, for quantiles
+    duration_sketch = Column(types.LargeBinary)
+
+    @property
+    def mean_duration(self):
+        if not self.duration_count:
+            return None
+        return self.duration_sum / self.duration_count
+
+    @property
+    def stdev_duration(self):
+        if (self.duration_count or 0) < 2:
+            return None
+        mean = self.duration_sum / self.duration_count
+        return math.sqrt(
+            max(self.duration_sum_of_squares / self.duration_count - mean**2, 0)
+        )
@@ -9,3 +9,20 @@ class GitProviders(Enum):
 
 class CiProviders(Enum):
     circleci = "circleci"
+
+
+class JobKinds(Enum):
+    label_analysis = "label_analysis"
+    regular_tests = "regular_tests"
+
+
+class JobPatternTypes(Enum):
+    exact = "exact"
+    glob = "glob"
+    regex = "regex"
+
+
+class RollupGranularities(Enum):
+    hour = "hour"
+    day = "day"
+    week = "week"
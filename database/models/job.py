@@ -2,16 +2,19 @@ from sqlalchemy import Column, ForeignKey, types
 from sqlalchemy.orm import relationship
 
 from database.models.base import Base
+from database.models.enums import JobKinds
 
 
 class Job(Base):
     __tablename__ = "jobs"
 
     id = Column("id", types.Integer, primary_key=True)
-    external_id = Column(types.String, nullable=True)
+    external_id = Column(types.String, nullable=True, unique=True, index=True)
     number = Column(types.Integer, nullable=False)
     status = Column(types.String)
     name = Column(types.String)
+    # Set when the job is synced, from the project's job classification
+    kind = Column(types.Enum(JobKinds), nullable=True, index=True)
     started_at = Column(types.DateTime)
     stopped_at = Column(types.DateTime)
     workflow_id = Column("workflow_id", types.Integer, ForeignKey("workflows.id"))
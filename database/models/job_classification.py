@@ -0,0 +1,24 @@
+from sqlalchemy import Column, ForeignKey, types
+from sqlalchemy.orm import relationship
+
+from database.models.base import Base
+from database.models.enums import JobKinds, JobPatternTypes
+
+
+class JobClassification(Base):
+    """Tells which of a project's CI jobs are label analysis / regular tests jobs.
+    A project can have many of each (e.g. parallel shards)."""
+
+    __tablename__ = "job_classifications"
+
+    id = Column("id", types.Integer, primary_key=True)
+    project_id = Column(
+        "project_id", types.Integer, ForeignKey("projects.id"), index=True
+    )
+    project = relationship("Project", back_populates="job_classifications")
+    kind = Column(types.Enum(JobKinds), nullable=False)
+    # Matched against the whole job name
+    pattern = Column(types.String, nullable=False)
+    pattern_type = Column(
+        types.Enum(JobPatternTypes), nullable=False, default=JobPatternTypes.exact
+    )
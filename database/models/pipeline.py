@@ -8,7 +8,7 @@ class Pipeline(Base):
     __tablename__ = "pipelines"
 
     id = Column("id", types.Integer, primary_key=True)
-    external_id = Column(types.String, nullable=True)
+    external_id = Column(types.String, nullable=True, unique=True, index=True)
     number = Column(types.Integer, nullable=False)
     status = Column(types.String)
     created_at = Column(types.DateTime)
@@ -14,8 +14,7 @@ class Project(Base):
     git_provider = Column(types.Enum(GitProviders))
     name = Column(types.String)
     ci_provider = Column(types.Enum(CiProviders))
-    # TODO: Add support for multiple regular-tests / label-analysis jobs
-    # (e.g. sentry has concurrency that runs 5 of each)
+    # Used when the project has no job_classifications
     label_analysis_job_name = Column(types.String)
     regular_tests_job_name = Column(types.String)
     # Relationships to other models
@@ -24,6 +23,12 @@ class Project(Base):
     )
     organization = relationship("Organization", back_populates="projects")
     pipelines = relationship("Pipeline", back_populates="project")
+    # Projects with many label-analysis / regular-tests jobs
+    # (e.g. sentry has concurrency that runs 5 of each) list them here
+    job_classifications = relationship(
+        "JobClassification", back_populates="project", order_by="JobClassification.id"
+    )
+    sync_cursor = relationship("SyncCursor", back_populates="project", uselist=False)
     totals_id = Column(
         "totals_id", types.Integer, ForeignKey("totals.id"), nullable=True
     )
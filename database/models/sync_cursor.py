@@ -0,0 +1,22 @@
+from sqlalchemy import Column, ForeignKey, types
+from sqlalchemy.orm import relationship
+
+from database.models.base import Base
+
+
+class SyncCursor(Base):
+    """Marks how far a project's CI history has already been synced"""
+
+    __tablename__ = "sync_cursors"
+
+    id = Column("id", types.Integer, primary_key=True)
+    project_id = Column(
+        "project_id", types.Integer, ForeignKey("projects.id"), unique=True
+    )
+    project = relationship("Project", back_populates="sync_cursor")
+    # Newest pipeline synced. Pipelines up to this one are not listed again.
+    last_pipeline_number = Column(types.Integer, nullable=True)
+    last_pipeline_created_at = Column(types.DateTime, nullable=True)
+    # Pipelines (by id) that still had unfinished workflows when last synced
+    pending_pipeline_ids = Column(types.JSON, default=list)
+    updated_at = Column(types.DateTime)
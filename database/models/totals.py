@@ -13,6 +13,8 @@ class Totals(Base):
     label_analysis_median_duration = Column(types.Float)
     label_analysis_p90_duration = Column(types.Float)
     label_analysis_stdev_duration = Column(types.Float)
+    # Serialized DurationSketch of the successful durations
+    label_analysis_duration_sketch = Column(types.LargeBinary)
 
     regular_tests_success_count = Column(types.Integer)
     regular_tests_failure_count = Column(types.Integer)
@@ -20,6 +22,7 @@ class Totals(Base):
     regular_tests_median_duration = Column(types.Float)
     regular_tests_p90_duration = Column(types.Float)
     regular_tests_stdev_duration = Column(types.Float)
+    regular_tests_duration_sketch = Column(types.LargeBinary)
 
     def __repr__(self):
         return (
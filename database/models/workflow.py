@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey, types
+from sqlalchemy import Column, ForeignKey, true, types
 from sqlalchemy.orm import Mapped, relationship
 
 from database.models.base import Base
@@ -9,18 +9,34 @@ class Workflow(Base):
     __tablename__ = "workflows"
 
     id = Column("id", types.Integer, primary_key=True)
-    external_id = Column(types.String, nullable=True)
+    external_id = Column(types.String, nullable=True, unique=True, index=True)
     name = Column(types.String)
     started_at = Column(types.DateTime)
     stopped_at = Column(types.DateTime)
     status = Column(types.String)
+    # A workflow can run several jobs (shards) of each kind.
+    # duration_seconds is the wall-clock span from the first shard's start
+    # to the last shard's end; success means all shards succeeded.
     label_analysis_duration_seconds = Column(types.Integer, nullable=True)
     label_analysis_success = Column(types.Boolean, nullable=True)
+    label_analysis_total_seconds = Column(types.Integer, nullable=True)
+    label_analysis_max_seconds = Column(types.Integer, nullable=True)
+    label_analysis_job_count = Column(types.Integer, nullable=True)
     regular_tests_duration_seconds = Column(types.Integer, nullable=True)
     regular_tests_success = Column(types.Boolean, nullable=True)
+    regular_tests_total_seconds = Column(types.Integer, nullable=True)
+    regular_tests_max_seconds = Column(types.Integer, nullable=True)
+    regular_tests_job_count = Column(types.Integer, nullable=True)
+    # Set when the workflow or its jobs are synced, cleared once the metrics
+    # above are recalculated. Only dirty workflows are processed again.
+    metrics_dirty = Column(
+        types.Boolean, nullable=False, default=True, server_default=true(), index=True
+    )
 
     # Relationships
-    pipeline_id = Column("pipeline_id", types.Integer, ForeignKey("pipelines.id"))
+    pipeline_id = Column(
+        "pipeline_id", types.Integer, ForeignKey("pipelines.id"), index=True
+    )
     pipeline: Mapped[Pipeline] = relationship("Pipeline", back_populates="workflows")
     jobs = relationship("Job", back_populates="workflow")
 
@@ -0,0 +1,117 @@
+"""Counts and times the SQL statements a block of code runs.
+
+    with QueryCounter(engine) as queries:
+        process_data.sync_project_metrics(project)
+    queries.assert_at_most(20)
+
+Statements are seen through the engine's cursor events, so ORM lazy loads,
+autoflushes and statements from other threads (e.g. the db-writer) count too.
+With a `name`, the count and time also go to the run's metrics.
+"""
+import time
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+from sqlalchemy import event
+
+from utils.metrics import metrics
+
+ExecutedStatement = namedtuple(
+    "ExecutedStatement", ["statement", "seconds", "executemany"]
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter(object):
+    def __init__(self, engine, name: Optional[str] = None) -> None:
+        self.engine = engine
+        self.name = name
+        self.statements: List[ExecutedStatement] = []
+        # Where each connection keeps the start times of its running statements
+        self._info_key = ("query_counter", id(self))
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def seconds(self) -> float:
+        return sum(item.seconds for item in self.statements)
+
+    def _before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault(self._info_key, []).append(time.perf_counter())
+
+    def _after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        start_times = conn.info.get(self._info_key)
+        if not start_times:
+            # Started before the counter was
+            return
+        self.statements.append(
+            ExecutedStatement(
+                statement, time.perf_counter() - start_times.pop(), executemany
+            )
+        )
+
+    def _handle_error(self, exception_context):
+        # after_cursor_execute doesn't run for statements that fail
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(self._info_key):
+            started_at = conn.info[self._info_key].pop()
+            self.statements.append(
+                ExecutedStatement(
+                    exception_context.statement,
+                    time.perf_counter() - started_at,
+                    exception_context.execution_context is not None
+                    and exception_context.execution_context.executemany,
+                )
+            )
+
+    def __enter__(self) -> "QueryCounter":
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(self.engine, "handle_error", self._handle_error)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(self.engine, "handle_error", self._handle_error)
+        if self.name is not None:
+            metrics.inc("sql_statements_total", self.count, block=self.name)
+            metrics.inc("sql_statement_seconds_total", self.seconds, block=self.name)
+
+    def most_common(self, limit: int = 5) -> List[Tuple[str, int, float]]:
+        """The statements run the most, with how many times and how long they took.
+        The same statement over and over is usually a query per row (N+1)."""
+        totals = {}
+        for item in self.statements:
+            count, seconds = totals.get(item.statement, (0, 0.0))
+            totals[item.statement] = (count + 1, seconds + item.seconds)
+        return sorted(
+            (
+                (statement, count, seconds)
+                for statement, (count, seconds) in totals.items()
+            ),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:limit]
+
+    def assert_at_most(self, budget: int) -> None:
+        if self.count <= budget:
+            return
+        repeated = "\n".join(
+            f"  {count}x ({seconds * 1000:.1f}ms) {' '.join(statement.split())[:200]}"
+            for statement, count, seconds in self.most_common()
+        )
+        raise QueryBudgetExceeded(
+            f"{self.count} statements ran, over the budget of {budget}."
+            f" Most common:\n{repeated}"
+        )
@@ -44,3 +44,16 @@ class WorkflowFactory(Factory):
     started_at = datetime(2023, 7, 30, 10)
     stopped_at = datetime(2023, 7, 30, 11)
     pipeline = factory.SubFactory(PipelineFactory)
+
+
+class JobFactory(Factory):
+    class Meta:
+        model = models.Job
+
+    external_id = factory.LazyFunction(lambda: str(uuid4()))
+    number = factory.Sequence(lambda n: n)
+    name = "test"
+    status = "success"
+    started_at = datetime(2023, 7, 30, 10)
+    stopped_at = datetime(2023, 7, 30, 10, 30)
+    workflow = factory.SubFactory(WorkflowFactory)
@@ -0,0 +1,37 @@
+from sqlalchemy import create_engine, text
+
+from database import models
+from database.maintenance import delete_orphaned_totals, vacuum
+from database.tests.factory import PipelineFactory, ProjectFactory
+
+
+class TestMaintenance(object):
+    def test_delete_orphaned_totals(self, dbsession):
+        project = ProjectFactory(totals=models.Totals())
+        pipeline = PipelineFactory(project=project, totals=models.Totals())
+        dbsession.add_all(
+            [
+                pipeline,
+                PipelineFactory(project=project),
+                models.Totals(),
+                models.Totals(),
+            ]
+        )
+        dbsession.flush()
+
+        assert delete_orphaned_totals(dbsession) == 2
+        assert set(dbsession.query(models.Totals)) == {project.totals, pipeline.totals}
+        assert delete_orphaned_totals(dbsession) == 0
+
+    def test_vacuum(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+        with engine.begin() as connection:
+            connection.execute(text("CREATE TABLE items (value TEXT)"))
+            connection.execute(
+                text("INSERT INTO items VALUES (:value)"),
+                [dict(value="x" * 1000) for _ in range(1000)],
+            )
+            connection.execute(text("DELETE FROM items"))
+        size_before = (tmp_path / "test.sqlite").stat().st_size
+        vacuum(engine)
+        assert (tmp_path / "test.sqlite").stat().st_size < size_before
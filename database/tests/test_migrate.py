@@ -0,0 +1,96 @@
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import Session
+
+from database import models
+from database.models.base import Base
+from database.tests.factory import (
+    JobFactory,
+    PipelineFactory,
+    ProjectFactory,
+    WorkflowFactory,
+)
+from migrate import run_migrations
+
+
+class TestRunMigrations(object):
+    def test_duplicate_external_ids(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path / 'test.sqlite'}")
+        Base.metadata.create_all(engine)
+        # As before external_id was unique
+        with engine.begin() as connection:
+            for table in ("pipelines", "workflows", "jobs"):
+                connection.execute(text(f"DROP INDEX ix_{table}_external_id"))
+
+        dbsession = Session(bind=engine)
+        project = ProjectFactory()
+        pipelines = [
+            PipelineFactory(project=project, external_id=external_id)
+            for external_id in ("pipeline", "pipeline", "other_pipeline")
+        ]
+        workflows = [
+            # The second pipeline's workflow is the first one's, synced again
+            WorkflowFactory(
+                pipeline=pipelines[0], external_id="workflow", metrics_dirty=False
+            ),
+            WorkflowFactory(
+                pipeline=pipelines[1], external_id="workflow", metrics_dirty=False
+            ),
+            WorkflowFactory(
+                pipeline=pipelines[1], external_id="new_workflow", metrics_dirty=False
+            ),
+        ]
+        dbsession.add_all(
+            [
+                JobFactory(workflow=workflows[0], external_id="job"),
+                JobFactory(workflow=workflows[1], external_id="job"),
+                JobFactory(workflow=workflows[1], external_id="other_job"),
+                JobFactory(workflow=workflows[2], external_id="new_job"),
+                # Jobs of unknown origin aren't duplicates of one another
+                JobFactory(workflow=workflows[2], external_id=None),
+                JobFactory(workflow=workflows[2], external_id=None),
+            ]
+        )
+        dbsession.commit()
+        kept_pipeline_id, other_pipeline_id = pipelines[0].id, pipelines[2].id
+        kept_workflow_id = workflows[0].id
+        dbsession.close()
+
+        run_migrations(engine)
+
+        dbsession = Session(bind=engine)
+        assert sorted(
+            (pipeline.external_id, pipeline.id)
+            for pipeline in dbsession.query(models.Pipeline)
+        ) == [("other_pipeline", other_pipeline_id), ("pipeline", kept_pipeline_id)]
+        workflows = {
+            workflow.external_id: workflow
+            for workflow in dbsession.query(models.Workflow)
+        }
+        assert sorted(workflows) == ["new_workflow", "workflow"]
+        assert workflows["workflow"].id == kept_workflow_id
+        assert workflows["new_workflow"].pipeline_id == kept_pipeline_id
+        assert all(workflow.metrics_dirty for workflow in workflows.values())
+        jobs = dbsession.query(models.Job).all()
+        assert sorted(
+            (job.external_id or "", job.workflow.external_id) for job in jobs
+        ) == [
+            ("", "new_workflow"),
+            ("", "new_workflow"),
+            ("job", "workflow"),
+            ("new_job", "new_workflow"),
+            ("other_job", "workflow"),
+        ]
+        dbsession.close()
+
+        unique_indexes = {
+            index["name"]
+            for table in ("pipelines", "workflows", "jobs")
+            for index in inspect(engine).get_indexes(table)
+            if index["unique"]
+        }
+        assert unique_indexes == {
+            "ix_pipelines_external_id",
+            "ix_workflows_external_id",
+            "ix_jobs_external_id",
+        }
+        engine.dispose()
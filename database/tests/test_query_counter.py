@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from database import models
+from database.query_counter import QueryBudgetExceeded, QueryCounter
+from database.tests.factory import JobFactory
+from utils.metrics import MetricsRegistry
+
+
+class TestQueryCounter(object):
+    def test_count(self, dbsession, query_counter):
+        jobs = [JobFactory() for _ in range(3)]
+        dbsession.add_all(jobs)
+        dbsession.flush()
+        dbsession.expire_all()
+
+        with query_counter:
+            for job in dbsession.query(models.Job).all():
+                # Lazy loads
+                job.workflow.pipeline
+        # Jobs, then a workflow and a pipeline for each job
+        assert query_counter.count == 1 + 3 * 2
+        assert query_counter.seconds > 0
+        assert all(not item.executemany for item in query_counter.statements)
+        statement, count, seconds = query_counter.most_common(1)[0]
+        assert "FROM workflows" in statement or "FROM pipelines" in statement
+        assert count == 3
+
+        # Stops counting on exit
+        dbsession.query(models.Job).all()
+        assert query_counter.count == 7
+
+    def test_executemany(self, dbsession, query_counter):
+        dbsession.execute(text("CREATE TABLE items (value INTEGER)"))
+        with query_counter:
+            dbsession.execute(
+                text("INSERT INTO items VALUES (:value)"),
+                [dict(value=value) for value in range(10)],
+            )
+        assert query_counter.count == 1
+        assert query_counter.statements[0].executemany is True
+
+    def test_failed_statement(self, engine, query_counter):
+        with query_counter, engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing"))
+            connection.execute(text("SELECT 1"))
+        assert [item.statement for item in query_counter.statements] == [
+            "SELECT * FROM missing",
+            "SELECT 1",
+        ]
+
+    def test_assert_at_most(self, dbsession, query_counter):
+        with query_counter:
+            for _ in range(4):
+                dbsession.execute(text("SELECT 1"))
+        query_counter.assert_at_most(4)
+        with pytest.raises(QueryBudgetExceeded) as exc:
+            query_counter.assert_at_most(3)
+        assert "4 statements ran, over the budget of 3" in str(exc.value)
+        assert "4x" in str(exc.value)
+        assert "SELECT 1" in str(exc.value)
+
+    def test_metrics(self, dbsession, engine, mocker):
+        registry = MetricsRegistry(enabled=True)
+        mocker.patch("database.query_counter.metrics", registry)
+        with QueryCounter(engine, name="process"):
+            dbsession.execute(text("SELECT 1"))
+            dbsession.execute(text("SELECT 2"))
+        counters = registry.as_dict()["counters"]
+        assert counters["sql_statements_total"] == [
+            dict(labels=dict(block="process"), value=2)
+        ]
+        assert counters["sql_statement_seconds_total"][0]["value"] > 0
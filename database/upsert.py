@@ -0,0 +1,58 @@
+from typing import Iterable, List
+
+from sqlalchemy import or_
+
+
+def _get_insert(dbsession):
+    dialect_name = dbsession.get_bind().dialect.name
+    if dialect_name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise NotImplementedError(f"Upsert not supported for {dialect_name}")
+    return insert
+
+
+def upsert(
+    dbsession,
+    model,
+    rows: List[dict],
+    index_elements: Iterable[str],
+    update_columns: Iterable[str],
+    batch_size: int = 500,
+) -> list:
+    """Inserts `rows` in `model`'s table, updating `update_columns` of the rows
+    that conflict on `index_elements` (which must be covered by a unique index).
+
+    Returns the instances of `model` that were inserted or actually changed.
+    Conflicting rows whose `update_columns` are the same are left untouched.
+    """
+    insert = _get_insert(dbsession)
+    update_columns = list(update_columns)
+    index_elements = list(index_elements)
+    changed = []
+    for offset in range(0, len(rows), batch_size):
+        statement = insert(model).values(rows[offset : offset + batch_size])
+        if update_columns:
+            statement = statement.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={column: statement.excluded[column] for column in update_columns},
+                where=or_(
+                    *[
+                        getattr(model, column).is_distinct_from(
+                            statement.excluded[column]
+                        )
+                        for column in update_columns
+                    ]
+                ),
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+        changed.extend(
+            dbsession.scalars(
+                statement.returning(model),
+                execution_options=dict(populate_existing=True),
+            )
+        )
+    return changed
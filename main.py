@@ -1,18 +1,27 @@
+import argparse
 import asyncio
 import logging
+from contextlib import contextmanager, nullcontext
 
-from config import load_config
+from config import get_config, load_config
 from database import models
-from database.engine import get_dbsession
-from database.models.enums import CiProviders, GitProviders
-from services.fetch_data import FetchDataService
-from services.process_data import ProcessDataService
-from utils.logging_config import LOGGER_NAME, configure_logger
+from database.engine import engine, get_dbsession
+from database.models.enums import CiProviders, GitProviders, RollupGranularities
+from database.query_counter import QueryCounter
+from utils.logging_config import LOGGER_NAME, configure_logger_from_config
+from utils.metrics import configure_metrics, export_metrics, metrics
+from utils.profiling import get_profiler
+
+# services.process_data (numpy, matplotlib) is imported by the commands that
+# use it, and services.fetch_data by the ones that fetch, so each command only
+# pays for what it runs
 
 logger = logging.getLogger(LOGGER_NAME)
 
 
 async def collect_data(config, dbsession, project):
+    from services.fetch_data import FetchDataService
+
     fetch_service = FetchDataService(dbsession, config)
     await fetch_service.sync_project(project)
 
@@ -20,25 +29,56 @@ async def collect_data(config, dbsession, project):
     dbsession.flush()
 
 
-def process_data(config, dbsession, project):
+def process_data(config, dbsession, project, full: bool = False):
+    from services.process_data import ProcessDataService
+
     process_service = ProcessDataService(dbsession, config)
-    process_service.sync_project_metrics(project)
+    process_service.sync_project_metrics(project, full=full)
 
     logger.info("Finished processing data")
     dbsession.flush()
 
+
+def plot_data(config, dbsession, project):
+    from services.process_data import ProcessDataService
+
+    process_service = ProcessDataService(dbsession, config)
     logger.info("Generating Workflow data plot")
-    process_service.plot_workflow_durations(project)
+    process_service.plot_workflow_durations(
+        project,
+        granularity=RollupGranularities(
+            get_config(config, "plot", "granularity", default="day")
+        ),
+        output_path=get_config(config, "plot", "output_path"),
+        points=get_config(config, "plot", "points", default=False),
+    )
+
 
+@contextmanager
+def run_phase(profiler, name: str):
+    """Times the phase and counts its SQL statements in the metrics,
+    and profiles it if enabled"""
+    queries = QueryCounter(engine, name=name) if metrics.enabled else nullcontext()
+    with metrics.timer("phase_seconds", phase=name), profiler.phase(name), queries:
+        yield
 
-def create_base_classes(dbsession):
-    organization = models.Organization(name="codecov")
-    dbsession.add(organization)
+
+def create_base_classes(
+    dbsession, organization_name: str = "codecov", project_name: str = "worker"
+):
+    organization = (
+        dbsession.query(models.Organization)
+        .filter(models.Organization.name == organization_name)
+        .first()
+    )
+    if organization is None:
+        organization = models.Organization(name=organization_name)
+        dbsession.add(organization)
 
     project = models.Project(
         ci_provider=CiProviders.circleci,
         git_provider=GitProviders.github,
-        name="worker",
+        name=project_name,
         organization=organization,
         label_analysis_job_name="ATS",
         regular_tests_job_name="test",
@@ -49,28 +89,193 @@ def create_base_classes(dbsession):
     return project
 
 
-async def main():
+def get_project(dbsession, organization_name: str, project_name: str):
+    project = (
+        dbsession.query(models.Project)
+        .join(models.Organization)
+        .filter(
+            models.Organization.name == organization_name,
+            models.Project.name == project_name,
+        )
+        .first()
+    )
+    if project is None:
+        project = create_base_classes(dbsession, organization_name, project_name)
+    return project
 
-    configure_logger(logger=logger)
-    config = load_config()
 
-    dbsession = get_dbsession()
+def parse_args(argv=None) -> argparse.Namespace:
+    project_arguments = argparse.ArgumentParser(add_help=False)
+    project_arguments.add_argument("--organization", default="codecov")
+    project_arguments.add_argument("--project", default="worker")
+    project_arguments.add_argument(
+        "--profile",
+        action="store_true",
+        help="cProfile each phase, writing the reports next to the run summary",
+    )
+    project_arguments.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="With --profile, also trace memory allocations (slow)",
+    )
 
-    project = (
-        dbsession.query(models.Project).filter(models.Project.name == "worker").first()
+    fetch_arguments = argparse.ArgumentParser(add_help=False)
+    fetch_group = fetch_arguments.add_argument_group("fetch")
+    fetch_group.add_argument(
+        "--no-incremental",
+        action="store_true",
+        help="List all the pipelines, not only the ones since the last sync",
     )
-    if project is None:
-        project = create_base_classes(dbsession)
+    fetch_group.add_argument(
+        "--workflow-workers",
+        type=int,
+        help="Pipelines fetching workflows at the same time",
+    )
+    fetch_group.add_argument(
+        "--job-workers", type=int, help="Workflows fetching jobs at the same time"
+    )
+    fetch_group.add_argument(
+        "--max-concurrency", type=int, help="CircleCI requests in flight at once"
+    )
+
+    process_arguments = argparse.ArgumentParser(add_help=False)
+    process_group = process_arguments.add_argument_group("process")
+    process_group.add_argument(
+        "--full",
+        action="store_true",
+        help="Recalculate all the workflows, not only the ones synced since the last run",
+    )
+
+    plot_arguments = argparse.ArgumentParser(add_help=False)
+    plot_group = plot_arguments.add_argument_group("plot")
+    plot_group.add_argument(
+        "--granularity", choices=[item.value for item in RollupGranularities]
+    )
+    plot_group.add_argument(
+        "--output", help="Write the plot to this PNG / SVG file instead of showing it"
+    )
+    plot_group.add_argument(
+        "--points",
+        action="store_true",
+        default=None,
+        help="Also plot every workflow run",
+    )
+
+    parser = argparse.ArgumentParser(description="Collects and analyzes ATS data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser(
+        "fetch",
+        parents=[project_arguments, fetch_arguments],
+        help="Sync the project's data from the CI provider",
+    )
+    subparsers.add_parser(
+        "process",
+        parents=[project_arguments, process_arguments],
+        help="Calculate the project's metrics",
+    )
+    subparsers.add_parser(
+        "plot",
+        parents=[project_arguments, plot_arguments],
+        help="Plot the project's workflow durations",
+    )
+    subparsers.add_parser(
+        "all",
+        parents=[project_arguments, fetch_arguments, process_arguments, plot_arguments],
+        help="fetch, process and plot",
+    )
+    return parser.parse_args(argv)
+
+
+def _set_config(config: dict, *path: str, value) -> None:
+    for key in path[:-1]:
+        config = config.setdefault(key, {})
+    config[path[-1]] = value
+
+
+def apply_arguments(config: dict, args: argparse.Namespace) -> dict:
+    """Overrides the config with the command line arguments given"""
+    overrides = [
+        (("fetch", "workflow_workers"), getattr(args, "workflow_workers", None)),
+        (("fetch", "job_workers"), getattr(args, "job_workers", None)),
+        (
+            ("datasources", "circleci", "scheduler", "max_concurrency"),
+            getattr(args, "max_concurrency", None),
+        ),
+        (("plot", "granularity"), getattr(args, "granularity", None)),
+        (("plot", "output_path"), getattr(args, "output", None)),
+        (("plot", "points"), getattr(args, "points", None)),
+    ]
+    max_concurrency = getattr(args, "max_concurrency", None)
+    if max_concurrency is not None:
+        # More requests in flight than connections would only queue for
+        # one in httpx's pool, and time out there
+        http_config = get_config(config, "datasources", "circleci", "http", default={})
+        for key in ("max_connections", "max_keepalive_connections"):
+            if max_concurrency > http_config.get(key, 20):
+                overrides.append(
+                    (("datasources", "circleci", "http", key), max_concurrency)
+                )
+    if getattr(args, "no_incremental", False):
+        overrides.append((("fetch", "incremental"), False))
+    if getattr(args, "profile", False):
+        overrides.append((("profiling", "enabled"), True))
+    if getattr(args, "profile_memory", False):
+        overrides.append((("profiling", "trace_memory"), True))
+    for path, value in overrides:
+        if value is not None:
+            _set_config(config, *path, value=value)
+    return config
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+
+    config = apply_arguments(load_config(), args)
+    log_listener = configure_logger_from_config(logger, config)
+    configure_metrics(config)
+    profiler = get_profiler(config)
+
+    dbsession = get_dbsession()
+
+    project = get_project(dbsession, args.organization, args.project)
+
+    try:
+        if args.command in ("fetch", "all"):
+            with run_phase(profiler, "fetch"):
+                await collect_data(config, dbsession, project)
 
-    await collect_data(config, dbsession, project)
+        if args.command in ("process", "all"):
+            with run_phase(profiler, "process"):
+                process_data(config, dbsession, project, full=args.full)
 
-    process_data(config, dbsession, project)
+        # TODO: Actually save info in the DB
+        dbsession.commit()
 
-    # TODO: Actually save info in the DB
-    dbsession.commit()
+        if args.command in ("plot", "all"):
+            with run_phase(profiler, "plot"):
+                plot_data(config, dbsession, project)
 
-    logger.info("=> Project totals")
-    print(project.totals)
+        if args.command in ("process", "all"):
+            logger.info("=> Project totals")
+            print(project.totals)
+    finally:
+        profiler.stop()
+        summary = export_metrics(config)
+        if summary is not None:
+            logger.info(
+                "Exported metrics",
+                extra=dict(
+                    extra_log_attributes=dict(
+                        prometheus_path=get_config(
+                            config, "metrics", "prometheus_path"
+                        ),
+                        summary_path=get_config(config, "metrics", "summary_path"),
+                        duration=summary["duration"],
+                    )
+                ),
+            )
+        if log_listener is not None:
+            log_listener.stop()
 
 
 if __name__ == "__main__":
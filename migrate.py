@@ -1,12 +1,43 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
 import database.models as models
-from database.engine import engine
+from database.engine import engine as default_engine
+from database.maintenance import delete_duplicate_external_ids
 from database.models.base import Base
 
 
-def run_migrations() -> None:
+def _add_missing_columns(engine) -> None:
+    # create_all doesn't touch tables that already exist, so nullable
+    # columns added to existing models are added here
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}")
+                )
+
+
+def run_migrations(engine=default_engine) -> None:
     # TODO: Add a migration manager
     # Possibly https://alembic.sqlalchemy.org/en/latest/index.html
+    _add_missing_columns(engine)
     Base.metadata.create_all(engine)
+    # The unique indexes on external_id can't be created over duplicates
+    with engine.begin() as connection:
+        delete_duplicate_external_ids(connection)
+    # create_all skips tables that already exist, so indexes added
+    # to existing tables have to be created separately
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,24 @@
 import asyncio
 from collections import namedtuple
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from typing import Any, Awaitable, Callable, List, Optional
 
-from database.models import Job, Pipeline, Project, Workflow
+from sqlalchemy import update
+
+from config import get_config
+from database.models import Job, Pipeline, Project, SyncCursor, Workflow
+from database.upsert import upsert
+from services.fetch_data.buffer import WriteBehindBuffer
 from services.fetch_data.datasources import BaseDatasource, get_datasource_class
-from services.fetch_data.datasources.error import DatasourceNotFoundError
+from services.fetch_data.datasources.error import (
+    DatasourceNotFoundError,
+    DatasourceRequestError,
+)
+from services.fetch_data.datasources.filters import JobFilter
+from services.job_classifier import JobClassifier
 from utils.logging_config import LOGGER_NAME
+from utils.metrics import metrics
 
 UpdateFields = namedtuple("UpdateField", ["model_field", "raw_data_field"])
 
@@ -20,131 +33,243 @@ class FetchDataService(object):
             config = {}
         self.config = config
         self.dbsession = dbsession
+        # Ids of pipelines whose workflows were still running when synced
+        self._pending_pipeline_ids = set()
+        # While a project syncs, all database work runs in this single thread
+        # so that slow writes don't hold up the requests in flight
+        self._db_executor = None
+        # Also while a project syncs, rows are written in batches through these
+        self._write_buffers = None
+
+    async def _run_db(self, func: Callable[..., Any], *args) -> Any:
+        """Runs `func(*args)` in the database thread, if there is one.
+        The session is only ever used from one thread at a time."""
+        if self._db_executor is None:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._db_executor, func, *args)
 
     def _sync_model(
         self, raw_data: List[dict], model, datadriver, update_fields: List[UpdateFields]
     ):
-        all_ids = set(map(lambda item: item["id"], raw_data))
-        ids_in_db = set(
-            item[0]
-            for item in self.dbsession.query(model.external_id)
-            .filter(model.external_id.in_(all_ids))
-            .all()  # returns tuples
-        )
-        # Instert models we don't yet have
-        ids_to_insert = all_ids - ids_in_db
-        raw_data_to_insert = filter(lambda item: item["id"] in ids_to_insert, raw_data)
-        objects_to_insert = list(
-            map(
-                lambda item: datadriver.to_db_representation(item, model),
-                raw_data_to_insert,
+        """Upserts `raw_data` into `model`'s table in a single statement.
+        Returns the instances that were inserted or had any of `update_fields` changed"""
+        # If the same id shows up more than once the last one wins
+        rows = {item["id"]: datadriver.to_db_values(item, model) for item in raw_data}
+        if not rows:
+            return []
+        with metrics.timer("upsert_seconds", table=model.__tablename__):
+            synced = upsert(
+                self.dbsession,
+                model,
+                list(rows.values()),
+                index_elements=["external_id"],
+                update_columns=[field.model_field for field in update_fields],
             )
+        metrics.inc("rows_received_total", len(rows), table=model.__tablename__)
+        # Inserted, or with any of update_fields changed
+        metrics.inc("rows_written_total", len(synced), table=model.__tablename__)
+        return synced
+
+    def _sync_page(
+        self, raw_data: List[dict], model, datadriver, update_fields: List[UpdateFields]
+    ):
+        synced = self._sync_model(raw_data, model, datadriver, update_fields)
+        self._mark_metrics_dirty(model, synced)
+        with metrics.timer("db_flush_seconds", table=model.__tablename__):
+            self.dbsession.flush()
+        return synced
+
+    def _mark_metrics_dirty(self, model, synced: list):
+        """Workflows that were synced, or whose jobs were, need their metrics recalculated"""
+        if model is Workflow:
+            workflow_ids = {workflow.id for workflow in synced}
+        elif model is Job:
+            workflow_ids = {job.workflow_id for job in synced}
+        else:
+            return
+        if not workflow_ids:
+            return
+        self.dbsession.execute(
+            update(Workflow)
+            .where(Workflow.id.in_(workflow_ids), Workflow.metrics_dirty.is_(False))
+            .values(metrics_dirty=True)
+            .execution_options(synchronize_session=False)
         )
-        self.dbsession.add_all(objects_to_insert)
-        # Update models we do have
-        models_to_update = sorted(
-            self.dbsession.query(model).filter(model.external_id.in_(ids_in_db)).all(),
-            key=lambda item: item.external_id,
+
+    def _get_write_buffer_config(self) -> dict:
+        return dict(
+            batch_size=get_config(
+                self.config, "fetch", "write_buffer", "batch_size", default=500
+            ),
+            max_delay=get_config(
+                self.config, "fetch", "write_buffer", "max_delay", default=0.05
+            ),
         )
-        raw_data_to_update = sorted(
-            filter(lambda item: item["id"] in ids_in_db, raw_data),
-            key=lambda item: item["id"],
+
+    async def _write_page(
+        self, raw_data: List[dict], model, datadriver, update_fields: List[UpdateFields]
+    ):
+        """Syncs a page of `raw_data`, through the model's write buffer if there is one.
+        Returns the instances that were inserted or updated"""
+        if self._write_buffers is None:
+            return await self._run_db(
+                self._sync_page, raw_data, model, datadriver, update_fields
+            )
+        buffer = self._write_buffers.get(model)
+        if buffer is None:
+            buffer = WriteBehindBuffer(
+                lambda rows: self._run_db(
+                    self._sync_page, rows, model, datadriver, update_fields
+                ),
+                **self._get_write_buffer_config(),
+            )
+            self._write_buffers[model] = buffer
+        return await buffer.add(raw_data)
+
+    def _get_job_filter(self, job_classifier: JobClassifier) -> JobFilter:
+        """We don't need to save all jobs, only the ones that interest us"""
+        started_after = get_config(self.config, "fetch", "job_filter", "started_after")
+        if isinstance(started_after, str):
+            started_after = datetime.fromisoformat(started_after)
+        elif isinstance(started_after, date) and not isinstance(
+            started_after, datetime
+        ):
+            # YAML parses unquoted dates
+            started_after = datetime(
+                started_after.year, started_after.month, started_after.day
+            )
+        return JobFilter(
+            name_predicate=job_classifier.matches,
+            statuses=get_config(self.config, "fetch", "job_filter", "statuses"),
+            started_after=started_after,
         )
-        data_pack = zip(models_to_update, raw_data_to_update)
-        updated_objects = []
-        for pair in data_pack:
-            instance, raw_data = pair
-            updated = False
-            for field in update_fields:
-                # We need to annotate what models actually changed
-                if (
-                    getattr(instance, field.model_field)
-                    != raw_data[field.raw_data_field]
-                ):
-                    updated = True
-                    setattr(instance, field.model_field, raw_data[field.raw_data_field])
-            if updated:
-                updated_objects.append(instance)
-        return objects_to_insert + updated_objects
 
-    async def sync_pipelines(self, project: Project, datasource):
-        all_synced_pipelines = []
+    def _get_job_classifier(self, project: Project) -> JobClassifier:
+        return JobClassifier.for_project(project)
+
+    async def iter_synced_pipelines(
+        self, project: Project, datasource, since_number: int = None
+    ):
+        """Syncs the project's pipelines page by page,
+        yielding the pipelines of each page that were inserted or updated"""
+        synced_count = 0
         fields_to_update = [UpdateFields("status", "state")]
-        async for pipelines in datasource.get_all_project_pipelines(project):
-            synced_pipelines = self._sync_model(
-                pipelines, Pipeline, datasource.data_driver, fields_to_update
+        async for pipelines in datasource.get_all_project_pipelines(
+            project, since_number=since_number
+        ):
+            synced_pipelines = await self._write_page(
+                pipelines,
+                Pipeline,
+                datasource.data_driver,
+                fields_to_update,
             )
-            self.dbsession.flush()
-            all_synced_pipelines.extend(synced_pipelines)
+            synced_count += len(synced_pipelines)
+            yield synced_pipelines
         logger.info(
             f"Synced all pipelines",
             extra=dict(
                 extra_log_attributes=dict(
-                    project=project.id, pipeline_count=len(all_synced_pipelines)
+                    project=project.id, pipeline_count=synced_count
                 )
             ),
         )
+
+    async def sync_pipelines(self, project: Project, datasource):
+        all_synced_pipelines = []
+        async for synced_pipelines in self.iter_synced_pipelines(project, datasource):
+            all_synced_pipelines.extend(synced_pipelines)
         return all_synced_pipelines
 
-    async def sync_workflows(self, pipeline: Pipeline, datasource):
-        all_synced_workflows = []
+    async def iter_synced_workflows(self, pipeline: Pipeline, datasource):
+        """Syncs the pipeline's workflows page by page,
+        yielding the workflows of each page that were inserted or updated"""
+        synced_count = 0
         fields_to_update = [
             UpdateFields("status", "status"),
             UpdateFields("stopped_at", "stopped_at"),
         ]
-        async for workflows in datasource.get_pipeline_workflows(pipeline):
-            synced_workflows = self._sync_model(
-                workflows, Workflow, datasource.data_driver, fields_to_update
+        data_driver = datasource.data_driver
+        is_pending = not data_driver.is_pipeline_finished(pipeline)
+        async for workflows in datasource.get_pipeline_workflows(
+            pipeline, include_unfinished=True
+        ):
+            finished_workflows = list(
+                filter(data_driver.is_workflow_finished, workflows)
             )
-            self.dbsession.flush()
-            all_synced_workflows.extend(synced_workflows)
+            # Unfinished workflows are not saved. We come back for them next sync
+            is_pending = is_pending or len(finished_workflows) < len(workflows)
+            workflows = finished_workflows
+            synced_workflows = await self._write_page(
+                workflows,
+                Workflow,
+                datasource.data_driver,
+                fields_to_update,
+            )
+            synced_count += len(synced_workflows)
+            yield synced_workflows
+        if is_pending:
+            self._pending_pipeline_ids.add(pipeline.id)
         logger.info(
             f"Synced all workflows",
             extra=dict(
+                # One per pipeline / workflow
+                sampled=True,
                 extra_log_attributes=dict(
-                    pipeline=pipeline.id, workflow_count=len(all_synced_workflows)
-                )
+                    pipeline=pipeline.id, workflow_count=synced_count
+                ),
             ),
         )
+
+    async def sync_workflows(self, pipeline: Pipeline, datasource):
+        all_synced_workflows = []
+        async for synced_workflows in self.iter_synced_workflows(pipeline, datasource):
+            all_synced_workflows.extend(synced_workflows)
         return all_synced_workflows
 
-    async def sync_jobs(self, workflow: Workflow, datasource):
+    async def sync_jobs(
+        self,
+        workflow: Workflow,
+        datasource,
+        job_classifier: Optional[JobClassifier] = None,
+        job_filter: Optional[JobFilter] = None,
+    ):
+        """Syncs the workflow's label analysis and regular tests jobs,
+        as told by `job_classifier` (by default the project's).
+        `job_filter` defaults to one built from `job_classifier`"""
         all_synced_jobs = []
         fields_to_update = [
             UpdateFields("status", "status"),
             UpdateFields("stopped_at", "stopped_at"),
+            UpdateFields("kind", "kind"),
         ]
-        async for jobs_data in datasource.get_workflow_jobs(workflow):
-            # We don't need to save all jobs, only the ones that interest us
-            standarized_data = list(
-                map(
-                    lambda item: datasource.data_driver.to_db_representation(item, Job),
-                    jobs_data,
-                )
+        if job_classifier is None:
+            # Getting the project goes through the workflow's pipeline
+            job_classifier = await self._run_db(
+                lambda: self._get_job_classifier(workflow.pipeline.project)
             )
-            pairs = zip(jobs_data, standarized_data)
-            jobs_of_interest = []
-            for raw_data, parsed_data in pairs:
-                if parsed_data.name in [
-                    workflow.label_analysis_job_name,
-                    workflow.regular_tests_job_name,
-                ]:
-                    jobs_of_interest.append(raw_data)
-
-            synced_jobs = self._sync_model(
-                jobs_of_interest, Job, datasource.data_driver, fields_to_update
+        if job_filter is None:
+            job_filter = self._get_job_filter(job_classifier)
+        async for jobs_data in datasource.get_workflow_jobs(
+            workflow, job_filter=job_filter
+        ):
+            for item in jobs_data:
+                item["kind"] = job_classifier.classify(item["name"])
+            synced_jobs = await self._write_page(
+                jobs_data, Job, datasource.data_driver, fields_to_update
             )
-            self.dbsession.flush()
             all_synced_jobs.extend(synced_jobs)
         logger.info(
             f"Synced all jobs",
             extra=dict(
+                # One per pipeline / workflow
+                sampled=True,
                 extra_log_attributes=dict(
                     workflow=workflow.id, job_count=len(all_synced_jobs)
-                )
+                ),
             ),
         )
-        return synced_jobs
+        return all_synced_jobs
 
     async def sync_project(self, project: Project):
         datasource_class = get_datasource_class(project.ci_provider)
@@ -152,25 +277,188 @@ class FetchDataService(object):
             raise DatasourceNotFoundError(f"Missing DataSource {datasource_class}")
         datasource: BaseDatasource = datasource_class(self.config)
 
-        # Sync pipelines
-        synced_pipelines = await self.sync_pipelines(
-            project=project, datasource=datasource
-        )
-        # Sync workflows
-        all_synced_workflows = await asyncio.gather(
-            *[
-                asyncio.create_task(
-                    self.sync_workflows(pipeline=pipeline, datasource=datasource)
+        if get_config(self.config, "fetch", "db_writer_thread", default=True):
+            self._db_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="db-writer"
+            )
+        self._write_buffers = {}
+        try:
+            # The datasource keeps a connection pool open for the whole sync
+            async with datasource:
+                await self._stream_project(project, datasource)
+        finally:
+            write_buffers = self._write_buffers
+            self._write_buffers = None
+            for buffer in write_buffers.values():
+                await buffer.close()
+            if self._db_executor is not None:
+                self._db_executor.shutdown(wait=True)
+                self._db_executor = None
+        logger.info(
+            "Synced project",
+            extra=dict(
+                extra_log_attributes=dict(
+                    project=project.id,
+                    datasource_stats=datasource.get_stats(),
+                    write_buffer=dict(
+                        **self._get_write_buffer_config(),
+                        **{
+                            model.__tablename__: buffer.stats.as_dict()
+                            for model, buffer in write_buffers.items()
+                        },
+                    ),
                 )
-                for pipeline in synced_pipelines
-            ]
+            ),
+        )
+
+    async def _stream_project(self, project: Project, datasource):
+        # Pipelines -> workflows -> jobs are synced as a streaming pipeline.
+        # Each synced pipeline is immediately handed to the workflow workers
+        # and each synced workflow to the job workers, so requests at all levels overlap.
+        # The queues are bounded so that a fast stage can't get too far ahead.
+        queue_size = get_config(self.config, "fetch", "queue_size", default=100)
+        workflow_workers = get_config(
+            self.config, "fetch", "workflow_workers", default=10
         )
-        for synced_workflows in all_synced_workflows:
-            # For some reason this will return a list of lists
-            # Sync Jobs
-            await asyncio.gather(
-                *[
-                    asyncio.create_task(self.sync_jobs(workflow, datasource))
-                    for workflow in synced_workflows
-                ]
+        job_workers = get_config(self.config, "fetch", "job_workers", default=20)
+        pipeline_queue = asyncio.Queue(maxsize=queue_size)
+        workflow_queue = asyncio.Queue(maxsize=queue_size)
+
+        # Incremental sync: only list pipelines newer than the ones we've seen.
+        # The ones that were still running last time are synced again either way:
+        # listing them doesn't tell if their workflows changed.
+        cursor = await self._run_db(self._get_sync_cursor, project)
+        since_number = None
+        if get_config(self.config, "fetch", "incremental", default=True):
+            since_number = cursor.last_pipeline_number
+        pending_pipelines = []
+        if cursor.pending_pipeline_ids:
+            pending_pipelines = await self._run_db(
+                self._get_pipelines, cursor.pending_pipeline_ids
             )
+        self._pending_pipeline_ids = set()
+        # All the project's workflows are after the same jobs
+        job_classifier = await self._run_db(self._get_job_classifier, project)
+        job_filter = self._get_job_filter(job_classifier)
+
+        async def produce_pipelines():
+            enqueued_ids = set()
+            async for pipelines in self.iter_synced_pipelines(
+                project, datasource, since_number=since_number
+            ):
+                for pipeline in pipelines:
+                    enqueued_ids.add(pipeline.id)
+                    await pipeline_queue.put(pipeline)
+            for pipeline in pending_pipelines:
+                if pipeline.id not in enqueued_ids:
+                    await pipeline_queue.put(pipeline)
+
+        async def consume_pipelines():
+            while (pipeline := await pipeline_queue.get()) is not None:
+                try:
+                    async for workflows in self.iter_synced_workflows(
+                        pipeline, datasource
+                    ):
+                        for workflow in workflows:
+                            await workflow_queue.put(workflow)
+                except DatasourceRequestError as exp:
+                    # Rate limits, server and network errors affect every request
+                    if exp.status_code in (None, 429) or exp.status_code >= 500:
+                        raise
+                    # Only this pipeline can't be synced. It's tried again next time
+                    self._pending_pipeline_ids.add(pipeline.id)
+                    logger.warning(
+                        "Skipped pipeline",
+                        extra=dict(
+                            extra_log_attributes=dict(
+                                pipeline=pipeline.id,
+                                status_code=exp.status_code,
+                                error=str(exp),
+                            )
+                        ),
+                    )
+
+        async def consume_workflows():
+            while (workflow := await workflow_queue.get()) is not None:
+                await self.sync_jobs(
+                    workflow,
+                    datasource,
+                    job_classifier=job_classifier,
+                    job_filter=job_filter,
+                )
+
+        stages = [
+            _run_stage(produce_pipelines, 1, pipeline_queue, workflow_workers),
+            _run_stage(
+                consume_pipelines, workflow_workers, workflow_queue, job_workers
+            ),
+            _run_stage(consume_workflows, job_workers),
+        ]
+        tasks = [asyncio.create_task(stage) for stage in stages]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Otherwise the other stages would be left blocked on their queues
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        # Every page waits for its rows to be written, so this is a no-op for now.
+        # It makes sure nothing is left behind if that changes.
+        for buffer in self._write_buffers.values():
+            await buffer.drain()
+        await self._run_db(self._update_sync_cursor, project, cursor)
+
+    def _get_pipelines(self, pipeline_ids: List[int]) -> List[Pipeline]:
+        return (
+            self.dbsession.query(Pipeline).filter(Pipeline.id.in_(pipeline_ids)).all()
+        )
+
+    def _get_sync_cursor(self, project: Project) -> SyncCursor:
+        cursor = (
+            self.dbsession.query(SyncCursor)
+            .filter(SyncCursor.project_id == project.id)
+            .first()
+        )
+        if cursor is None:
+            cursor = SyncCursor(project_id=project.id, pending_pipeline_ids=[])
+            self.dbsession.add(cursor)
+        return cursor
+
+    def _update_sync_cursor(self, project: Project, cursor: SyncCursor):
+        newest_pipeline = (
+            self.dbsession.query(Pipeline)
+            .filter(Pipeline.project_id == project.id)
+            .order_by(Pipeline.number.desc())
+            .first()
+        )
+        if newest_pipeline is not None:
+            cursor.last_pipeline_number = newest_pipeline.number
+            cursor.last_pipeline_created_at = newest_pipeline.created_at
+        cursor.pending_pipeline_ids = sorted(self._pending_pipeline_ids)
+        cursor.updated_at = datetime.now()
+        self.dbsession.flush()
+        logger.info(
+            "Updated sync cursor",
+            extra=dict(
+                extra_log_attributes=dict(
+                    project=project.id,
+                    last_pipeline_number=cursor.last_pipeline_number,
+                    pending_pipeline_count=len(cursor.pending_pipeline_ids),
+                )
+            ),
+        )
+
+
+async def _run_stage(
+    worker: Callable[[], Awaitable[None]],
+    worker_count: int,
+    output_queue: asyncio.Queue = None,
+    output_worker_count: int = 0,
+):
+    """Runs `worker_count` copies of `worker` until they're all done,
+    then signals each of the workers of the next stage to stop"""
+    await asyncio.gather(*[worker() for _ in range(worker_count)])
+    if output_queue is not None:
+        for _ in range(output_worker_count):
+            await output_queue.put(None)
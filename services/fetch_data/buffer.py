@@ -0,0 +1,128 @@
+import asyncio
+from operator import attrgetter, itemgetter
+from typing import Any, Awaitable, Callable, List, Optional
+
+
+class WriteBufferStats(object):
+    def __init__(self) -> None:
+        self.rows = 0
+        self.flushes = 0
+        self.size_flushes = 0
+        self.timer_flushes = 0
+        self.drain_flushes = 0
+        self.max_batch_rows = 0
+
+    def record_flush(self, reason: str, row_count: int) -> None:
+        self.rows += row_count
+        self.flushes += 1
+        setattr(self, f"{reason}_flushes", getattr(self, f"{reason}_flushes") + 1)
+        self.max_batch_rows = max(self.max_batch_rows, row_count)
+
+    def as_dict(self) -> dict:
+        return dict(
+            rows=self.rows,
+            flushes=self.flushes,
+            size_flushes=self.size_flushes,
+            timer_flushes=self.timer_flushes,
+            drain_flushes=self.drain_flushes,
+            max_batch_rows=self.max_batch_rows,
+        )
+
+
+class WriteBehindBuffer(object):
+    """Accumulates rows to be written to a table and writes them in batches.
+
+    A batch is written when it reaches `batch_size` rows, when its oldest row
+    has waited `max_delay` seconds, or when the buffer is drained.
+    `add` returns a future that resolves, once its rows are written, to the
+    results of `flush_func` for those rows; results are matched to rows
+    through `row_key` / `result_key`.
+    """
+
+    def __init__(
+        self,
+        flush_func: Callable[[List[dict]], Awaitable[List[Any]]],
+        batch_size: int = 500,
+        max_delay: float = 0.05,
+        row_key: Callable[[dict], Any] = itemgetter("id"),
+        result_key: Callable[[Any], Any] = attrgetter("external_id"),
+    ) -> None:
+        self._flush_func = flush_func
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._row_key = row_key
+        self._result_key = result_key
+        self._rows: List[dict] = []
+        self._waiters: List[tuple] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks = set()
+        self.stats = WriteBufferStats()
+
+    def add(self, rows: List[dict]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not rows:
+            future.set_result([])
+            return future
+        self._rows.extend(rows)
+        keys = list(dict.fromkeys(self._row_key(row) for row in rows))
+        self._waiters.append((future, keys))
+        if len(self._rows) >= self.batch_size:
+            self._start_flush("size")
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush, "timer")
+        return future
+
+    async def drain(self) -> None:
+        """Writes whatever is buffered and waits for all pending writes"""
+        self._start_flush("drain")
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    async def close(self) -> None:
+        """Drops the buffered rows and cancels the writes in progress,
+        cancelling the futures of their rows. `drain` first to keep them."""
+        self._cancel_timer()
+        for future, _ in self._waiters:
+            future.cancel()
+        self._rows, self._waiters = [], []
+        for task in self._flush_tasks:
+            task.cancel()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _start_flush(self, reason: str) -> None:
+        self._cancel_timer()
+        rows, waiters = self._rows, self._waiters
+        self._rows, self._waiters = [], []
+        if not rows:
+            return
+        task = asyncio.ensure_future(self._flush(rows, waiters, reason))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, rows: List[dict], waiters: List[tuple], reason: str):
+        try:
+            results = await self._flush_func(rows)
+        except asyncio.CancelledError:
+            for future, _ in waiters:
+                future.cancel()
+            raise
+        except Exception as exc:
+            # The error is raised to whoever is waiting for these rows
+            for future, _ in waiters:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        self.stats.record_flush(reason, len(rows))
+        results_by_key = {self._result_key(result): result for result in results}
+        for future, keys in waiters:
+            if not future.done():
+                future.set_result(
+                    [results_by_key[key] for key in keys if key in results_by_key]
+                )
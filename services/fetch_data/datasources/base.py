@@ -8,3 +8,17 @@ class BaseDatasource(object):
         if config is None:
             config = {}
         config = config
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Releases any resources (e.g. network connections) held by the datasource"""
+        pass
+
+    def get_stats(self) -> dict:
+        """Returns request metrics collected by the datasource"""
+        return {}
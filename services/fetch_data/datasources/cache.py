@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import zlib
+from typing import Dict, Optional
+
+from config import get_config
+
+
+class CachedResponse(object):
+    def __init__(
+        self,
+        body: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        immutable: bool = False,
+    ) -> None:
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.immutable = immutable
+
+    def json(self):
+        return json.loads(self.body)
+
+    def get_conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class CacheStats(object):
+    """
+    hits: Responses served from the cache without touching the network
+    revalidated: Responses served from the cache after a 304 Not Modified
+    misses: Responses that were not in the cache
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.stored_bytes = 0
+
+    def as_dict(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            revalidated=self.revalidated,
+            stored=self.stored,
+            stored_bytes=self.stored_bytes,
+        )
+
+
+class ResponseCache(object):
+    """On-disk cache of raw response bodies, stored compressed.
+
+    Modes:
+        revalidate: Entries are served as long as the server confirms they didn't
+            change (conditional requests). Immutable entries are served directly.
+        replay: Everything is served from the cache. The network is never used.
+    """
+
+    REVALIDATE = "revalidate"
+    REPLAY = "replay"
+
+    def __init__(self, directory: str, mode: str = REVALIDATE) -> None:
+        if mode not in (self.REVALIDATE, self.REPLAY):
+            raise ValueError(f"Unknown cache mode {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.stats = CacheStats()
+
+    @classmethod
+    def from_config(cls, cache_config: dict) -> Optional["ResponseCache"]:
+        mode = get_config(cache_config, "mode", default="off")
+        # YAML reads an unquoted `off` as False
+        if mode in ("off", False, None):
+            return None
+        return cls(
+            directory=get_config(cache_config, "directory", default=".http_cache"),
+            mode=mode,
+        )
+
+    @property
+    def is_replay(self) -> bool:
+        return self.mode == self.REPLAY
+
+    def get_key(self, method: str, url: str, params: dict = None) -> str:
+        params = {
+            name: value for name, value in (params or {}).items() if value is not None
+        }
+        raw_key = json.dumps([method.upper(), url, params], sort_keys=True)
+        return hashlib.sha256(raw_key.encode()).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.z")
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        try:
+            with open(self._get_path(key), "rb") as fd:
+                data = zlib.decompress(fd.read())
+        except FileNotFoundError:
+            return None
+        header, _, body = data.partition(b"\n")
+        metadata = json.loads(header)
+        return CachedResponse(body=body, **metadata)
+
+    async def aget(self, key: str) -> Optional[CachedResponse]:
+        """`get` in a thread, so that reading and decompressing don't block the loop"""
+        return await asyncio.to_thread(self.get, key)
+
+    def _write(self, key: str, entry: CachedResponse) -> int:
+        metadata = dict(
+            etag=entry.etag,
+            last_modified=entry.last_modified,
+            immutable=entry.immutable,
+        )
+        data = zlib.compress(json.dumps(metadata).encode() + b"\n" + entry.body)
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so that readers never see half written entries
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fd:
+            fd.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    def _record_stored(self, size: int) -> None:
+        self.stats.stored += 1
+        self.stats.stored_bytes += size
+
+    def set(self, key: str, entry: CachedResponse) -> None:
+        self._record_stored(self._write(key, entry))
+
+    async def aset(self, key: str, entry: CachedResponse) -> None:
+        """`set` in a thread, so that compressing and writing don't block the loop"""
+        # Stats are only updated from the loop's thread
+        self._record_stored(await asyncio.to_thread(self._write, key, entry))
@@ -1,6 +1,7 @@
+import asyncio
 import logging
 from datetime import datetime
-from typing import Dict
+from typing import Callable, Dict, Optional
 
 import httpx
 
@@ -8,8 +9,21 @@ from config import get_config
 from database.models import Job, Pipeline, Workflow
 from database.models.project import Project
 from services.fetch_data.datasources.base import BaseDatasource
-from services.fetch_data.datasources.error import DatasourceConfigError
+from services.fetch_data.datasources.cache import CachedResponse, ResponseCache
+from services.fetch_data.datasources.error import (
+    DatasourceConfigError,
+    DatasourceRequestError,
+    DatasourceUnavailableError,
+)
+from services.fetch_data.datasources.filters import JobFilter
+from services.fetch_data.datasources.retry import (
+    CircuitBreaker,
+    RetryPolicy,
+    RetryStats,
+)
+from services.fetch_data.datasources.scheduler import RequestScheduler
 from utils.logging_config import LOGGER_NAME
+from utils.metrics import COUNT_BUCKETS, metrics
 
 logger = logging.getLogger(LOGGER_NAME)
 
@@ -25,88 +39,325 @@ class CircleCIDatasource(BaseDatasource):
 
     def __init__(self, config: Dict):
         self.api_token = get_config(config, "datasources", "circleci", "api_token")
+        self.base_url = get_config(
+            config, "datasources", "circleci", "base_url", default=self.BASE_URL
+        )
+        self.http_config = get_config(
+            config, "datasources", "circleci", "http", default={}
+        )
+        self.scheduler = RequestScheduler.from_config(
+            get_config(config, "datasources", "circleci", "scheduler", default={})
+        )
+        self.retry_policy = RetryPolicy.from_config(
+            get_config(config, "datasources", "circleci", "retry", default={})
+        )
+        self.circuit_breaker_config = get_config(
+            config, "datasources", "circleci", "circuit_breaker", default={}
+        )
+        self.retry_stats = RetryStats()
+        self._circuit_breakers: Dict[str, CircuitBreaker] = {}
+        self.cache = ResponseCache.from_config(
+            get_config(config, "datasources", "circleci", "cache", default={})
+        )
         self._data_driver = CircleCIDataDriver()
+        self._client: Optional[httpx.AsyncClient] = None
 
         if self.api_token is None:
             raise DatasourceConfigError("Missing API TOKEN")
 
         super().__init__()
 
+    async def __aenter__(self):
+        self._get_client()
+        return self
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # A single client is shared by all requests so that connections
+        # (and their TCP + TLS handshakes) are reused across pages.
+        if self._client is None:
+            limits = httpx.Limits(
+                max_connections=self.http_config.get("max_connections", 20),
+                max_keepalive_connections=self.http_config.get(
+                    "max_keepalive_connections", 20
+                ),
+                keepalive_expiry=self.http_config.get("keepalive_expiry", 30.0),
+            )
+            try:
+                self._client = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    limits=limits,
+                    timeout=self.http_config.get("timeout", 30.0),
+                    http2=self.http_config.get("http2", False),
+                )
+            except ImportError as exp:
+                # http2 requires the optional `h2` package (`pip install httpx[http2]`)
+                raise DatasourceConfigError(str(exp)) from exp
+        return self._client
+
+    def get_stats(self) -> dict:
+        return dict(
+            scheduler=self.scheduler.get_stats(),
+            retries=self.retry_stats.as_dict(),
+            circuit_breakers={
+                host: dict(
+                    state=circuit_breaker.state,
+                    times_opened=circuit_breaker.times_opened,
+                )
+                for host, circuit_breaker in self._circuit_breakers.items()
+            },
+            cache=self.cache.stats.as_dict() if self.cache is not None else None,
+        )
+
     # TODO: Create generator function that yields the pages when there are multiple pages
     async def _paginated_requests(
-        self, method: str, url: str, headers: dict = None, params: dict = None
+        self,
+        method: str,
+        url: str,
+        headers: dict = None,
+        params: dict = None,
+        endpoint: str = "default",
+        is_immutable: Callable[[dict], bool] = None,
     ):
         if params is None:
             params = {}
         next_page = True
-        while next_page:
-            response = await self._execute_request(method, url, headers, params)
-            yield response
-            next_page_token = response.get("next_page_token", None)
-            params["page-token"] = next_page_token
-            next_page = next_page_token is not None
+        pages = 0
+        try:
+            while next_page:
+                response = await self._execute_request(
+                    method,
+                    url,
+                    headers,
+                    params,
+                    endpoint=endpoint,
+                    is_immutable=is_immutable,
+                )
+                pages += 1
+                yield response
+                next_page_token = response.get("next_page_token", None)
+                params["page-token"] = next_page_token
+                next_page = next_page_token is not None
+        finally:
+            metrics.observe(
+                "pages_per_call", pages, buckets=COUNT_BUCKETS, endpoint=endpoint
+            )
 
     async def _execute_request(
-        self, method: str, url: str, headers: dict = None, params: dict = None
+        self,
+        method: str,
+        url: str,
+        headers: dict = None,
+        params: dict = None,
+        endpoint: str = "default",
+        is_immutable: Callable[[dict], bool] = None,
     ):
+        """Sends the request, retrying it if needed, and returns the decoded body.
+
+        If the response cache is enabled, GET responses are cached.
+        `is_immutable(body)` tells if a response will never change,
+        in which case it's never requested again.
+        """
         if headers is None:
             headers = {}
+        cache_key = None
+        cached_response = None
+        if self.cache is not None and method.upper() == "GET":
+            cache_key = self.cache.get_key(method, url, params)
+            cached_response = await self.cache.aget(cache_key)
+            # Entries stored as immutable are only trusted if the caller still
+            # thinks these responses can be (workflows pages used to be)
+            immutable = (
+                cached_response is not None
+                and cached_response.immutable
+                and is_immutable is not None
+            )
+            if cached_response is not None and (immutable or self.cache.is_replay):
+                self.cache.stats.hits += 1
+                return cached_response.json()
+            self.cache.stats.misses += cached_response is None
+            if self.cache.is_replay:
+                raise DatasourceRequestError(f"{url} is not cached (replay mode)")
+            if cached_response is not None:
+                headers = {**headers, **cached_response.get_conditional_headers()}
         headers = {**headers, "Circle-Token": self.api_token}
-        async with httpx.AsyncClient(base_url=self.BASE_URL) as client:
-            response = await client.request(method, url, headers=headers, params=params)
-            if response.status_code >= 300:
-                logger.warning(
-                    "Response with code >= 300",
-                    extra=dict(extra_log_attributes=dict(response=response.text)),
+        client = self._get_client()
+        host = client.base_url.join(url).host
+        circuit_breaker = self._circuit_breakers.setdefault(
+            host, CircuitBreaker(**self.circuit_breaker_config)
+        )
+        attempt = 0
+        while True:
+            if not circuit_breaker.allow_request():
+                self.retry_stats.rejected_by_circuit_breaker += 1
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.failed_requests += 1
+                    raise DatasourceUnavailableError(f"Circuit breaker open for {host}")
+                # Waits for the circuit to half open, or for someone
+                # else's trial request to tell if the host is back
+                reason = "circuit_open"
+                delay = (
+                    circuit_breaker.seconds_until_half_open()
+                    or self.retry_policy.get_delay(attempt)
+                )
+                await self._wait_to_retry(url, reason, attempt, delay)
+                attempt += 1
+                continue
+            try:
+                async with self.scheduler.slot(endpoint):
+                    # Time in the scheduler's queue isn't counted
+                    with metrics.timer("http_request_seconds", endpoint=endpoint):
+                        response = await client.request(
+                            method, url, headers=headers, params=params
+                        )
+            except httpx.TransportError as exp:
+                metrics.inc(
+                    "http_requests_total", endpoint=endpoint, status=type(exp).__name__
+                )
+                circuit_breaker.record_failure()
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.failed_requests += 1
+                    raise DatasourceRequestError(
+                        f"Request to {url} failed: {exp!r}"
+                    ) from exp
+                reason = type(exp).__name__
+                delay = self.retry_policy.get_delay(attempt)
+            else:
+                metrics.inc(
+                    "http_requests_total",
+                    endpoint=endpoint,
+                    status=response.status_code,
                 )
-            return response.json()
-        # TODO: Handle errors and such
+                if response.status_code == 304 and cached_response is not None:
+                    circuit_breaker.record_success()
+                    self.cache.stats.revalidated += 1
+                    return cached_response.json()
+                if response.status_code < 300:
+                    circuit_breaker.record_success()
+                    data = response.json()
+                    if cache_key is not None:
+                        await self.cache.aset(
+                            cache_key,
+                            CachedResponse(
+                                body=response.content,
+                                etag=response.headers.get("ETag"),
+                                last_modified=response.headers.get("Last-Modified"),
+                                immutable=is_immutable is not None
+                                and is_immutable(data),
+                            ),
+                        )
+                    return data
+                if response.status_code >= 500:
+                    circuit_breaker.record_failure()
+                else:
+                    # The host answered, whatever it thinks of the request
+                    circuit_breaker.record_success()
+                if (
+                    not self.retry_policy.is_retryable(response.status_code)
+                    or attempt >= self.retry_policy.max_retries
+                ):
+                    self.retry_stats.failed_requests += 1
+                    logger.warning(
+                        "Response with code >= 300",
+                        extra=dict(
+                            extra_log_attributes=dict(
+                                url=url,
+                                status_code=response.status_code,
+                                attempts=attempt + 1,
+                                response=response.text,
+                            )
+                        ),
+                    )
+                    raise DatasourceRequestError(
+                        f"Request to {url} failed with {response.status_code}",
+                        status_code=response.status_code,
+                    )
+                reason = str(response.status_code)
+                delay = self.retry_policy.get_delay(attempt, response)
+                if response.status_code == 429:
+                    # Everyone backs off, not only this request
+                    self.scheduler.pause(delay)
+            await self._wait_to_retry(url, reason, attempt, delay)
+            attempt += 1
 
-    async def get_all_project_pipelines(self, project: Project):
+    async def _wait_to_retry(
+        self, url: str, reason: str, attempt: int, delay: float
+    ) -> None:
+        self.retry_stats.record_retry(reason, delay)
+        logger.info(
+            "Retrying request",
+            extra=dict(
+                extra_log_attributes=dict(
+                    url=url, reason=reason, attempt=attempt + 1, delay=delay
+                )
+            ),
+        )
+        await asyncio.sleep(delay)
+
+    async def get_all_project_pipelines(
+        self, project: Project, since_number: Optional[int] = None
+    ):
         # Get a list of all project's pipelines
         # https://circleci.com/docs/api/v2/index.html#operation/listPipelinesForProject
-        # TODO: Handle the multiple pages
+        # Pipelines are listed newest first. If `since_number` is given we stop
+        # paginating once we reach pipelines with numbers <= since_number
         url = f"/project/{self.data_driver.get_project_slug(project)}/pipeline"
 
-        async for page in self._paginated_requests("GET", url):
+        async for page in self._paginated_requests("GET", url, endpoint="pipelines"):
             # Extend raw data with `project` key
             items = page.get("items", [])
+            reached_synced_pipelines = False
+            if since_number is not None:
+                new_items = [
+                    item for item in items if int(item["number"]) > since_number
+                ]
+                reached_synced_pipelines = len(new_items) < len(items)
+                items = new_items
             extended_items = [{**item, "project": project} for item in items]
             yield extended_items
+            if reached_synced_pipelines:
+                break
 
-    async def get_pipeline_workflows(self, pipeline: Pipeline):
+    async def get_pipeline_workflows(
+        self, pipeline: Pipeline, include_unfinished: bool = False
+    ):
         # Get pipeline's workflows
         # https://circleci.com/docs/api/v2/index.html#operation/listWorkflowsByPipelineId
-        # TODO: Handle the multiple pages. Hopefully turning this into a generator function
+        # Workflows that didn't finish yet are skipped unless `include_unfinished`
 
         url = f"/pipeline/{pipeline.external_id}/workflow"
 
-        async for page in self._paginated_requests("GET", url):
+        # Never immutable: rerunning a workflow adds a new one to the pipeline
+        async for page in self._paginated_requests("GET", url, endpoint="workflows"):
             items = page.get("items", [])
-            items = filter(
-                lambda item: item["created_at"] is not None
-                and item["stopped_at"] is not None,
-                items,
-            )
+            if not include_unfinished:
+                items = filter(self.data_driver.is_workflow_finished, items)
             # Include the key `pipeline` in the data
             extended_items = [{**item, "pipeline": pipeline} for item in items]
             yield extended_items
 
-    async def get_workflow_jobs(self, workflow: Workflow):
+    async def get_workflow_jobs(
+        self, workflow: Workflow, job_filter: Optional[JobFilter] = None
+    ):
         # Get a workflow's jobs
         # https://circleci.com/docs/api/v2/index.html#operation/listWorkflowJobs
-        # TODO: Handle the multiple pages
+        # Jobs are filtered on their raw payload, before anything is built out of them
+        if job_filter is None:
+            job_filter = JobFilter()
 
         url = f"/workflow/{workflow.external_id}/job"
 
-        async for page in self._paginated_requests("GET", url):
-            items = page.get("items", [])
-            # Filter jobs that don't have a started_at date
-            items = filter(
-                lambda item: item["started_at"] is not None
-                and item["stopped_at"] is not None,
-                items,
-            )
+        async for page in self._paginated_requests(
+            "GET",
+            url,
+            endpoint="jobs",
+            is_immutable=self.data_driver.is_jobs_page_final,
+        ):
+            items = job_filter.filter(page.get("items", []))
             # Extend raw data with `workflow` key
             extended_items = [{**item, "workflow": workflow} for item in items]
             yield extended_items
@@ -115,42 +366,89 @@ class CircleCIDatasource(BaseDatasource):
 class CircleCIDataDriver(object):
     """This class translates CircleCI API data to internal representations"""
 
+    # https://circleci.com/docs/api/v2/index.html#operation/getPipelineById
+    FINISHED_PIPELINE_STATES = ("created", "errored")
+    # https://circleci.com/docs/api/v2/index.html#operation/listWorkflowJobs
+    FINISHED_JOB_STATUSES = (
+        "success",
+        "failed",
+        "canceled",
+        "not_run",
+        "infrastructure_fail",
+        "timedout",
+        "unauthorized",
+        "terminated-unknown",
+    )
+
+    def is_workflow_finished(self, circleci_data: dict) -> bool:
+        return (
+            circleci_data["created_at"] is not None
+            and circleci_data["stopped_at"] is not None
+        )
+
+    def is_jobs_page_final(self, page: dict) -> bool:
+        """A page of jobs won't change once all its jobs finished"""
+        items = page.get("items", [])
+        return len(items) > 0 and all(
+            item["status"] in self.FINISHED_JOB_STATUSES for item in items
+        )
+
+    def is_pipeline_finished(self, pipeline: Pipeline) -> bool:
+        """A pipeline is finished once all its workflows were created.
+        Its workflows might still be running."""
+        return pipeline.status in self.FINISHED_PIPELINE_STATES
+
     def get_project_slug(self, project: Project) -> str:
         return (
             f"{project.git_provider.value}/{project.organization.name}/{project.name}"
         )
 
-    def _to_job(self, circleci_data: dict) -> Job:
-        job = Job(
+    def _job_values(self, circleci_data: dict) -> dict:
+        return dict(
             external_id=circleci_data["id"],
-            workflow=circleci_data["workflow"],
             name=circleci_data["name"],
             number=circleci_data["job_number"],
             status=circleci_data["status"],
             started_at=datetime.fromisoformat(circleci_data["started_at"][:19]),
             stopped_at=datetime.fromisoformat(circleci_data["stopped_at"][:19]),
         )
-        return job
 
-    def _to_workflow(self, circleci_data: dict) -> Workflow:
-        workflow = Workflow(
+    def _workflow_values(self, circleci_data: dict) -> dict:
+        return dict(
             external_id=circleci_data["id"],
-            pipeline=circleci_data["pipeline"],
             name=circleci_data["name"],
             status=circleci_data["status"],
             started_at=datetime.fromisoformat(circleci_data["created_at"][:19]),
             stopped_at=datetime.fromisoformat(circleci_data["stopped_at"][:19]),
         )
-        return workflow
 
-    def _to_pipeline(self, circleci_data: dict) -> Pipeline:
-        pipeline = Pipeline(
-            project=circleci_data["project"],
+    def _pipeline_values(self, circleci_data: dict) -> dict:
+        return dict(
             external_id=circleci_data["id"],
             number=circleci_data["number"],
             created_at=datetime.fromisoformat(circleci_data["created_at"][:19]),
             status=circleci_data["state"],
         )
+
+    def _to_job(self, circleci_data: dict) -> Job:
+        job = Job(
+            workflow=circleci_data["workflow"],
+            kind=circleci_data.get("kind"),
+            **self._job_values(circleci_data),
+        )
+        return job
+
+    def _to_workflow(self, circleci_data: dict) -> Workflow:
+        workflow = Workflow(
+            pipeline=circleci_data["pipeline"],
+            **self._workflow_values(circleci_data),
+        )
+        return workflow
+
+    def _to_pipeline(self, circleci_data: dict) -> Pipeline:
+        pipeline = Pipeline(
+            project=circleci_data["project"], **self._pipeline_values(circleci_data)
+        )
         return pipeline
 
     def to_db_representation(self, circleci_data: dict, model_class):
@@ -161,3 +459,24 @@ class CircleCIDataDriver(object):
         if issubclass(model_class, Job):
             return self._to_job(circleci_data)
         raise Exception(f"Unknown model {model_class}")
+
+    def to_db_values(self, circleci_data: dict, model_class) -> dict:
+        """Same as `to_db_representation`, but returns the values of the columns
+        instead of a model instance. The parent model needs to have an id already."""
+        if issubclass(model_class, Pipeline):
+            return dict(
+                project_id=circleci_data["project"].id,
+                **self._pipeline_values(circleci_data),
+            )
+        if issubclass(model_class, Workflow):
+            return dict(
+                pipeline_id=circleci_data["pipeline"].id,
+                **self._workflow_values(circleci_data),
+            )
+        if issubclass(model_class, Job):
+            return dict(
+                workflow_id=circleci_data["workflow"].id,
+                kind=circleci_data.get("kind"),
+                **self._job_values(circleci_data),
+            )
+        raise Exception(f"Unknown model {model_class}")
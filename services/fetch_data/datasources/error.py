@@ -4,3 +4,13 @@ class DatasourceConfigError(Exception):
 
 class DatasourceNotFoundError(Exception):
     pass
+
+
+class DatasourceRequestError(Exception):
+    def __init__(self, message: str, status_code: int = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class DatasourceUnavailableError(DatasourceRequestError):
+    pass
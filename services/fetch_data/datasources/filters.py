@@ -0,0 +1,61 @@
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional
+
+# CircleCI dates look like 2023-08-24T14:15:22.000Z. Up to the seconds,
+# they sort as strings in the same order as the dates they represent.
+DATE_PREFIX_LENGTH = 19
+
+
+def _date_prefix(date: datetime) -> str:
+    return date.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+class JobFilter(object):
+    """Predicate over raw CircleCI v2 job payloads.
+
+    Everything that can be is prepared once (name and status sets, date
+    bounds as strings), so a job is checked with a few lookups and string
+    comparisons, without parsing it or building any ORM object.
+    Jobs that didn't start or stop are always rejected.
+    """
+
+    def __init__(
+        self,
+        names: Optional[Iterable[str]] = None,
+        name_predicate: Optional[Callable[[str], bool]] = None,
+        statuses: Optional[Iterable[str]] = None,
+        started_after: Optional[datetime] = None,
+        started_before: Optional[datetime] = None,
+    ) -> None:
+        self.names = frozenset(names) if names is not None else None
+        # For names that can't be listed, e.g. patterns
+        self.name_predicate = name_predicate
+        self.statuses = frozenset(statuses) if statuses is not None else None
+        self.started_after = (
+            _date_prefix(started_after) if started_after is not None else None
+        )
+        self.started_before = (
+            _date_prefix(started_before) if started_before is not None else None
+        )
+
+    def __call__(self, item: dict) -> bool:
+        started_at = item.get("started_at")
+        if started_at is None or item.get("stopped_at") is None:
+            return False
+        if self.names is not None and item.get("name") not in self.names:
+            return False
+        if self.name_predicate is not None and not self.name_predicate(
+            item.get("name")
+        ):
+            return False
+        if self.statuses is not None and item.get("status") not in self.statuses:
+            return False
+        started_at = started_at[:DATE_PREFIX_LENGTH]
+        if self.started_after is not None and started_at < self.started_after:
+            return False
+        if self.started_before is not None and started_at >= self.started_before:
+            return False
+        return True
+
+    def filter(self, items: Iterable[dict]) -> List[dict]:
+        return [item for item in items if self(item)]
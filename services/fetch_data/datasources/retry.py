@@ -0,0 +1,165 @@
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+import httpx
+
+
+class RetryPolicy(object):
+    """Decides which responses are retried and how long to wait before retrying.
+
+    Waits follow exponential backoff with full jitter, unless the server tells us
+    how long to wait through the `Retry-After` header.
+    """
+
+    RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        retry_after_max: float = 300.0,
+        jitter: bool = True,
+        random_func: Callable[[], float] = random.random,
+    ) -> None:
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_after_max = retry_after_max
+        self.jitter = jitter
+        self._random = random_func
+
+    @classmethod
+    def from_config(cls, retry_config: dict) -> "RetryPolicy":
+        return cls(
+            max_retries=retry_config.get("max_retries", 5),
+            backoff_base=retry_config.get("backoff_base", 0.5),
+            backoff_max=retry_config.get("backoff_max", 30.0),
+            retry_after_max=retry_config.get("retry_after_max", 300.0),
+            jitter=retry_config.get("jitter", True),
+        )
+
+    def is_retryable(self, status_code: int) -> bool:
+        return status_code in self.RETRYABLE_STATUS_CODES
+
+    def get_retry_after(self, response: httpx.Response) -> Optional[float]:
+        """Seconds the server asked us to wait, if any"""
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(seconds, 0.0), self.retry_after_max)
+
+    def get_delay(self, attempt: int, response: httpx.Response = None) -> float:
+        """Seconds to wait before retry number `attempt` (starting at 0)"""
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None:
+                return retry_after
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        if self.jitter:
+            delay = delay * self._random()
+        return delay
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a host after `failure_threshold` consecutive
+    failures. After `reset_timeout` seconds a single trial request is let
+    through; its result decides if the circuit closes or opens again.
+    A trial that never reports back is given up on after another `reset_timeout`."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 10,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_started_at: Optional[float] = None
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def seconds_until_half_open(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - self._clock())
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.OPEN:
+            return False
+        now = self._clock()
+        if (
+            self._trial_started_at is not None
+            and now - self._trial_started_at < self.reset_timeout
+        ):
+            # Another request is already finding out if the host is back
+            return False
+        self._trial_started_at = now
+        return True
+
+    def record_success(self) -> None:
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_started_at = None
+
+    def record_failure(self) -> None:
+        self._consecutive_failures += 1
+        self._trial_started_at = None
+        if (
+            self.state == self.HALF_OPEN
+            or self._consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self._opened_at = self._clock()
+
+
+class RetryStats(object):
+    def __init__(self) -> None:
+        self.retries = 0
+        self.retries_by_reason: Dict[str, int] = {}
+        self.failed_requests = 0
+        self.rejected_by_circuit_breaker = 0
+        self.total_backoff_seconds = 0.0
+
+    def record_retry(self, reason: str, delay: float) -> None:
+        self.retries += 1
+        self.retries_by_reason[reason] = self.retries_by_reason.get(reason, 0) + 1
+        self.total_backoff_seconds += delay
+
+    def as_dict(self) -> dict:
+        return dict(
+            retries=self.retries,
+            retries_by_reason=dict(self.retries_by_reason),
+            failed_requests=self.failed_requests,
+            rejected_by_circuit_breaker=self.rejected_by_circuit_breaker,
+            total_backoff_seconds=round(self.total_backoff_seconds, 3),
+        )
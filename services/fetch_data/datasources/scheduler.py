@@ -0,0 +1,174 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
+
+from config import get_config
+
+
+class TokenBucket(object):
+    """Rate limiter that allows `rate` acquisitions per second on average,
+    with bursts of up to `capacity` acquisitions."""
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._clock = clock
+        self._tokens = self.capacity
+        self._last_refill = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    async def acquire(self) -> float:
+        """Waits until a token is available and takes it.
+        Returns the time spent waiting, in seconds."""
+        waited = 0.0
+        # The lock makes waiters take tokens in FIFO order
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                wait_time = (1 - self._tokens) / self.rate
+                await asyncio.sleep(wait_time)
+                waited += wait_time
+                self._refill()
+            self._tokens -= 1
+        return waited
+
+
+class SchedulerStats(object):
+    def __init__(self) -> None:
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queued = 0
+        self.max_in_flight = 0
+        self.total_requests = 0
+        self.total_queue_seconds = 0.0
+        self.total_rate_limited_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(
+            queued=self.queued,
+            in_flight=self.in_flight,
+            max_queued=self.max_queued,
+            max_in_flight=self.max_in_flight,
+            total_requests=self.total_requests,
+            total_queue_seconds=round(self.total_queue_seconds, 3),
+            total_rate_limited_seconds=round(self.total_rate_limited_seconds, 3),
+        )
+
+
+class RequestScheduler(object):
+    """Bounds the number of concurrent requests, globally and per endpoint,
+    and optionally their rate through a token bucket."""
+
+    def __init__(
+        self,
+        max_concurrency: int = 20,
+        endpoint_concurrency: Dict[str, int] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+    ) -> None:
+        if endpoint_concurrency is None:
+            endpoint_concurrency = {}
+        self._global_semaphore = asyncio.Semaphore(max_concurrency)
+        self._endpoint_semaphores = {
+            endpoint: asyncio.Semaphore(limit)
+            for endpoint, limit in endpoint_concurrency.items()
+        }
+        self.rate_limiter = rate_limiter
+        self._paused_until = 0.0
+        self.stats = SchedulerStats()
+        self.endpoint_stats: Dict[str, SchedulerStats] = {}
+
+    @classmethod
+    def from_config(cls, scheduler_config: dict) -> "RequestScheduler":
+        rate_limiter = None
+        requests_per_second = get_config(
+            scheduler_config, "rate_limit", "requests_per_second"
+        )
+        if requests_per_second is not None:
+            rate_limiter = TokenBucket(
+                rate=requests_per_second,
+                capacity=get_config(scheduler_config, "rate_limit", "burst"),
+            )
+        return cls(
+            max_concurrency=scheduler_config.get("max_concurrency", 20),
+            endpoint_concurrency=scheduler_config.get("endpoint_concurrency", {}),
+            rate_limiter=rate_limiter,
+        )
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str):
+        """Waits for a free slot for `endpoint` and holds it while the request runs"""
+        all_stats = [
+            self.stats,
+            self.endpoint_stats.setdefault(endpoint, SchedulerStats()),
+        ]
+        for stats in all_stats:
+            stats.queued += 1
+            stats.max_queued = max(stats.max_queued, stats.queued)
+        queued_at = time.monotonic()
+        endpoint_semaphore = self._endpoint_semaphores.get(endpoint)
+        try:
+            if endpoint_semaphore is not None:
+                await endpoint_semaphore.acquire()
+            try:
+                await self._global_semaphore.acquire()
+            except BaseException:
+                if endpoint_semaphore is not None:
+                    endpoint_semaphore.release()
+                raise
+        finally:
+            queue_seconds = time.monotonic() - queued_at
+            for stats in all_stats:
+                stats.queued -= 1
+                stats.total_queue_seconds += queue_seconds
+
+        try:
+            rate_limited_seconds = 0.0
+            while (remaining := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(remaining)
+                rate_limited_seconds += remaining
+            if self.rate_limiter is not None:
+                rate_limited_seconds += await self.rate_limiter.acquire()
+            if rate_limited_seconds:
+                for stats in all_stats:
+                    stats.total_rate_limited_seconds += rate_limited_seconds
+            for stats in all_stats:
+                stats.in_flight += 1
+                stats.max_in_flight = max(stats.max_in_flight, stats.in_flight)
+                stats.total_requests += 1
+            try:
+                yield
+            finally:
+                for stats in all_stats:
+                    stats.in_flight -= 1
+        finally:
+            self._global_semaphore.release()
+            if endpoint_semaphore is not None:
+                endpoint_semaphore.release()
+
+    def pause(self, seconds: float) -> None:
+        """Holds back new requests for `seconds`.
+        Used when the server tells us to slow down."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def get_stats(self) -> dict:
+        return dict(
+            **self.stats.as_dict(),
+            endpoints={
+                endpoint: stats.as_dict()
+                for endpoint, stats in self.endpoint_stats.items()
+            },
+        )
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from services.fetch_data.datasources.cache import CachedResponse, ResponseCache
+
+
+class ThreadRecordingCache(ResponseCache):
+    """Records the threads that touch the files"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.get_ident())
+        return super().get(key)
+
+    def _write(self, key, entry):
+        self.threads.append(threading.get_ident())
+        return super()._write(key, entry)
+
+
+class TestResponseCache(object):
+    def test_set_and_get(self, tmp_path):
+        cache = ResponseCache(str(tmp_path))
+        key = cache.get_key("GET", "/pipeline/id/workflow", {"page-token": "abc"})
+        assert cache.get(key) is None
+
+        cache.set(
+            key,
+            CachedResponse(
+                body=b'{"items": [], "next_page_token": null}',
+                etag='W/"123"',
+                immutable=True,
+            ),
+        )
+        cached = cache.get(key)
+        assert cached.json() == {"items": [], "next_page_token": None}
+        assert cached.immutable is True
+        assert cached.get_conditional_headers() == {"If-None-Match": 'W/"123"'}
+        assert cache.stats.stored == 1
+
+    @pytest.mark.asyncio
+    async def test_async_set_and_get(self, tmp_path):
+        cache = ThreadRecordingCache(str(tmp_path))
+        key = cache.get_key("GET", "/workflow/id/job")
+        assert await cache.aget(key) is None
+
+        await cache.aset(key, CachedResponse(body=b'{"items": []}'))
+        assert (await cache.aget(key)).json() == {"items": []}
+        assert cache.stats.stored == 1
+        # Files are read and written out of the event loop's thread
+        assert len(cache.threads) == 3
+        assert threading.get_ident() not in cache.threads
+
+    def test_key(self):
+        cache = ResponseCache("unused")
+        assert cache.get_key("GET", "/url", {"page-token": None}) == cache.get_key(
+            "get", "/url"
+        )
+        assert cache.get_key("GET", "/url", {"page-token": "a"}) != cache.get_key(
+            "GET", "/url", {"page-token": "b"}
+        )
+
+    @pytest.mark.parametrize(
+        "cache_config,expected_mode",
+        [
+            ({}, None),
+            ({"mode": "off"}, None),
+            ({"mode": False}, None),
+            ({"mode": "replay"}, ResponseCache.REPLAY),
+            ({"mode": "revalidate"}, ResponseCache.REVALIDATE),
+        ],
+    )
+    def test_from_config(self, cache_config, expected_mode):
+        cache = ResponseCache.from_config(cache_config)
+        if expected_mode is None:
+            assert cache is None
+        else:
+            assert cache.mode == expected_mode
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            ResponseCache("unused", mode="sometimes")
@@ -1,19 +1,31 @@
+import json
 import unittest
 from copy import deepcopy
 from datetime import datetime
-from unittest.mock import MagicMock, patch
+from unittest import mock
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import httpx
 import pytest
 
 from database.models.job import Job
 from database.models.pipeline import Pipeline
 from database.models.workflow import Workflow
 from database.tests.factory import PipelineFactory, ProjectFactory, WorkflowFactory
+from services.fetch_data.datasources.cache import CachedResponse
 from services.fetch_data.datasources.circleci import (
     CircleCIDataDriver,
     CircleCIDatasource,
 )
-from services.fetch_data.datasources.error import DatasourceConfigError
+from services.fetch_data.datasources.error import (
+    DatasourceConfigError,
+    DatasourceRequestError,
+    DatasourceUnavailableError,
+)
+from services.fetch_data.datasources.filters import JobFilter
+from services.fetch_data.datasources.retry import CircuitBreaker
+from services.fetch_data.datasources.tests.test_retry import FakeClock
+from utils.metrics import MetricsRegistry
 
 
 class TestCircleCIDatasource(object):
@@ -27,6 +39,300 @@ class TestCircleCIDatasource(object):
         with pytest.raises(DatasourceConfigError):
             CircleCIDatasource(config)
 
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_client_is_shared_and_closed(self, mock_httpx_client):
+        config = deepcopy(self.config)
+        config["datasources"]["circleci"]["http"] = {
+            "max_connections": 5,
+            "max_keepalive_connections": 2,
+            "http2": True,
+        }
+        mock_response = MagicMock(name="mock_response")
+        mock_response.json.return_value = {"items": []}
+        mock_response.status_code = 200
+        mock_client = mock_httpx_client.return_value
+        mock_client.request = AsyncMock(return_value=mock_response)
+        mock_client.aclose = AsyncMock()
+
+        async with CircleCIDatasource(config) as datasource:
+            await datasource._execute_request("GET", "/some/url")
+            await datasource._execute_request("GET", "/other/url")
+            assert mock_client.request.call_count == 2
+
+        mock_httpx_client.assert_called_once()
+        _, kwargs = mock_httpx_client.call_args
+        assert kwargs["base_url"] == CircleCIDatasource.BASE_URL
+        assert kwargs["http2"] is True
+        assert kwargs["limits"].max_connections == 5
+        assert kwargs["limits"].max_keepalive_connections == 2
+        mock_client.aclose.assert_awaited_once()
+        assert datasource._client is None
+
+    @pytest.mark.asyncio
+    @patch(
+        "services.fetch_data.datasources.circleci.httpx.AsyncClient",
+        side_effect=ImportError("h2 not installed"),
+    )
+    async def test_http2_without_h2_installed(self, mock_httpx_client):
+        datasource = CircleCIDatasource(self.config)
+        with pytest.raises(DatasourceConfigError):
+            async with datasource:
+                pass
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.asyncio.sleep")
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_retries_with_backoff(self, mock_httpx_client, mock_sleep):
+        config = deepcopy(self.config)
+        config["datasources"]["circleci"]["retry"] = {"jitter": False}
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = AsyncMock(
+            side_effect=[
+                httpx.ConnectError("Connection refused"),
+                httpx.Response(502),
+                httpx.Response(429, headers={"Retry-After": "7"}),
+                httpx.Response(200, json={"items": [1]}),
+            ]
+        )
+
+        datasource = CircleCIDatasource(config)
+        datasource.scheduler.pause = MagicMock()
+        assert await datasource._execute_request("GET", "/some/url") == {"items": [1]}
+
+        assert mock_httpx_client.return_value.request.call_count == 4
+        assert [call.args[0] for call in mock_sleep.call_args_list] == [0.5, 1, 7]
+        datasource.scheduler.pause.assert_called_once_with(7)
+        stats = datasource.get_stats()
+        assert stats["retries"]["retries"] == 3
+        assert stats["retries"]["retries_by_reason"] == {
+            "ConnectError": 1,
+            "502": 1,
+            "429": 1,
+        }
+        assert stats["circuit_breakers"] == {
+            "circleci.com": dict(state="closed", times_opened=0)
+        }
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.asyncio.sleep")
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_gives_up_after_max_retries(self, mock_httpx_client, mock_sleep):
+        config = deepcopy(self.config)
+        config["datasources"]["circleci"]["retry"] = {"max_retries": 2}
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = AsyncMock(
+            return_value=httpx.Response(503)
+        )
+
+        datasource = CircleCIDatasource(config)
+        with pytest.raises(DatasourceRequestError) as exp:
+            await datasource._execute_request("GET", "/some/url")
+        assert exp.value.status_code == 503
+        assert mock_httpx_client.return_value.request.call_count == 3
+        assert datasource.retry_stats.failed_requests == 1
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.asyncio.sleep")
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_client_errors_are_not_retried(self, mock_httpx_client, mock_sleep):
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = AsyncMock(
+            return_value=httpx.Response(404, json={"message": "Not found"})
+        )
+
+        datasource = CircleCIDatasource(self.config)
+        with pytest.raises(DatasourceRequestError) as exp:
+            await datasource._execute_request("GET", "/some/url")
+        assert exp.value.status_code == 404
+        mock_sleep.assert_not_called()
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.asyncio.sleep")
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_circuit_breaker_opens(self, mock_httpx_client, mock_sleep):
+        config = deepcopy(self.config)
+        config["datasources"]["circleci"]["retry"] = {"max_retries": 10}
+        config["datasources"]["circleci"]["circuit_breaker"] = {"failure_threshold": 3}
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = AsyncMock(
+            return_value=httpx.Response(500)
+        )
+
+        datasource = CircleCIDatasource(config)
+        # The circuit never half opens: time doesn't pass
+        with pytest.raises(DatasourceUnavailableError):
+            await datasource._execute_request("GET", "/some/url")
+        assert mock_httpx_client.return_value.request.call_count == 3
+        assert mock_sleep.call_count == 10
+        # Other requests to the same host aren't sent either
+        with pytest.raises(DatasourceUnavailableError):
+            await datasource._execute_request("GET", "/other/url")
+        assert mock_httpx_client.return_value.request.call_count == 3
+        assert datasource.retry_stats.rejected_by_circuit_breaker == 8 + 11
+        assert datasource.retry_stats.retries_by_reason["circuit_open"] == 7 + 10
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.asyncio.sleep")
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_circuit_breaker_waits_for_half_open(
+        self, mock_httpx_client, mock_sleep
+    ):
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = AsyncMock(
+            side_effect=[
+                httpx.Response(502),
+                httpx.Response(200, json={"items": []}),
+                httpx.Response(404),
+            ]
+        )
+        clock = FakeClock()
+
+        async def sleep(delay):
+            clock.now += delay
+
+        mock_sleep.side_effect = sleep
+        datasource = CircleCIDatasource(self.config)
+        datasource._circuit_breakers["circleci.com"] = CircuitBreaker(
+            failure_threshold=1, reset_timeout=10, clock=clock
+        )
+        # Opens on the 502, and the retry waits for it to half open
+        assert await datasource._execute_request("GET", "/some/url") == {"items": []}
+        assert clock.now >= 10
+        assert datasource.retry_stats.retries_by_reason["circuit_open"] == 1
+
+        datasource._circuit_breakers["circleci.com"].record_failure()
+        clock.now += 10
+        # The trial request gets a 404: the host is back
+        with pytest.raises(DatasourceRequestError) as exp:
+            await datasource._execute_request("GET", "/missing/url")
+        assert exp.value.status_code == 404
+        assert datasource._circuit_breakers["circleci.com"].state == "closed"
+        assert mock_httpx_client.return_value.request.call_count == 3
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_response_cache(self, mock_httpx_client, tmp_path):
+        config = deepcopy(self.config)
+        config["datasources"]["circleci"]["cache"] = {
+            "mode": "revalidate",
+            "directory": str(tmp_path),
+        }
+        running_page = {"items": [{"status": "running"}], "next_page_token": None}
+        finished_page = {"items": [{"status": "success"}], "next_page_token": None}
+        mock_request = AsyncMock(
+            side_effect=[
+                httpx.Response(200, json=running_page, headers={"ETag": '"v1"'}),
+                httpx.Response(304),
+                httpx.Response(200, json=finished_page, headers={"ETag": '"v2"'}),
+            ]
+        )
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = mock_request
+
+        datasource = CircleCIDatasource(config)
+        is_final = datasource.data_driver.is_jobs_page_final
+
+        async def get_page(url):
+            return await datasource._execute_request(
+                "GET", url, params={"page-token": None}, is_immutable=is_final
+            )
+
+        assert await get_page("/workflow/running/job") == running_page
+        # Not final yet, so it's revalidated
+        assert await get_page("/workflow/running/job") == running_page
+        assert mock_request.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
+        assert await get_page("/workflow/finished/job") == finished_page
+        # Final pages never hit the network again
+        assert await get_page("/workflow/finished/job") == finished_page
+        assert mock_request.call_count == 3
+        assert datasource.get_stats()["cache"] == dict(
+            hits=1, misses=2, revalidated=1, stored=2, stored_bytes=mock.ANY
+        )
+
+        # Replay mode serves from the cache only
+        config["datasources"]["circleci"]["cache"]["mode"] = "replay"
+        datasource = CircleCIDatasource(config)
+        assert await get_page("/workflow/running/job") == running_page
+        assert mock_request.call_count == 3
+        with pytest.raises(DatasourceRequestError):
+            await get_page("/workflow/never-seen/job")
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_workflows_pages_are_revalidated(self, mock_httpx_client, tmp_path):
+        config = deepcopy(self.config)
+        config["datasources"]["circleci"]["cache"] = {
+            "mode": "revalidate",
+            "directory": str(tmp_path),
+        }
+        finished_workflow = {
+            "id": "workflow",
+            "created_at": "2023-08-24T14:15:22Z",
+            "stopped_at": "2023-08-24T14:20:22Z",
+        }
+        first_page = {"items": [finished_workflow], "next_page_token": None}
+        # Rerun, in the same pipeline
+        rerun_page = {
+            "items": [finished_workflow, {**finished_workflow, "id": "rerun"}],
+            "next_page_token": None,
+        }
+        mock_request = AsyncMock(
+            side_effect=[
+                httpx.Response(200, json=first_page, headers={"ETag": '"v1"'}),
+                httpx.Response(200, json=rerun_page, headers={"ETag": '"v2"'}),
+            ]
+        )
+        mock_httpx_client.return_value.base_url = httpx.URL(CircleCIDatasource.BASE_URL)
+        mock_httpx_client.return_value.request = mock_request
+        pipeline = Pipeline(external_id="pipeline")
+
+        datasource = CircleCIDatasource(config)
+        # As stored when workflows pages were thought to be immutable
+        cache_key = datasource.cache.get_key(
+            "GET", "/pipeline/pipeline/workflow", {"page-token": None}
+        )
+        datasource.cache.set(
+            cache_key,
+            CachedResponse(body=json.dumps(first_page).encode(), immutable=True),
+        )
+        for expected_ids in (["workflow"], ["workflow", "rerun"]):
+            pages = [page async for page in datasource.get_pipeline_workflows(pipeline)]
+            assert [item["id"] for page in pages for item in page] == expected_ids
+        assert mock_request.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_request_metrics(self, mock_httpx_client, mocker):
+        registry = mocker.patch(
+            "services.fetch_data.datasources.circleci.metrics",
+            MetricsRegistry(enabled=True),
+        )
+        pages = [
+            {"items": [], "next_page_token": "page-2"},
+            {"items": [], "next_page_token": None},
+        ]
+        responses = []
+        for page in pages:
+            response = MagicMock(status_code=200)
+            response.json.return_value = page
+            responses.append(response)
+        mock_httpx_client.return_value.request = AsyncMock(side_effect=responses)
+
+        datasource = CircleCIDatasource(self.config)
+        async for _ in datasource._paginated_requests("GET", "/jobs", endpoint="jobs"):
+            pass
+
+        summary = registry.as_dict()
+        assert summary["counters"]["http_requests_total"] == [
+            dict(labels=dict(endpoint="jobs", status="200"), value=2)
+        ]
+        [latency] = summary["histograms"]["http_request_seconds"]
+        assert latency["labels"] == dict(endpoint="jobs")
+        assert latency["count"] == 2
+        [pages_per_call] = summary["histograms"]["pages_per_call"]
+        assert pages_per_call["sum"] == 2
+
     @pytest.mark.asyncio
     @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
     async def test_get_all_project_pipelines(self, mock_httpx_client, dbsession):
@@ -54,9 +360,7 @@ class TestCircleCIDatasource(object):
         mock_response = MagicMock(name="mock_response")
         mock_response.json.return_value = example_response
         mock_response.status_code = 200
-        mock_httpx_client.return_value.__aenter__.return_value.request.return_value = (
-            mock_response
-        )
+        mock_httpx_client.return_value.request = AsyncMock(return_value=mock_response)
 
         datasource = CircleCIDatasource(self.config)
         items = []
@@ -82,13 +386,46 @@ class TestCircleCIDatasource(object):
         result = items[0]
         assert result == expected_result
 
-        mock_httpx_client.return_value.__aenter__.return_value.request.assert_called_once_with(
+        mock_httpx_client.return_value.request.assert_called_once_with(
             "GET",
             f"/project/gh/CircleCI-Public/api-preview-docs/pipeline",
             headers={"Circle-Token": "your_api_token_here"},
             params={"page-token": None},
         )
 
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_get_all_project_pipelines_since_number(
+        self, mock_httpx_client, dbsession
+    ):
+        project = ProjectFactory(
+            organization__name="CircleCI-Public", name="api-preview-docs"
+        )
+        dbsession.add(project)
+        pages = [
+            {"items": [{"number": 13}, {"number": 12}], "next_page_token": "page_2"},
+            {"items": [{"number": 11}, {"number": 10}], "next_page_token": "page_3"},
+            {"items": [{"number": 9}, {"number": 8}], "next_page_token": None},
+        ]
+        mock_responses = []
+        for page in pages:
+            mock_response = MagicMock(name="mock_response")
+            mock_response.json.return_value = page
+            mock_response.status_code = 200
+            mock_responses.append(mock_response)
+        mock_httpx_client.return_value.request = AsyncMock(side_effect=mock_responses)
+
+        datasource = CircleCIDatasource(self.config)
+        items = []
+        async for page in datasource.get_all_project_pipelines(
+            project, since_number=10
+        ):
+            items.extend(page)
+
+        assert [item["number"] for item in items] == [13, 12, 11]
+        # The last page is never requested
+        assert mock_httpx_client.return_value.request.call_count == 2
+
     @pytest.mark.asyncio
     @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
     async def test_get_pipeline_workflows(self, mock_httpx_client, dbsession):
@@ -116,9 +453,7 @@ class TestCircleCIDatasource(object):
         mock_response = MagicMock()
         mock_response.json.return_value = example_response
         mock_response.status_code = 200
-        mock_httpx_client.return_value.__aenter__.return_value.request.return_value = (
-            mock_response
-        )
+        mock_httpx_client.return_value.request = AsyncMock(return_value=mock_response)
 
         datasource = CircleCIDatasource(self.config)
         items = []
@@ -146,7 +481,7 @@ class TestCircleCIDatasource(object):
         result = items[0]
         assert result == expected_response
 
-        mock_httpx_client.return_value.__aenter__.return_value.request.assert_called_once_with(
+        mock_httpx_client.return_value.request.assert_called_once_with(
             "GET",
             f"/pipeline/{pipeline.external_id}/workflow",
             headers={"Circle-Token": "your_api_token_here"},
@@ -180,9 +515,7 @@ class TestCircleCIDatasource(object):
         mock_response = MagicMock()
         mock_response.json.return_value = example_response
         mock_response.status_code = 200
-        mock_httpx_client.return_value.__aenter__.return_value.request.return_value = (
-            mock_response
-        )
+        mock_httpx_client.return_value.request = AsyncMock(return_value=mock_response)
 
         datasource = CircleCIDatasource(self.config)
         items = []
@@ -210,13 +543,44 @@ class TestCircleCIDatasource(object):
         result = items[0]
         assert result == expected_response
 
-        mock_httpx_client.return_value.__aenter__.return_value.request.assert_called_once_with(
+        mock_httpx_client.return_value.request.assert_called_once_with(
             "GET",
             f"/workflow/{workflow.external_id}/job",
             headers={"Circle-Token": "your_api_token_here"},
             params={"page-token": None},
         )
 
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.datasources.circleci.httpx.AsyncClient")
+    async def test_get_workflow_jobs_with_filter(self, mock_httpx_client, dbsession):
+        workflow = WorkflowFactory()
+        dbsession.add(workflow)
+        example_response = {
+            "items": [
+                {
+                    "id": f"job-{name}",
+                    "name": name,
+                    "status": "success",
+                    "started_at": "2019-08-24T14:15:22Z",
+                    "stopped_at": "2019-08-24T14:15:22Z",
+                }
+                for name in ["ATS", "lint", "test"]
+            ],
+        }
+        mock_response = MagicMock()
+        mock_response.json.return_value = example_response
+        mock_response.status_code = 200
+        mock_httpx_client.return_value.request = AsyncMock(return_value=mock_response)
+
+        datasource = CircleCIDatasource(self.config)
+        items = []
+        async for page in datasource.get_workflow_jobs(
+            workflow, job_filter=JobFilter(names=["ATS", "test"])
+        ):
+            items.extend(page)
+        assert [item["id"] for item in items] == ["job-ATS", "job-test"]
+        assert all(item["workflow"] == workflow for item in items)
+
 
 class TestCircleCIDataDriver(object):
     def test_to_pipeline(self, dbsession):
@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from services.fetch_data.datasources.filters import JobFilter
+
+
+def job_data(name="test", status="success", started_at="2023-08-24T14:15:22Z"):
+    return {
+        "id": f"{name}-{status}-{started_at}",
+        "name": name,
+        "status": status,
+        "started_at": started_at,
+        "stopped_at": "2023-08-24T15:15:22Z" if started_at is not None else None,
+    }
+
+
+class TestJobFilter(object):
+    def test_no_predicates(self):
+        job_filter = JobFilter()
+        assert job_filter(job_data())
+        assert not job_filter(job_data(started_at=None))
+        assert not job_filter({**job_data(), "stopped_at": None})
+
+    def test_names(self):
+        job_filter = JobFilter(names=["ATS", "test"])
+        assert job_filter(job_data(name="ATS"))
+        assert job_filter(job_data(name="test"))
+        assert not job_filter(job_data(name="lint"))
+
+    def test_statuses(self):
+        job_filter = JobFilter(statuses=["success", "failed"])
+        assert job_filter(job_data(status="failed"))
+        assert not job_filter(job_data(status="canceled"))
+
+    def test_dates(self):
+        job_filter = JobFilter(
+            started_after=datetime(2023, 8, 24, 14, 15, 22),
+            started_before=datetime(2023, 9, 1),
+        )
+        assert job_filter(job_data(started_at="2023-08-24T14:15:22.000Z"))
+        assert job_filter(job_data(started_at="2023-08-31T23:59:59Z"))
+        assert not job_filter(job_data(started_at="2023-08-24T14:15:21.999Z"))
+        assert not job_filter(job_data(started_at="2023-09-01T00:00:00Z"))
+
+    def test_filter(self):
+        job_filter = JobFilter(names=["ATS"], statuses=["success"])
+        jobs = [
+            job_data(name="ATS"),
+            job_data(name="ATS", status="failed"),
+            job_data(name="test"),
+            job_data(name="ATS", started_at=None),
+        ]
+        assert job_filter.filter(jobs) == [jobs[0]]
@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+
+from services.fetch_data.datasources.retry import (
+    CircuitBreaker,
+    RetryPolicy,
+    RetryStats,
+)
+
+
+class FakeClock(object):
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestRetryPolicy(object):
+    @pytest.mark.parametrize(
+        "status_code,expected",
+        [(429, True), (500, True), (502, True), (404, False), (401, False)],
+    )
+    def test_is_retryable(self, status_code, expected):
+        assert RetryPolicy().is_retryable(status_code) == expected
+
+    def test_exponential_backoff(self):
+        policy = RetryPolicy(backoff_base=1, backoff_max=5, jitter=False)
+        assert [policy.get_delay(attempt) for attempt in range(5)] == [1, 2, 4, 5, 5]
+
+    def test_full_jitter(self):
+        policy = RetryPolicy(backoff_base=1, random_func=lambda: 0.25)
+        assert policy.get_delay(3) == 2
+
+    def test_retry_after_seconds(self):
+        policy = RetryPolicy(retry_after_max=60)
+        response = httpx.Response(429, headers={"Retry-After": "12"})
+        assert policy.get_delay(0, response) == 12
+        response = httpx.Response(429, headers={"Retry-After": "600"})
+        assert policy.get_delay(0, response) == 60
+
+    def test_retry_after_date(self):
+        policy = RetryPolicy()
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+        response = httpx.Response(
+            503, headers={"Retry-After": format_datetime(retry_at, usegmt=True)}
+        )
+        assert 25 < policy.get_delay(0, response) <= 30
+
+    def test_invalid_retry_after(self):
+        policy = RetryPolicy(backoff_base=1, jitter=False)
+        response = httpx.Response(429, headers={"Retry-After": "soon"})
+        assert policy.get_delay(2, response) == 4
+
+    def test_from_config(self):
+        policy = RetryPolicy.from_config({"max_retries": 2, "jitter": False})
+        assert policy.max_retries == 2
+        assert policy.jitter is False
+        assert policy.backoff_base == 0.5
+
+
+class TestCircuitBreaker(object):
+    def test_opens_after_threshold_and_recovers(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock)
+        for _ in range(2):
+            breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow_request()
+
+        clock.now = 10
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow_request()
+        # A failure while half open opens the circuit right away
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.times_opened == 2
+
+        clock.now = 20
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_allows_one_trial(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        assert breaker.allow_request()
+        # The others wait for the trial's result
+        assert not breaker.allow_request()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.record_success()
+        assert breaker.allow_request()
+        assert breaker.allow_request()
+
+    def test_lost_trial_is_given_up_on(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 10
+        assert breaker.allow_request()
+        clock.now = 19
+        assert not breaker.allow_request()
+        clock.now = 20
+        assert breaker.allow_request()
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retry_stats():
+    stats = RetryStats()
+    stats.record_retry("429", 1.5)
+    stats.record_retry("429", 1)
+    stats.record_retry("ReadTimeout", 0.5)
+    assert stats.as_dict() == dict(
+        retries=3,
+        retries_by_reason={"429": 2, "ReadTimeout": 1},
+        failed_requests=0,
+        rejected_by_circuit_breaker=0,
+        total_backoff_seconds=3.0,
+    )
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from services.fetch_data.datasources.scheduler import RequestScheduler, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestTokenBucket(object):
+    @pytest.mark.asyncio
+    async def test_burst_then_waits(self, mocker):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+
+        async def fake_sleep(seconds):
+            clock.now += seconds
+
+        mocker.patch(
+            "services.fetch_data.datasources.scheduler.asyncio.sleep",
+            side_effect=fake_sleep,
+        )
+        waits = [await bucket.acquire() for _ in range(5)]
+        assert waits[:3] == [0, 0, 0]
+        assert waits[3:] == [0.5, 0.5]
+        assert clock.now == 1.0
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            TokenBucket(rate=0)
+
+
+class TestRequestScheduler(object):
+    @pytest.mark.asyncio
+    async def test_concurrency_limits(self):
+        scheduler = RequestScheduler(
+            max_concurrency=3, endpoint_concurrency={"jobs": 1}
+        )
+        running = {"jobs": 0, "workflows": 0}
+        max_running = {"jobs": 0, "workflows": 0}
+
+        async def request(endpoint):
+            async with scheduler.slot(endpoint):
+                running[endpoint] += 1
+                max_running[endpoint] = max(max_running[endpoint], running[endpoint])
+                await asyncio.sleep(0.01)
+                running[endpoint] -= 1
+
+        await asyncio.gather(
+            *[request("jobs") for _ in range(5)],
+            *[request("workflows") for _ in range(5)],
+        )
+        assert max_running["jobs"] == 1
+        assert max_running["workflows"] <= 3
+        stats = scheduler.get_stats()
+        assert stats["total_requests"] == 10
+        assert stats["max_in_flight"] == 3
+        assert stats["in_flight"] == 0
+        assert stats["queued"] == 0
+        assert stats["max_queued"] > 0
+        assert stats["endpoints"]["jobs"]["total_requests"] == 5
+        assert stats["endpoints"]["jobs"]["max_in_flight"] == 1
+
+    @pytest.mark.asyncio
+    async def test_slot_released_on_error(self):
+        scheduler = RequestScheduler(max_concurrency=1)
+        with pytest.raises(RuntimeError):
+            async with scheduler.slot("jobs"):
+                raise RuntimeError()
+        # Would block forever if the slot was not released
+        async with scheduler.slot("jobs"):
+            pass
+        assert scheduler.stats.in_flight == 0
+
+    def test_from_config(self):
+        scheduler = RequestScheduler.from_config(
+            {
+                "max_concurrency": 5,
+                "endpoint_concurrency": {"jobs": 2},
+                "rate_limit": {"requests_per_second": 10, "burst": 15},
+            }
+        )
+        assert scheduler._global_semaphore._value == 5
+        assert scheduler._endpoint_semaphores["jobs"]._value == 2
+        assert scheduler.rate_limiter.rate == 10
+        assert scheduler.rate_limiter.capacity == 15
+
+    def test_from_empty_config(self):
+        scheduler = RequestScheduler.from_config({})
+        assert scheduler.rate_limiter is None
+        assert scheduler._endpoint_semaphores == {}
@@ -0,0 +1,111 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from services.fetch_data.buffer import WriteBehindBuffer
+
+
+class FakeTable(object):
+    def __init__(self, error: Exception = None) -> None:
+        self.batches = []
+        self.error = error
+
+    async def write(self, rows):
+        self.batches.append([row["id"] for row in rows])
+        if self.error is not None:
+            raise self.error
+        # Rows with odd ids are "already there and unchanged"
+        return [SimpleNamespace(external_id=row["id"]) for row in rows if row["id"] % 2]
+
+
+class TestWriteBehindBuffer(object):
+    @pytest.mark.asyncio
+    async def test_flush_on_size(self):
+        table = FakeTable()
+        buffer = WriteBehindBuffer(table.write, batch_size=3, max_delay=10)
+        first = buffer.add([{"id": 1}, {"id": 2}])
+        second = buffer.add([{"id": 3}])
+        results = await asyncio.gather(first, second)
+        assert table.batches == [[1, 2, 3]]
+        assert [[item.external_id for item in result] for result in results] == [
+            [1],
+            [3],
+        ]
+        assert buffer.stats.as_dict() == dict(
+            rows=3,
+            flushes=1,
+            size_flushes=1,
+            timer_flushes=0,
+            drain_flushes=0,
+            max_batch_rows=3,
+        )
+
+    @pytest.mark.asyncio
+    async def test_flush_on_timer(self):
+        table = FakeTable()
+        buffer = WriteBehindBuffer(table.write, batch_size=100, max_delay=0.01)
+        first = buffer.add([{"id": 1}])
+        await asyncio.sleep(0)
+        second = buffer.add([{"id": 3}])
+        assert table.batches == []
+        await asyncio.gather(first, second)
+        assert table.batches == [[1, 3]]
+        assert buffer.stats.timer_flushes == 1
+
+    @pytest.mark.asyncio
+    async def test_empty_page(self):
+        table = FakeTable()
+        buffer = WriteBehindBuffer(table.write)
+        assert await buffer.add([]) == []
+        await buffer.drain()
+        assert table.batches == []
+
+    @pytest.mark.asyncio
+    async def test_drain(self):
+        table = FakeTable()
+        buffer = WriteBehindBuffer(table.write, batch_size=100, max_delay=10)
+        future = buffer.add([{"id": 1}, {"id": 2}])
+        await buffer.drain()
+        assert future.done()
+        assert table.batches == [[1, 2]]
+        assert buffer.stats.drain_flushes == 1
+
+    @pytest.mark.asyncio
+    async def test_error_is_raised_to_waiters(self):
+        table = FakeTable(error=RuntimeError("Database is locked"))
+        buffer = WriteBehindBuffer(table.write, batch_size=2, max_delay=10)
+        first = buffer.add([{"id": 1}])
+        second = buffer.add([{"id": 2}])
+        for future in (first, second):
+            with pytest.raises(RuntimeError):
+                await future
+        assert buffer.stats.flushes == 0
+
+    @pytest.mark.asyncio
+    async def test_close(self):
+        table = FakeTable()
+        buffer = WriteBehindBuffer(table.write, batch_size=100, max_delay=0.01)
+        future = buffer.add([{"id": 1}])
+        await buffer.close()
+        await asyncio.sleep(0.02)
+        assert future.cancelled()
+        assert table.batches == []
+
+    @pytest.mark.asyncio
+    async def test_close_cancels_writes(self):
+        started = asyncio.Event()
+        finished = []
+
+        async def slow_write(rows):
+            started.set()
+            await asyncio.sleep(1)
+            finished.append(rows)
+
+        buffer = WriteBehindBuffer(slow_write, batch_size=1)
+        future = buffer.add([{"id": 1}])
+        await started.wait()
+        await buffer.close()
+        assert future.cancelled()
+        assert finished == []
+        assert not buffer._flush_tasks
@@ -1,11 +1,31 @@
+import asyncio
+import threading
+from types import SimpleNamespace
 from unittest.mock import MagicMock, call, patch
 
 import pytest
 
+from benchmarks.fake_circleci import FakeCircleCIServer, SyntheticHistory
 from database import models
-from database.tests.factory import PipelineFactory, WorkflowFactory
+from database.models.enums import JobKinds, JobPatternTypes
+from database.tests.factory import PipelineFactory, ProjectFactory, WorkflowFactory
 from services.fetch_data import FetchDataService, UpdateFields
+from services.fetch_data.datasources.base import BaseDatasource
 from services.fetch_data.datasources.circleci import CircleCIDataDriver
+from services.fetch_data.datasources.error import DatasourceRequestError
+
+
+def sync_everything(raw_data, *args):
+    # Everything that is sent to the DB is considered synced
+    return [
+        SimpleNamespace(
+            external_id=item["id"],
+            label_analysis_job_name="ATS",
+            regular_tests_job_name="test",
+            **item,
+        )
+        for item in raw_data
+    ]
 
 
 class TestFetchDataService(object):
@@ -69,6 +89,117 @@ class TestFetchDataService(object):
         assert len(models_synced) == 2
         assert workflow_already_there_to_update in models_synced
 
+    @pytest.mark.parametrize("job_count", [5, 50])
+    def test_sync_page_query_budget(self, dbsession, query_counter, job_count):
+        workflows = [WorkflowFactory(metrics_dirty=False) for _ in range(2)]
+        dbsession.add_all(workflows)
+        dbsession.flush()
+        history = SyntheticHistory(pipelines=1, jobs_per_workflow=job_count)
+        jobs = []
+        for idx in range(job_count):
+            job = history.get_job(1, 0, idx)
+            job["workflow"] = workflows[idx % 2]
+            jobs.append(job)
+
+        fetch_data_service = FetchDataService(dbsession, {})
+        with query_counter:
+            synced = fetch_data_service._sync_page(
+                jobs,
+                models.Job,
+                CircleCIDataDriver(),
+                [UpdateFields("status", "status")],
+            )
+        # Upsert and marking the workflows dirty, whatever the page size
+        query_counter.assert_at_most(2)
+        assert len(synced) == job_count
+        dbsession.expire_all()
+        assert all(workflow.metrics_dirty for workflow in workflows)
+
+    def test_sync_model_single_statement(self, dbsession, mocker):
+        pipeline = PipelineFactory(status="created", external_id="already_there")
+        dbsession.add(pipeline)
+        dbsession.flush()
+
+        def raw_pipeline(external_id, number, state):
+            return {
+                "project": pipeline.project,
+                "id": external_id,
+                "number": number,
+                "state": state,
+                "created_at": "2019-08-24T14:15:22Z",
+            }
+
+        fetch_data_service = FetchDataService(dbsession, {})
+        execute = mocker.spy(dbsession, "scalars")
+        models_synced = fetch_data_service._sync_model(
+            raw_data=[
+                raw_pipeline("already_there", pipeline.number, "created"),
+                raw_pipeline("new_pipeline", 1, "setup"),
+                # Same pipeline showing up twice, last one wins
+                raw_pipeline("new_pipeline", 1, "created"),
+            ],
+            model=models.Pipeline,
+            datadriver=CircleCIDataDriver(),
+            update_fields=[UpdateFields("status", "state")],
+        )
+        assert execute.call_count == 1
+        assert [item.external_id for item in models_synced] == ["new_pipeline"]
+        assert models_synced[0].status == "created"
+        assert models_synced[0].project_id == pipeline.project.id
+        assert dbsession.query(models.Pipeline).count() == 2
+
+        models_synced = fetch_data_service._sync_model(
+            raw_data=[raw_pipeline("already_there", pipeline.number, "errored")],
+            model=models.Pipeline,
+            datadriver=CircleCIDataDriver(),
+            update_fields=[UpdateFields("status", "state")],
+        )
+        # The instance in the session is updated
+        assert models_synced == [pipeline]
+        assert pipeline.status == "errored"
+
+    def test_sync_page_marks_metrics_dirty(self, dbsession):
+        workflow = WorkflowFactory(external_id="workflow", metrics_dirty=False)
+        other_workflow = WorkflowFactory(metrics_dirty=False)
+        dbsession.add_all([workflow, other_workflow])
+        dbsession.flush()
+        raw_job = {
+            "workflow": workflow,
+            "id": "job",
+            "name": "test",
+            "job_number": 1,
+            "status": "success",
+            "started_at": "2023-08-24T14:15:22Z",
+            "stopped_at": "2023-08-24T14:20:22Z",
+        }
+        fetch_data_service = FetchDataService(dbsession, {})
+        update_fields = [UpdateFields("status", "status")]
+        fetch_data_service._sync_page(
+            [raw_job], models.Job, CircleCIDataDriver(), update_fields
+        )
+        dbsession.refresh(workflow)
+        dbsession.refresh(other_workflow)
+        assert workflow.metrics_dirty
+        assert not other_workflow.metrics_dirty
+
+        # Syncing the same job again changes nothing
+        workflow.metrics_dirty = False
+        dbsession.flush()
+        fetch_data_service._sync_page(
+            [raw_job], models.Job, CircleCIDataDriver(), update_fields
+        )
+        dbsession.refresh(workflow)
+        assert not workflow.metrics_dirty
+
+    def test_sync_model_empty(self, dbsession):
+        fetch_data_service = FetchDataService(dbsession, {})
+        assert (
+            fetch_data_service._sync_model(
+                [], models.Pipeline, CircleCIDataDriver(), []
+            )
+            == []
+        )
+
     @pytest.mark.asyncio
     @patch("services.fetch_data.FetchDataService._sync_model")
     async def test_sync_pipelines(self, mock_sync_model, dbsession):
@@ -118,8 +249,11 @@ class TestFetchDataService(object):
         )
 
     @pytest.mark.asyncio
+    @patch("services.fetch_data.FetchDataService._mark_metrics_dirty")
     @patch("services.fetch_data.FetchDataService._sync_model")
-    async def test_sync_workflows(self, mock_sync_model, dbsession):
+    async def test_sync_workflows(
+        self, mock_sync_model, mock_mark_metrics_dirty, dbsession
+    ):
         # Mock the data source and data drivers
         mock_datasource = MagicMock(name="datasource")
         mock_data_driver = MagicMock(name="data_driver")
@@ -170,3 +304,363 @@ class TestFetchDataService(object):
                 ),
             ]
         )
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.FetchDataService._mark_metrics_dirty")
+    @patch("services.fetch_data.FetchDataService._sync_model")
+    async def test_sync_jobs(self, mock_sync_model, mock_mark_metrics_dirty, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        workflow = WorkflowFactory(pipeline=PipelineFactory(project=project))
+        dbsession.add(workflow)
+        dbsession.flush()
+        mock_datasource = MagicMock(name="datasource")
+        mock_data_driver = MagicMock(name="data_driver")
+        mock_datasource.data_driver = mock_data_driver
+        job_filters = []
+
+        async def get_jobs_mock(workflow, job_filter=None):
+            job_filters.append(job_filter)
+            yield [{"id": "job_1", "name": "ATS"}]
+            yield [{"id": "job_2", "name": "test"}]
+
+        mock_datasource.get_workflow_jobs = get_jobs_mock
+        mock_sync_model.side_effect = sync_everything
+
+        fetch_data_service = FetchDataService(dbsession, {})
+        synced_jobs = await fetch_data_service.sync_jobs(workflow, mock_datasource)
+        assert [(job.external_id, job.kind) for job in synced_jobs] == [
+            ("job_1", JobKinds.label_analysis),
+            ("job_2", JobKinds.regular_tests),
+        ]
+        # Jobs are filtered on their raw data, by the datasource
+        assert len(job_filters) == 1
+        assert job_filters[0].name_predicate("ATS")
+        assert not job_filters[0].name_predicate("lint")
+        mock_data_driver.to_db_representation.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_sync_project_job_classifications(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        dbsession.add(project)
+        dbsession.add_all(
+            [
+                models.JobClassification(
+                    project=project,
+                    kind=JobKinds.label_analysis,
+                    pattern="ATS",
+                    pattern_type=JobPatternTypes.exact,
+                ),
+                models.JobClassification(
+                    project=project,
+                    kind=JobKinds.regular_tests,
+                    pattern="job-*",
+                    pattern_type=JobPatternTypes.glob,
+                ),
+            ]
+        )
+        dbsession.flush()
+        history = SyntheticHistory(
+            pipelines=2, workflows_per_pipeline=1, jobs_per_workflow=5
+        )
+        async with FakeCircleCIServer(history) as server:
+            config = {
+                "datasources": {
+                    "circleci": {"api_token": "some-token", "base_url": server.base_url}
+                }
+            }
+            await FetchDataService(dbsession, config).sync_project(project)
+
+        jobs = dbsession.query(models.Job).order_by(models.Job.external_id).all()
+        # "test" is not a regular tests job anymore, the 3 job-N shards are
+        assert [(job.name, job.kind) for job in jobs] == [
+            ("ATS", JobKinds.label_analysis),
+            ("job-2", JobKinds.regular_tests),
+            ("job-3", JobKinds.regular_tests),
+            ("job-4", JobKinds.regular_tests),
+        ] * 2
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.FetchDataService._sync_model")
+    @patch("services.fetch_data.get_datasource_class")
+    async def test_sync_project_streams_stages(
+        self, mock_get_datasource_class, mock_sync_model, dbsession
+    ):
+        events = []
+        job_filters = []
+
+        class FakeDatasource(BaseDatasource):
+            data_driver = MagicMock(name="data_driver")
+
+            async def get_all_project_pipelines(self, project, since_number=None):
+                for idx in [1, 2]:
+                    events.append(f"fetch pipeline_{idx}")
+                    # The second page is slow; the first pipeline's
+                    # workflows and jobs shouldn't wait for it
+                    await asyncio.sleep(0.05 if idx == 2 else 0)
+                    yield [{"id": f"pipeline_{idx}"}]
+
+            async def get_pipeline_workflows(self, pipeline, include_unfinished=False):
+                events.append(f"fetch workflows of {pipeline.id}")
+                yield [{"id": f"{pipeline.id}_workflow"}]
+
+            async def get_workflow_jobs(self, workflow, job_filter=None):
+                events.append(f"fetch jobs of {workflow.id}")
+                job_filters.append(job_filter)
+                yield []
+
+        mock_get_datasource_class.return_value = lambda config: FakeDatasource()
+        mock_sync_model.side_effect = sync_everything
+
+        fetch_data_service = FetchDataService(
+            dbsession,
+            {
+                "fetch": {
+                    "workflow_workers": 2,
+                    "job_workers": 2,
+                    "write_buffer": {"max_delay": 0},
+                }
+            },
+        )
+        project = ProjectFactory()
+        dbsession.add(project)
+        dbsession.flush()
+        await fetch_data_service.sync_project(project)
+
+        assert sorted(events) == sorted(
+            [
+                "fetch pipeline_1",
+                "fetch pipeline_2",
+                "fetch workflows of pipeline_1",
+                "fetch workflows of pipeline_2",
+                "fetch jobs of pipeline_1_workflow",
+                "fetch jobs of pipeline_2_workflow",
+            ]
+        )
+        assert events.index("fetch jobs of pipeline_1_workflow") < events.index(
+            "fetch workflows of pipeline_2"
+        )
+        # Built once for the whole project
+        assert len(job_filters) == 2
+        assert job_filters[0] is job_filters[1]
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.FetchDataService._sync_model")
+    @patch("services.fetch_data.get_datasource_class")
+    async def test_sync_project_stage_error(
+        self, mock_get_datasource_class, mock_sync_model, dbsession
+    ):
+        class FakeDatasource(BaseDatasource):
+            data_driver = MagicMock(name="data_driver")
+
+            async def get_all_project_pipelines(self, project, since_number=None):
+                for idx in range(50):
+                    yield [{"id": idx}]
+
+            async def get_pipeline_workflows(self, pipeline, include_unfinished=False):
+                raise RuntimeError("Failed to fetch workflows")
+                yield
+
+        mock_get_datasource_class.return_value = lambda config: FakeDatasource()
+        mock_sync_model.side_effect = sync_everything
+
+        fetch_data_service = FetchDataService(dbsession, {"fetch": {"queue_size": 1}})
+        project = ProjectFactory()
+        dbsession.add(project)
+        dbsession.flush()
+        with pytest.raises(RuntimeError):
+            await fetch_data_service.sync_project(project)
+
+    @pytest.mark.asyncio
+    @patch("services.fetch_data.FetchDataService._sync_model")
+    @patch("services.fetch_data.get_datasource_class")
+    async def test_sync_project_skips_pipeline_on_client_error(
+        self, mock_get_datasource_class, mock_sync_model, dbsession
+    ):
+        project = ProjectFactory()
+        pipelines = [PipelineFactory(project=project, number=idx) for idx in (1, 2)]
+        dbsession.add_all(pipelines)
+        dbsession.flush()
+        synced_workflows = []
+
+        class FakeDatasource(BaseDatasource):
+            data_driver = MagicMock(name="data_driver")
+
+            async def get_all_project_pipelines(self, project, since_number=None):
+                yield [
+                    {"id": pipeline.id, "number": pipeline.number}
+                    for pipeline in pipelines
+                ]
+
+            async def get_pipeline_workflows(self, pipeline, include_unfinished=False):
+                if pipeline.number == 1:
+                    raise DatasourceRequestError("Not found", status_code=404)
+                synced_workflows.append(pipeline.number)
+                yield []
+
+        mock_get_datasource_class.return_value = lambda config: FakeDatasource()
+        mock_sync_model.side_effect = sync_everything
+        fetch_data_service = FetchDataService(dbsession)
+        await fetch_data_service.sync_project(project)
+
+        assert synced_workflows == [2]
+        cursor = dbsession.query(models.SyncCursor).one()
+        assert pipelines[0].id in cursor.pending_pipeline_ids
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("incremental", [True, False])
+    @patch("services.fetch_data.get_datasource_class")
+    async def test_sync_project_incremental(
+        self, mock_get_datasource_class, dbsession, incremental
+    ):
+        project = ProjectFactory()
+        old_pipeline = PipelineFactory(project=project, number=10, status="created")
+        running_pipeline = PipelineFactory(project=project, number=11, status="created")
+        dbsession.add_all([project, old_pipeline, running_pipeline])
+        dbsession.flush()
+        dbsession.add(
+            models.SyncCursor(
+                project=project,
+                last_pipeline_number=11,
+                pending_pipeline_ids=[running_pipeline.id],
+            )
+        )
+        dbsession.flush()
+        requested = dict(since_number=[], workflows=[])
+
+        def workflow_data(pipeline, workflow_id, stopped_at):
+            return {
+                "pipeline": pipeline,
+                "id": workflow_id,
+                "name": "build-and-test",
+                "status": "success" if stopped_at else "running",
+                "created_at": "2023-08-24T14:15:22Z",
+                "stopped_at": stopped_at,
+            }
+
+        class FakeDatasource(BaseDatasource):
+            data_driver = CircleCIDataDriver()
+
+            async def get_all_project_pipelines(self, project, since_number=None):
+                requested["since_number"].append(since_number)
+                yield [
+                    {
+                        "project": project,
+                        "id": "new_pipeline",
+                        "number": 12,
+                        "state": "created",
+                        "created_at": "2023-08-24T14:15:22Z",
+                    }
+                ]
+
+            async def get_pipeline_workflows(self, pipeline, include_unfinished=False):
+                requested["workflows"].append(pipeline.number)
+                if pipeline.number == 11:
+                    # Finished since last sync
+                    yield [workflow_data(pipeline, "finished", "2023-08-24T14:20:22Z")]
+                else:
+                    yield [workflow_data(pipeline, "still_running", None)]
+
+            async def get_workflow_jobs(self, workflow, job_filter=None):
+                yield []
+
+        mock_get_datasource_class.return_value = lambda config: FakeDatasource()
+
+        fetch_data_service = FetchDataService(
+            dbsession, {"fetch": {"incremental": incremental}}
+        )
+        await fetch_data_service.sync_project(project)
+
+        # Without incremental sync the running pipeline is listed again, but
+        # unchanged. It's synced because it was pending all the same.
+        assert requested["since_number"] == [11 if incremental else None]
+        assert sorted(requested["workflows"]) == [11, 12]
+        cursor = project.sync_cursor
+        new_pipeline = (
+            dbsession.query(models.Pipeline)
+            .filter(models.Pipeline.external_id == "new_pipeline")
+            .one()
+        )
+        assert cursor.last_pipeline_number == 12
+        assert cursor.pending_pipeline_ids == [new_pipeline.id]
+        workflows = dbsession.query(models.Workflow).all()
+        assert [workflow.external_id for workflow in workflows] == ["finished"]
+
+    @pytest.mark.asyncio
+    async def test_sync_project_against_fake_server(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        dbsession.add(project)
+        dbsession.flush()
+        history = SyntheticHistory(
+            pipelines=30, workflows_per_pipeline=2, jobs_per_workflow=4
+        )
+        server = FakeCircleCIServer(
+            history, error_rate=0.05, rate_limit_rate=0.05, retry_after=0
+        )
+        async with server:
+            config = {
+                "datasources": {
+                    "circleci": {
+                        "api_token": "some-token",
+                        "base_url": server.base_url,
+                        "retry": {"backoff_base": 0.001, "max_retries": 10},
+                    }
+                }
+            }
+            fetch_data_service = FetchDataService(dbsession, config)
+            await fetch_data_service.sync_project(project)
+            first_sync_pages = server.responses_by_status[200]
+            # The second sync only lists the newest pipelines page
+            await fetch_data_service.sync_project(project)
+
+        assert server.responses_by_status[200] == 2 + 30 + 60 + 1
+        assert server.responses_by_status[200] - first_sync_pages == 1
+        assert dbsession.query(models.Pipeline).count() == 30
+        assert dbsession.query(models.Workflow).count() == 60
+        jobs = dbsession.query(models.Job).all()
+        assert len(jobs) == 120
+        assert set(job.name for job in jobs) == {"ATS", "test"}
+        assert project.sync_cursor.last_pipeline_number == 30
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "db_writer_thread,expected_threads",
+        [(True, {"db-writer"}), (False, {"MainThread"})],
+    )
+    async def test_sync_project_db_writer_thread(
+        self, dbsession, db_writer_thread, expected_threads
+    ):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        dbsession.add(project)
+        dbsession.flush()
+        history = SyntheticHistory(
+            pipelines=3, workflows_per_pipeline=2, jobs_per_workflow=4
+        )
+        async with FakeCircleCIServer(history) as server:
+            config = {
+                "datasources": {
+                    "circleci": {"api_token": "some-token", "base_url": server.base_url}
+                },
+                "fetch": {"db_writer_thread": db_writer_thread},
+            }
+            fetch_data_service = FetchDataService(dbsession, config)
+            sync_model = fetch_data_service._sync_model
+            threads = set()
+
+            def record_thread(*args):
+                threads.add(threading.current_thread().name.split("_")[0])
+                return sync_model(*args)
+
+            with patch.object(fetch_data_service, "_sync_model", record_thread):
+                await fetch_data_service.sync_project(project)
+
+        assert threads == expected_threads
+        assert fetch_data_service._db_executor is None
+        assert dbsession.query(models.Job).count() == 12
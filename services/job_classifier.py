@@ -0,0 +1,75 @@
+import fnmatch
+import re
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Pattern, Tuple
+
+from database import models
+from database.models.enums import JobKinds, JobPatternTypes
+
+JobRule = namedtuple(
+    "JobRule", ["kind", "pattern", "pattern_type"], defaults=[JobPatternTypes.exact]
+)
+
+
+class JobClassifier(object):
+    """Tells the kind of a job (label analysis, regular tests or none) from its name.
+
+    Rules are compiled once: exact names go in a dict and glob / regex
+    patterns are tried in order. Each pattern is compiled on its own, so it
+    matches the same as it would by itself (groups, backreferences, inline
+    flags). Results are memoized since the same job names show up over and over.
+    When several rules match a name, exact names win, then the first pattern.
+    """
+
+    def __init__(self, rules: Iterable[JobRule]) -> None:
+        self.rules = list(rules)
+        self._exact: Dict[str, JobKinds] = {}
+        self._patterns: List[Tuple[Pattern, JobKinds]] = []
+        for rule in self.rules:
+            if rule.pattern_type == JobPatternTypes.exact:
+                self._exact.setdefault(rule.pattern, rule.kind)
+                continue
+            if rule.pattern_type == JobPatternTypes.glob:
+                regex = fnmatch.translate(rule.pattern)
+            else:
+                regex = rule.pattern
+            self._patterns.append((re.compile(regex), rule.kind))
+        self._cache: Dict[str, Optional[JobKinds]] = {}
+
+    @classmethod
+    def for_project(cls, project: models.Project) -> "JobClassifier":
+        """The project's job classifications or, if it has none, its single job names"""
+        if project.job_classifications:
+            return cls(
+                JobRule(item.kind, item.pattern, item.pattern_type)
+                for item in project.job_classifications
+            )
+        rules = []
+        if project.label_analysis_job_name:
+            rules.append(
+                JobRule(JobKinds.label_analysis, project.label_analysis_job_name)
+            )
+        if project.regular_tests_job_name:
+            rules.append(
+                JobRule(JobKinds.regular_tests, project.regular_tests_job_name)
+            )
+        return cls(rules)
+
+    def classify(self, name: Optional[str]) -> Optional[JobKinds]:
+        if name is None:
+            return None
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        kind = self._exact.get(name)
+        if kind is None:
+            for pattern, pattern_kind in self._patterns:
+                if pattern.fullmatch(name) is not None:
+                    kind = pattern_kind
+                    break
+        self._cache[name] = kind
+        return kind
+
+    def matches(self, name: Optional[str]) -> bool:
+        return self.classify(name) is not None
@@ -1,12 +1,55 @@
-import statistics
 from datetime import datetime
-from typing import List, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
-import matplotlib.pyplot as plt
 import numpy as np
-from sqlalchemy.orm import lazyload
+from sqlalchemy import (
+    and_,
+    case,
+    cast,
+    extract,
+    func,
+    insert,
+    or_,
+    select,
+    types,
+    update,
+)
+from sqlalchemy.orm import contains_eager, lazyload
 
 from database import models
+from database.models.enums import JobKinds, RollupGranularities
+from services.job_classifier import JobClassifier
+from services.process_data import stats
+from services.process_data.downsampling import min_max_indexes
+from services.process_data.rollups import bucket_ranges, bucket_starts
+from services.process_data.sketch import DurationSketch, calculate_grouped_sketches
+from utils.metrics import metrics
+
+# Workflow columns filled by calculate_workflow_run_durations
+WORKFLOW_RUN_COLUMNS = [
+    f"{kind.value}_{field}"
+    for kind in JobKinds
+    for field in (
+        "success",
+        "duration_seconds",
+        "total_seconds",
+        "max_seconds",
+        "job_count",
+    )
+]
+
+# Workflow columns calculate_totals summarizes
+TOTALS_COLUMNS = [
+    f"{kind.value}_{field}"
+    for kind in JobKinds
+    for field in ("success", "duration_seconds")
+]
+
+# Pipelines loaded at once by id, under SQLite's bound parameters limit
+PIPELINES_BATCH_SIZE = 500
+
+# Points drawn per series, at most
+PLOT_MAX_POINTS = 2000
 
 
 class ProcessDataService(object):
@@ -16,255 +59,816 @@ class ProcessDataService(object):
         self.config = config
         self.dbsession = dbsession
 
-    def calculate_workflow_run_durations(self, workflow: models.Workflow):
-        label_analysis_job = (
-            self.dbsession.query(models.Job)
-            .filter(
-                models.Job.workflow_id == workflow.id,
-                models.Job.name == workflow.label_analysis_job_name,
-            )
-            .first()
+    def _update_job_kinds(self, job_classifier: JobClassifier, jobs_filter) -> None:
+        """Brings jobs.kind up to date with `job_classifier`.
+        The current classification wins over the one jobs were synced with.
+        Names are classified once each, with one UPDATE per name whose kind changed."""
+        names_and_kinds = (
+            self.dbsession.query(models.Job.name, models.Job.kind)
+            .filter(jobs_filter)
+            .distinct()
+            .all()
         )
-        regular_tests_job = (
-            self.dbsession.query(models.Job)
-            .filter(
-                models.Job.workflow_id == workflow.id,
-                models.Job.name == workflow.regular_tests_job_name,
+        for name, kind in names_and_kinds:
+            new_kind = job_classifier.classify(name)
+            if new_kind == kind:
+                continue
+            self.dbsession.execute(
+                update(models.Job)
+                .where(jobs_filter, models.Job.name == name)
+                .values(kind=new_kind)
+                .execution_options(synchronize_session="fetch")
             )
-            .first()
+
+    def _job_duration_seconds(self):
+        if self.dbsession.get_bind().dialect.name == "sqlite":
+            seconds = (
+                func.julianday(models.Job.stopped_at)
+                - func.julianday(models.Job.started_at)
+            ) * 86400
+        else:
+            seconds = extract("epoch", models.Job.stopped_at - models.Job.started_at)
+        return cast(func.round(seconds), types.Integer)
+
+    def _aggregate_job_durations(self, jobs_filter) -> Dict[int, dict]:
+        """Aggregates the label analysis and regular tests jobs (shards) of
+        the workflows matching `jobs_filter` in a single GROUP BY.
+        Returns the workflows' run duration columns, by workflow id"""
+        duration = self._job_duration_seconds()
+        rows = (
+            self.dbsession.query(
+                models.Job.workflow_id,
+                models.Job.kind,
+                func.min(models.Job.started_at),
+                func.max(models.Job.stopped_at),
+                func.sum(case((models.Job.status == "success", 0), else_=1)),
+                func.sum(duration),
+                func.max(duration),
+                func.count(models.Job.id),
+            )
+            .filter(jobs_filter, models.Job.kind.isnot(None))
+            .group_by(models.Job.workflow_id, models.Job.kind)
+            .all()
         )
+        workflow_runs = {}
+        for (
+            workflow_id,
+            kind,
+            started_at,
+            stopped_at,
+            failure_count,
+            total_seconds,
+            max_seconds,
+            job_count,
+        ) in rows:
+            prefix = kind.value
+            workflow_runs.setdefault(workflow_id, {}).update(
+                {
+                    f"{prefix}_success": failure_count == 0,
+                    # Wall-clock time, from the first shard's start to the last one's end
+                    f"{prefix}_duration_seconds": int(
+                        (stopped_at - started_at).total_seconds()
+                    ),
+                    f"{prefix}_total_seconds": total_seconds,
+                    f"{prefix}_max_seconds": max_seconds,
+                    f"{prefix}_job_count": job_count,
+                }
+            )
+        return workflow_runs
+
+    def calculate_workflow_run_durations(
+        self, workflow: models.Workflow, job_classifier: JobClassifier = None
+    ):
+        """Aggregates the workflow's label analysis and regular tests jobs.
+        There can be many of each (shards)."""
+        if job_classifier is None:
+            job_classifier = JobClassifier.for_project(workflow.pipeline.project)
+        jobs_filter = models.Job.workflow_id == workflow.id
+        self._update_job_kinds(job_classifier, jobs_filter)
+        workflow_run = self._aggregate_job_durations(jobs_filter).get(workflow.id, {})
 
-        if label_analysis_job is None:
+        if f"{JobKinds.label_analysis.value}_success" not in workflow_run:
             print("LABEL ANALYSIS JOB MISSING")
-        if regular_tests_job is None:
+        if f"{JobKinds.regular_tests.value}_success" not in workflow_run:
             print("REGULAR TESTS JOB MISSING")
 
-        if label_analysis_job:
-            workflow.label_analysis_success = label_analysis_job.status == "success"
-            workflow.label_analysis_duration_seconds = (
-                label_analysis_job.stopped_at - label_analysis_job.started_at
-            ).seconds
-
-        if regular_tests_job:
-            workflow.regular_tests_success = regular_tests_job.status == "success"
-            workflow.regular_tests_duration_seconds = (
-                regular_tests_job.stopped_at - regular_tests_job.started_at
-            ).seconds
-
-        return dict(
-            label_analysis_success=workflow.label_analysis_success,
-            label_analysis_duration_seconds=workflow.label_analysis_duration_seconds,
-            regular_tests_success=workflow.regular_tests_success,
-            regular_tests_duration_seconds=workflow.regular_tests_duration_seconds,
+        for column, value in workflow_run.items():
+            setattr(workflow, column, value)
+        return {column: getattr(workflow, column) for column in WORKFLOW_RUN_COLUMNS}
+
+    def _project_workflow_ids(self, project: models.Project):
+        return (
+            select(models.Workflow.id)
+            .join(models.Pipeline, models.Workflow.pipeline_id == models.Pipeline.id)
+            .where(models.Pipeline.project_id == project.id)
         )
 
-    def calculate_statistics(self, durations: List[int]) -> dict:
-        mean_duration = statistics.mean(durations) if durations != [] else None
-        median_duration = statistics.median(durations) if durations != [] else None
-        stdev_duration = statistics.pstdev(durations) if len(durations) > 1 else None
-        deciles = (
-            statistics.quantiles(durations, n=10, method="inclusive")
-            if len(durations) > 1
-            else None
+    def update_workflow_run_durations(
+        self,
+        project: models.Project,
+        job_classifier: JobClassifier = None,
+        dirty_only: bool = False,
+    ) -> Set[int]:
+        """Same as `calculate_workflow_run_durations` for all the project's workflows
+        (or only the ones marked `metrics_dirty`), with a handful of statements
+        regardless of how many workflows there are.
+        Returns the ids of the pipelines whose workflows were recalculated."""
+        if job_classifier is None:
+            job_classifier = JobClassifier.for_project(project)
+        workflow_ids = self._project_workflow_ids(project)
+        if dirty_only:
+            workflow_ids = workflow_ids.where(models.Workflow.metrics_dirty.is_(True))
+        workflow_ids = workflow_ids.scalar_subquery()
+        pipeline_ids = set(
+            self.dbsession.scalars(
+                select(models.Workflow.pipeline_id)
+                .where(models.Workflow.id.in_(workflow_ids))
+                .distinct()
+            )
+        )
+        if not pipeline_ids:
+            return pipeline_ids
+
+        jobs_filter = models.Job.workflow_id.in_(workflow_ids)
+        self._update_job_kinds(job_classifier, jobs_filter)
+        workflow_runs = self._aggregate_job_durations(jobs_filter)
+        # Workflows (or kinds) left without classified jobs have no durations.
+        # Cleared first, then the ones that do are set by primary key.
+        self.dbsession.execute(
+            update(models.Workflow)
+            .where(models.Workflow.id.in_(workflow_ids))
+            .values(
+                metrics_dirty=False,
+                **{column: None for column in WORKFLOW_RUN_COLUMNS},
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if workflow_runs:
+            # Bulk UPDATE by primary key, batched as an executemany
+            self.dbsession.execute(
+                update(models.Workflow),
+                [
+                    dict(id=workflow_id, **workflow_run)
+                    for workflow_id, workflow_run in workflow_runs.items()
+                ],
+            )
+        # Workflows already loaded in the session don't see the bulk updates
+        for instance in list(self.dbsession.identity_map.values()):
+            if isinstance(instance, models.Workflow):
+                self.dbsession.expire(
+                    instance, [*WORKFLOW_RUN_COLUMNS, "metrics_dirty"]
+                )
+        return pipeline_ids
+
+    def get_workflow_runs_by_pipeline(
+        self, project: models.Project
+    ) -> Dict[int, List[dict]]:
+        """The project's workflow run durations, grouped by pipeline id"""
+        rows = (
+            self.dbsession.query(
+                models.Workflow.pipeline_id,
+                *[getattr(models.Workflow, column) for column in WORKFLOW_RUN_COLUMNS],
+            )
+            .filter(
+                models.Workflow.id.in_(
+                    self._project_workflow_ids(project).scalar_subquery()
+                )
+            )
+            .all()
         )
-        p90_duration = deciles[-1] if deciles else None
-        return dict(
-            mean_duration=mean_duration,
-            median_duration=median_duration,
-            stdev_duration=stdev_duration,
-            p90_duration=p90_duration,
+        workflow_runs_by_pipeline = {}
+        for pipeline_id, *values in rows:
+            workflow_runs_by_pipeline.setdefault(pipeline_id, []).append(
+                dict(zip(WORKFLOW_RUN_COLUMNS, values))
+            )
+        return workflow_runs_by_pipeline
+
+    def calculate_project_workflow_run_durations(
+        self, project: models.Project, job_classifier: JobClassifier = None
+    ) -> Dict[int, List[dict]]:
+        """Recalculates all the project's workflows.
+        Returns the workflow run durations grouped by pipeline id."""
+        self.update_workflow_run_durations(project, job_classifier)
+        return self.get_workflow_runs_by_pipeline(project)
+
+    def calculate_statistics(self, durations: List[int]) -> dict:
+        return stats.calculate_statistics(durations)
+
+    def _set_totals(
+        self, totals: models.Totals, totals_by_kind: Dict[JobKinds, dict]
+    ) -> models.Totals:
+        for kind, kind_totals in totals_by_kind.items():
+            for key, value in kind_totals.items():
+                setattr(totals, f"{kind.value}_{key}", value)
+        return totals
+
+    def _save_totals(
+        self,
+        parent_model: Union[models.Pipeline, models.Project],
+        totals_by_kind: Dict[JobKinds, dict],
+    ) -> models.Totals:
+        """Updates the parent model's totals in place, creating them the first time"""
+        totals = parent_model.totals
+        if totals is None:
+            totals = models.Totals()
+            self.dbsession.add(totals)
+            parent_model.totals = totals
+        return self._set_totals(totals, totals_by_kind)
+
+    def _calculate_totals_by_group(
+        self, group_ids: np.ndarray, columns: Dict[str, np.ndarray], groups: List[int]
+    ) -> Dict[int, Dict[JobKinds, dict]]:
+        """Totals of each of `groups` by kind, with the sketch of their successful durations"""
+        totals_by_group = {group: {} for group in groups}
+        for kind in JobKinds:
+            success = columns[f"{kind.value}_success"]
+            durations = columns[f"{kind.value}_duration_seconds"]
+            kind_totals = stats.calculate_grouped_totals(
+                group_ids, success, durations, groups=groups
+            )
+            with_duration = (success == 1) & ~np.isnan(durations)
+            sketches = calculate_grouped_sketches(
+                group_ids[with_duration], durations[with_duration]
+            )
+            for group in groups:
+                duration_sketch = sketches.get(group) or DurationSketch()
+                totals_by_group[group][kind] = dict(
+                    kind_totals[group], duration_sketch=duration_sketch.to_bytes()
+                )
+        return totals_by_group
+
+    def calculate_grouped_totals(
+        self,
+        parent_models: List[Union[models.Pipeline, models.Project]],
+        group_ids: np.ndarray,
+        columns: Dict[str, np.ndarray],
+    ) -> None:
+        """Saves the totals of each of `parent_models`, calculated at once.
+        `group_ids` tells which parent model (by id) each workflow run belongs to,
+        `columns` has the workflow runs' `<kind>_success` and `<kind>_duration_seconds`."""
+        totals_by_group = self._calculate_totals_by_group(
+            group_ids, columns, [parent_model.id for parent_model in parent_models]
         )
+        for parent_model in parent_models:
+            self._save_totals(parent_model, totals_by_group[parent_model.id])
 
     def calculate_totals(
         self,
         parent_model: Union[models.Pipeline, models.Project],
         workflow_run_durations: List[dict],
     ):
-        totals = models.Totals()
-        label_analysis_success = list(
-            filter(
-                lambda item: item["label_analysis_success"] == True,
-                workflow_run_durations,
+        columns = _to_columns(workflow_run_durations, TOTALS_COLUMNS)
+        group_ids = np.zeros(len(workflow_run_durations), dtype=np.int64)
+        totals_by_group = self._calculate_totals_by_group(group_ids, columns, [0])
+        return self._save_totals(parent_model, totals_by_group[0])
+
+    def merge_totals(
+        self,
+        totals_list: Iterable[models.Totals],
+        removed: Iterable[models.Totals] = (),
+    ) -> Dict[JobKinds, dict]:
+        """Totals of all the workflow runs of `totals_list`, minus the ones of `removed`,
+        from their counts and duration sketches only.
+        Mean and stdev are exact, median and p90 within the sketches' accuracy."""
+        totals_list = list(totals_list)
+        removed = list(removed)
+        totals_by_kind = {}
+        for kind in JobKinds:
+            prefix = kind.value
+            success_count = failure_count = 0
+            duration_sketch = DurationSketch()
+            for sign, merged_list in ((1, totals_list), (-1, removed)):
+                for totals in merged_list:
+                    success_count += sign * (
+                        getattr(totals, f"{prefix}_success_count") or 0
+                    )
+                    failure_count += sign * (
+                        getattr(totals, f"{prefix}_failure_count") or 0
+                    )
+                    other = DurationSketch.from_bytes(
+                        getattr(totals, f"{prefix}_duration_sketch")
+                    )
+                    if sign > 0:
+                        duration_sketch.merge(other)
+                    else:
+                        duration_sketch.subtract(other)
+            totals_by_kind[kind] = dict(
+                success_count=success_count,
+                failure_count=failure_count,
+                **duration_sketch.statistics(),
+                duration_sketch=duration_sketch.to_bytes(),
             )
+        return totals_by_kind
+
+    def get_pipeline_totals(
+        self,
+        project: models.Project,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> List[models.Totals]:
+        """Totals of the project's pipelines, created in [since, until) if given"""
+        query = (
+            self.dbsession.query(models.Totals)
+            .join(models.Pipeline, models.Pipeline.totals_id == models.Totals.id)
+            .filter(models.Pipeline.project_id == project.id)
+        )
+        if since is not None:
+            query = query.filter(models.Pipeline.created_at >= since)
+        if until is not None:
+            query = query.filter(models.Pipeline.created_at < until)
+        return query.all()
+
+    def calculate_window_totals(
+        self,
+        project: models.Project,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> models.Totals:
+        """Totals of the project's pipelines created in [since, until), merged from
+        the pipelines' totals. They are not saved.
+        Pipeline totals are up to date after `sync_project_metrics`."""
+        return self._set_totals(
+            models.Totals(),
+            self.merge_totals(self.get_pipeline_totals(project, since, until)),
+        )
+
+    def get_workflow_run_columns(
+        self, project: models.Project, pipeline_ids: Optional[List[int]] = None
+    ):
+        """The project's workflow runs as NumPy columns, for calculating totals.
+        Only the runs of `pipeline_ids`, if given.
+        Returns the runs' pipeline ids and the `TOTALS_COLUMNS`, with NaN for NULL."""
+        query = self.dbsession.query(
+            models.Workflow.pipeline_id,
+            *[getattr(models.Workflow, column) for column in TOTALS_COLUMNS],
         )
-        label_analysis_fail = list(
-            filter(
-                lambda item: item["label_analysis_success"] == False,
-                workflow_run_durations,
+        if pipeline_ids is None:
+            rows = query.filter(
+                models.Workflow.id.in_(
+                    self._project_workflow_ids(project).scalar_subquery()
+                )
+            ).all()
+        else:
+            rows = []
+            for offset in range(0, len(pipeline_ids), PIPELINES_BATCH_SIZE):
+                rows.extend(
+                    query.filter(
+                        models.Workflow.pipeline_id.in_(
+                            pipeline_ids[offset : offset + PIPELINES_BATCH_SIZE]
+                        )
+                    ).all()
+                )
+        pipeline_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        columns = {
+            column: np.array([row[idx] for row in rows], dtype=float)
+            for idx, column in enumerate(TOTALS_COLUMNS, start=1)
+        }
+        return pipeline_ids, columns
+
+    def sync_project_metrics(self, project: models.Project, full: bool = False):
+        """Recalculates the workflows synced since the last run (all of them if `full`),
+        then the totals of their pipelines and the rollups of the time buckets they
+        started in. The project totals are updated from the pipelines' totals,
+        without going through the workflow runs again.
+        Changing the project's job classification needs a `full` run."""
+        with metrics.timer("process_phase_seconds", phase="workflow_runs"):
+            updated_pipeline_ids = self.update_workflow_run_durations(
+                project, dirty_only=not full
             )
+        with metrics.timer("process_phase_seconds", phase="rollups"):
+            if full or not self._has_rollups(project):
+                self.sync_rollups(project)
+            elif updated_pipeline_ids:
+                self.sync_rollups(project, updated_pipeline_ids)
+        with metrics.timer("process_phase_seconds", phase="totals"):
+            self._sync_totals(project, updated_pipeline_ids, full)
+
+    def _sync_totals(
+        self, project: models.Project, updated_pipeline_ids: Set[int], full: bool
+    ) -> None:
+        project_totals = project.totals
+        # Totals from before duration sketches can't be merged
+        has_sketches = (
+            project_totals is not None
+            and project_totals.label_analysis_duration_sketch is not None
         )
-        label_analysis_success_durations = list(
-            map(
-                lambda item: item["label_analysis_duration_seconds"],
-                label_analysis_success,
+        pipelines_query = (
+            self.dbsession.query(models.Pipeline)
+            .outerjoin(models.Pipeline.totals)
+            .options(
+                lazyload(models.Pipeline.workflows),
+                contains_eager(models.Pipeline.totals),
             )
         )
-        totals.label_analysis_success_count = len(label_analysis_success)
-        totals.label_analysis_failure_count = len(label_analysis_fail)
-        label_analysis_statistics = self.calculate_statistics(
-            label_analysis_success_durations
+        # Pipelines without totals are new, or have no workflows at all
+        pipelines = pipelines_query.filter(
+            models.Pipeline.project_id == project.id,
+            or_(
+                models.Pipeline.totals_id.is_(None),
+                models.Totals.label_analysis_duration_sketch.is_(None),
+            ),
+        ).all()
+        if not pipelines and not updated_pipeline_ids and has_sketches:
+            return
+        pipeline_ids = sorted(
+            updated_pipeline_ids - set(pipeline.id for pipeline in pipelines)
         )
-        totals.label_analysis_mean_duration = label_analysis_statistics["mean_duration"]
-        totals.label_analysis_median_duration = label_analysis_statistics[
-            "median_duration"
-        ]
-        totals.label_analysis_stdev_duration = label_analysis_statistics[
-            "stdev_duration"
-        ]
-        totals.label_analysis_p90_duration = label_analysis_statistics["p90_duration"]
-
-        regular_tests_success = list(
-            filter(
-                lambda item: item["regular_tests_success"] == True,
-                workflow_run_durations,
+        for offset in range(0, len(pipeline_ids), PIPELINES_BATCH_SIZE):
+            pipelines.extend(
+                pipelines_query.filter(
+                    models.Pipeline.id.in_(
+                        pipeline_ids[offset : offset + PIPELINES_BATCH_SIZE]
+                    )
+                ).all()
             )
+        metrics.inc("pipeline_totals_calculated_total", len(pipelines))
+        incremental = not full and has_sketches
+        if incremental:
+            # Totals are updated in place, the previous ones are subtracted below
+            previous_totals = [
+                _copy_totals(pipeline.totals)
+                for pipeline in pipelines
+                if pipeline.totals is not None
+            ]
+
+        run_pipeline_ids, columns = self.get_workflow_run_columns(
+            project, None if full else [pipeline.id for pipeline in pipelines]
         )
-        regular_tests_fail = list(
-            filter(
-                lambda item: item["regular_tests_success"] == False,
-                workflow_run_durations,
+        self.calculate_grouped_totals(pipelines, run_pipeline_ids, columns)
+
+        if incremental:
+            # Swaps the recalculated pipelines' previous totals for their new ones
+            project_totals = self.merge_totals(
+                [project_totals, *(pipeline.totals for pipeline in pipelines)],
+                removed=previous_totals,
             )
-        )
-        regular_tests_success_durations = list(
-            map(
-                lambda item: item["regular_tests_duration_seconds"],
-                regular_tests_success,
+        else:
+            project_totals = self.merge_totals(self.get_pipeline_totals(project))
+        self._save_totals(project, project_totals)
+
+    def _get_workflow_started_at(self, pipeline_ids: List[int]) -> np.ndarray:
+        started_at = []
+        for offset in range(0, len(pipeline_ids), PIPELINES_BATCH_SIZE):
+            started_at.extend(
+                self.dbsession.scalars(
+                    select(models.Workflow.started_at)
+                    .where(
+                        models.Workflow.pipeline_id.in_(
+                            pipeline_ids[offset : offset + PIPELINES_BATCH_SIZE]
+                        ),
+                        models.Workflow.started_at.isnot(None),
+                    )
+                    .distinct()
+                )
             )
-        )
-        totals.regular_tests_success_count = len(regular_tests_success)
-        totals.regular_tests_failure_count = len(regular_tests_fail)
-        regular_tests_statistics = self.calculate_statistics(
-            regular_tests_success_durations
-        )
-        totals.regular_tests_mean_duration = regular_tests_statistics["mean_duration"]
-        totals.regular_tests_median_duration = regular_tests_statistics[
-            "median_duration"
-        ]
-        totals.regular_tests_stdev_duration = regular_tests_statistics["stdev_duration"]
-        totals.regular_tests_p90_duration = regular_tests_statistics["p90_duration"]
-
-        self.dbsession.add(totals)
-        parent_model.totals = totals
-        return totals
+        return np.array(started_at, dtype="datetime64[s]")
 
-    def sync_project_metrics(self, project: models.Project):
-        # Traverse the "tree" of pipelines and workflows in the project
-        # And work our way up updating the data
-        # We don't go down branches that are already calculated
-        pipelines = (
-            self.dbsession.query(models.Pipeline)
-            .options(lazyload(models.Pipeline.workflows))
-            .filter(models.Pipeline.project_id == project.id)
-            .all()
+    def _get_rollup_run_columns(
+        self,
+        project: models.Project,
+        ranges: Optional[List[Tuple[datetime, datetime]]] = None,
+    ):
+        """The project's workflow runs that started in one of the [start, end) `ranges`,
+        or all of them. Returns when they started, as datetime64, and the `TOTALS_COLUMNS`"""
+        query = (
+            self.dbsession.query(
+                models.Workflow.started_at,
+                *[getattr(models.Workflow, column) for column in TOTALS_COLUMNS],
+            )
+            .join(models.Pipeline, models.Workflow.pipeline_id == models.Pipeline.id)
+            .filter(
+                models.Pipeline.project_id == project.id,
+                models.Workflow.started_at.isnot(None),
+            )
         )
-        project_workflow_runs = []
-        for pipeline in pipelines:
-            workflow_runs = []
-            workflows = (
-                self.dbsession.query(models.Workflow)
-                .options(lazyload(models.Workflow.jobs))
-                .filter(
-                    models.Workflow.pipeline_id == pipeline.id,
+        if ranges is not None:
+            query = query.filter(
+                or_(
+                    *[
+                        and_(
+                            models.Workflow.started_at >= start,
+                            models.Workflow.started_at < end,
+                        )
+                        for start, end in ranges
+                    ]
                 )
-                .all()
-            )
-            for workflow in workflows:
-                workflow_run_durations = self.calculate_workflow_run_durations(workflow)
-                workflow_runs.append(workflow_run_durations)
-            self.calculate_totals(pipeline, workflow_runs)
-            project_workflow_runs.extend(workflow_runs)
-        self.calculate_totals(project, project_workflow_runs)
-
-    def plot_workflow_durations(self, project: models.Project):
-        # Get all the workflows for a project
-        pipeline_id_rows = (
-            self.dbsession.query(models.Pipeline.id)
-            .filter(models.Pipeline.project_id == project.id)
-            .all()
+            )
+        rows = query.all()
+        started_at = np.array([row[0] for row in rows], dtype="datetime64[s]")
+        columns = {
+            column: np.array([row[idx] for row in rows], dtype=float)
+            for idx, column in enumerate(TOTALS_COLUMNS, start=1)
+        }
+        return started_at, columns
+
+    def _update_rollups(
+        self,
+        project: models.Project,
+        granularity: RollupGranularities,
+        starts: np.ndarray,
+        columns: Dict[str, np.ndarray],
+        affected_starts: Optional[Set[datetime]] = None,
+    ) -> None:
+        """Updates the rollups of the buckets the runs `starts` in, or of `affected_starts`.
+        Rollups of affected buckets left without runs are deleted."""
+        if affected_starts is not None:
+            # The runs loaded are the ones of whole weeks
+            in_affected = np.isin(
+                starts, np.array(sorted(affected_starts), dtype="datetime64[s]")
+            )
+            starts = starts[in_affected]
+            columns = {
+                column: values[in_affected] for column, values in columns.items()
+            }
+        buckets, group_ids = np.unique(starts, return_inverse=True)
+        buckets = buckets.tolist()
+
+        existing = {}
+        if affected_starts:
+            rollups = self.dbsession.query(models.DurationRollup).filter(
+                models.DurationRollup.project_id == project.id,
+                models.DurationRollup.granularity == granularity,
+                models.DurationRollup.bucket_start >= min(affected_starts),
+                models.DurationRollup.bucket_start <= max(affected_starts),
+            )
+            existing = {
+                (rollup.bucket_start, rollup.kind): rollup for rollup in rollups
+            }
+
+        new_rollups = []
+        for kind in JobKinds:
+            success = columns[f"{kind.value}_success"]
+            durations = columns[f"{kind.value}_duration_seconds"]
+            success_counts = np.bincount(
+                group_ids, weights=success == 1, minlength=len(buckets)
+            )
+            failure_counts = np.bincount(
+                group_ids, weights=success == 0, minlength=len(buckets)
+            )
+            with_duration = (success == 1) & ~np.isnan(durations)
+            sketches = calculate_grouped_sketches(
+                group_ids[with_duration], durations[with_duration]
+            )
+            for idx, bucket_start in enumerate(buckets):
+                if not success_counts[idx] and not failure_counts[idx]:
+                    continue
+                duration_sketch = sketches.get(idx) or DurationSketch()
+                values = dict(
+                    success_count=int(success_counts[idx]),
+                    failure_count=int(failure_counts[idx]),
+                    duration_count=duration_sketch.count,
+                    duration_sum=duration_sketch.sum,
+                    duration_sum_of_squares=duration_sketch.sum_of_squares,
+                    duration_sketch=duration_sketch.to_bytes(),
+                )
+                rollup = existing.pop((bucket_start, kind), None)
+                if rollup is None:
+                    new_rollups.append(
+                        dict(
+                            project_id=project.id,
+                            granularity=granularity,
+                            bucket_start=bucket_start,
+                            kind=kind,
+                            **values,
+                        )
+                    )
+                    continue
+                for key, value in values.items():
+                    setattr(rollup, key, value)
+
+        # In a single executemany. Added one by one, the ORM inserts them
+        # one statement each to get their ids back.
+        if new_rollups:
+            self.dbsession.execute(insert(models.DurationRollup), new_rollups)
+        for (bucket_start, _), rollup in existing.items():
+            if bucket_start in affected_starts:
+                self.dbsession.delete(rollup)
+
+    def sync_rollups(
+        self, project: models.Project, pipeline_ids: Optional[Iterable[int]] = None
+    ) -> None:
+        """Recalculates the project's duration rollups of the buckets the workflows
+        of `pipeline_ids` started in, or all of them.
+        Only the runs of the affected weeks are loaded."""
+        affected_starts = None
+        if pipeline_ids is None:
+            self.dbsession.query(models.DurationRollup).filter(
+                models.DurationRollup.project_id == project.id
+            ).delete(synchronize_session="fetch")
+            started_at, columns = self._get_rollup_run_columns(project)
+        else:
+            changed_started_at = self._get_workflow_started_at(sorted(pipeline_ids))
+            if not len(changed_started_at):
+                return
+            affected_starts = {
+                granularity: set(
+                    bucket_starts(changed_started_at, granularity).tolist()
+                )
+                for granularity in RollupGranularities
+            }
+            started_at, columns = self._get_rollup_run_columns(
+                project,
+                bucket_ranges(
+                    affected_starts[RollupGranularities.week],
+                    RollupGranularities.week,
+                ),
+            )
+        for granularity in RollupGranularities:
+            self._update_rollups(
+                project,
+                granularity,
+                bucket_starts(started_at, granularity),
+                columns,
+                None if affected_starts is None else affected_starts[granularity],
+            )
+
+    def _has_rollups(self, project: models.Project) -> bool:
+        return self.dbsession.query(
+            self.dbsession.query(models.DurationRollup)
+            .filter(models.DurationRollup.project_id == project.id)
+            .exists()
+        ).scalar()
+
+    def get_duration_trends(
+        self,
+        project: models.Project,
+        granularity: RollupGranularities = RollupGranularities.day,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Dict[JobKinds, List[dict]]:
+        """Totals of each bucket with runs, by kind and in time order, from the rollups.
+        `since` and `until` select the buckets by their start."""
+        query = self.dbsession.query(models.DurationRollup).filter(
+            models.DurationRollup.project_id == project.id,
+            models.DurationRollup.granularity == granularity,
         )
-        pipeline_ids = [row[0] for row in pipeline_id_rows]
-        workflows = (
-            self.dbsession.query(models.Workflow)
-            .options(lazyload(models.Workflow.jobs))
-            .filter(models.Workflow.pipeline_id.in_(pipeline_ids))
+        if since is not None:
+            query = query.filter(models.DurationRollup.bucket_start >= since)
+        if until is not None:
+            query = query.filter(models.DurationRollup.bucket_start < until)
+        trends = {kind: [] for kind in JobKinds}
+        for rollup in query.order_by(models.DurationRollup.bucket_start):
+            trends[rollup.kind].append(
+                dict(
+                    bucket_start=rollup.bucket_start,
+                    success_count=rollup.success_count,
+                    failure_count=rollup.failure_count,
+                    **DurationSketch.from_bytes(rollup.duration_sketch).statistics(),
+                )
+            )
+        return trends
+
+    def get_workflow_durations(
+        self, project: models.Project
+    ) -> Tuple[np.ndarray, Dict[JobKinds, np.ndarray]]:
+        """When each of the project's workflows started, as datetime64, in order,
+        and their durations by kind, with NaN where there's none."""
+        rows = (
+            self.dbsession.query(
+                models.Workflow.started_at,
+                *[
+                    getattr(models.Workflow, f"{kind.value}_duration_seconds")
+                    for kind in JobKinds
+                ],
+            )
+            .join(models.Pipeline, models.Workflow.pipeline_id == models.Pipeline.id)
+            .filter(
+                models.Pipeline.project_id == project.id,
+                models.Workflow.started_at.isnot(None),
+            )
+            .order_by(models.Workflow.started_at)
             .all()
         )
-        # Sort by date
-        workflows.sort(key=lambda item: item.started_at)
-        # Extract data for plotting
-        dates = [workflow.started_at for workflow in workflows]
-        label_analysis_durations = [
-            workflow.label_analysis_duration_seconds for workflow in workflows
-        ]
-        regular_tests_durations = [
-            workflow.regular_tests_duration_seconds for workflow in workflows
-        ]
-
-        # Convert dates to a more suitable format for plotting (e.g., matplotlib's internal date representation)
-        dates_numeric = [datetime.timestamp(date) for date in dates]
-
-        zipped_data = zip(
-            dates_numeric, label_analysis_durations, regular_tests_durations
-        )
-        zipped_data = list(
-            filter(
-                lambda item: item[0] is not None
-                and item[1] is not None
-                and item[2] is not None,
-                zipped_data,
+        started_at = np.array([row[0] for row in rows], dtype="datetime64[s]")
+        durations = {
+            kind: np.array([row[idx] for row in rows], dtype=float)
+            for idx, kind in enumerate(JobKinds, start=1)
+        }
+        return started_at, durations
+
+    def plot_workflow_durations(
+        self,
+        project: models.Project,
+        granularity: RollupGranularities = RollupGranularities.day,
+        output_path: Optional[str] = None,
+        points: bool = False,
+        max_points: int = PLOT_MAX_POINTS,
+    ):
+        """Plots the mean and p90 durations of each bucket, from the rollups, and
+        with `points` the duration of every workflow run too.
+        Series longer than `max_points` are downsampled, keeping the min and max.
+        Shows the plot or, with `output_path`, renders it without a display
+        to a PNG / SVG file (the format comes from the extension)."""
+        with metrics.timer("process_phase_seconds", phase="plot"):
+            self._plot_workflow_durations(
+                project, granularity, output_path, points, max_points
             )
-        )
 
-        dates_numeric = [item[0] for item in zipped_data]
-        label_analysis_durations = [item[1] for item in zipped_data]
-        regular_tests_durations = [item[2] for item in zipped_data]
+    def _plot_workflow_durations(
+        self,
+        project: models.Project,
+        granularity: RollupGranularities,
+        output_path: Optional[str],
+        points: bool,
+        max_points: int,
+    ):
+        trends = self.get_duration_trends(project, granularity)
 
-        # Create a new figure and set axis labels
-        plt.figure(figsize=(10, 6))
-        plt.xlabel("Date")
-        plt.ylabel("Duration (seconds)")
+        if output_path is None:
+            figure = _pyplot().figure(figsize=(10, 6))
+        else:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
 
-        # Plot the data
-        plt.scatter(
-            dates_numeric, label_analysis_durations, marker="o", label="Label Analysis"
-        )
-        plt.scatter(
-            dates_numeric, regular_tests_durations, marker="o", label="Regular Tests"
-        )
-        # Calculate trend lines
-        label_analysis_trend = np.polyfit(dates_numeric, label_analysis_durations, 5)
-        plottable_trend = np.poly1d(label_analysis_trend)
-        plt.plot(dates_numeric, plottable_trend(dates_numeric))
+            # Agg canvas, so no display and no pyplot global state
+            figure = Figure(figsize=(10, 6))
+            FigureCanvasAgg(figure)
+        axes = figure.add_subplot()
+        axes.set_xlabel("Date")
+        axes.set_ylabel("Duration (seconds)")
 
-        regular_tests_trend = np.polyfit(dates_numeric, regular_tests_durations, 5)
-        plottable_trend = np.poly1d(regular_tests_trend)
-        plt.plot(dates_numeric, plottable_trend(dates_numeric))
+        if points:
+            started_at, durations = self.get_workflow_durations(project)
+        for kind, label in (
+            (JobKinds.label_analysis, "Label Analysis"),
+            (JobKinds.regular_tests, "Regular Tests"),
+        ):
+            buckets = [
+                item for item in trends[kind] if item["mean_duration"] is not None
+            ]
+            dates = np.array(
+                [item["bucket_start"] for item in buckets], dtype="datetime64[s]"
+            )
+            means = np.array([item["mean_duration"] for item in buckets], dtype=float)
+            # None (less than 2 runs) leaves a gap
+            p90s = np.array([item["p90_duration"] for item in buckets], dtype=float)
+            keep = min_max_indexes(dates.astype(np.int64), means, max_points)
+            (line,) = axes.plot(
+                dates[keep], means[keep], marker="o", label=f"{label} (mean)"
+            )
+            axes.plot(
+                dates[keep],
+                p90s[keep],
+                linestyle="--",
+                color=line.get_color(),
+                label=f"{label} (p90)",
+            )
+            if points:
+                has_duration = ~np.isnan(durations[kind])
+                kind_started_at = started_at[has_duration]
+                kind_durations = durations[kind][has_duration]
+                keep = min_max_indexes(
+                    kind_started_at.astype(np.int64), kind_durations, max_points
+                )
+                axes.scatter(
+                    kind_started_at[keep],
+                    kind_durations[keep],
+                    s=4,
+                    alpha=0.3,
+                    color=line.get_color(),
+                )
 
         # Add a legend
-        plt.legend()
-
-        # Set the x-axis ticks as dates
-        # Aggregate dates that are less than 1d appart
-        label_ticks = [datetime.fromtimestamp(dates_numeric[0])]
-        numeric_ticks = [dates_numeric[0]]
-        TWELVE_HOURS = 12 * 60 * 60
-        for date in dates_numeric[1:]:
-            if (datetime.fromtimestamp(date) - label_ticks[-1]).seconds >= TWELVE_HOURS:
-                label_ticks.append(datetime.fromtimestamp(date))
-                numeric_ticks.append(date)
-        plt.xticks(
-            numeric_ticks,
-            [date.strftime("%Y-%m-%D") for date in label_ticks],
-            rotation=45,
-            ha="right",
-        )
+        axes.legend()
+        figure.autofmt_xdate()
 
         # Set a title
-        plt.title("Label Analysis vs Regular Tests Durations Over Time")
-        plt.suptitle(
+        axes.set_title(
+            f"Label Analysis vs Regular Tests Durations per {granularity.value}"
+        )
+        figure.suptitle(
             f"{project.organization.name}/{project.name} - {project.ci_provider.value}"
         )
 
-        # Show the plot
-        plt.tight_layout()
-        plt.show()
+        figure.tight_layout()
+        if output_path is None:
+            # Show the plot
+            _pyplot().show()
+        else:
+            figure.savefig(output_path)
+
+
+def _pyplot():
+    # matplotlib takes a while to import, and is only needed to plot
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def _to_columns(rows: List[dict], columns: List[str]) -> Dict[str, np.ndarray]:
+    # None becomes NaN
+    return {
+        column: np.array([row[column] for row in rows], dtype=float)
+        for column in columns
+    }
+
+
+def _copy_totals(totals: models.Totals) -> models.Totals:
+    # Not added to the session
+    return models.Totals(
+        **{
+            column.key: getattr(totals, column.key)
+            for column in models.Totals.__table__.columns
+            if not column.primary_key
+        }
+    )
@@ -0,0 +1,23 @@
+import numpy as np
+
+
+def min_max_indexes(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """Indexes of the points to draw of the series (`x` sorted, `y` without NaN),
+    at most `max_points` of them: the min and max `y` of as many bins of equal
+    `x` width, so peaks and outliers stay visible. In `x` order."""
+    if len(x) <= max_points:
+        return np.arange(len(x))
+    bin_count = max(max_points // 2, 1)
+    x = np.asarray(x, dtype=float)
+    span = x[-1] - x[0]
+    if span > 0:
+        bins = ((x - x[0]) / span * bin_count).astype(np.int64)
+        bins = np.minimum(bins, bin_count - 1)
+    else:
+        bins = np.zeros(len(x), dtype=np.int64)
+    # Sorted by bin, then y: each bin's min comes first and its max last
+    order = np.lexsort((y, bins))
+    sorted_bins = bins[order]
+    firsts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    lasts = np.r_[firsts[1:] - 1, len(order) - 1]
+    return np.unique(np.concatenate([order[firsts], order[lasts]]))
@@ -0,0 +1,42 @@
+"""Time buckets of the duration rollups"""
+from datetime import datetime, timedelta
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from database.models.enums import RollupGranularities
+
+BUCKET_LENGTHS = {
+    RollupGranularities.hour: timedelta(hours=1),
+    RollupGranularities.day: timedelta(days=1),
+    RollupGranularities.week: timedelta(weeks=1),
+}
+
+
+def bucket_starts(
+    started_at: np.ndarray, granularity: RollupGranularities
+) -> np.ndarray:
+    """Start of the bucket of each datetime64 in `started_at`.
+    Weeks start on Monday."""
+    if granularity == RollupGranularities.hour:
+        return started_at.astype("datetime64[h]").astype("datetime64[s]")
+    days = started_at.astype("datetime64[D]")
+    if granularity == RollupGranularities.week:
+        # 1970-01-01 was a Thursday, 3 days after a Monday
+        days = days - (days.astype(np.int64) + 3) % 7
+    return days.astype("datetime64[s]")
+
+
+def bucket_ranges(
+    starts: Iterable[datetime], granularity: RollupGranularities
+) -> List[Tuple[datetime, datetime]]:
+    """[start, end) ranges covering the buckets starting at `starts`,
+    with consecutive buckets merged"""
+    length = BUCKET_LENGTHS[granularity]
+    ranges = []
+    for start in sorted(starts):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], start + length)
+        else:
+            ranges.append((start, start + length))
+    return ranges
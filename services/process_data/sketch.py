@@ -0,0 +1,265 @@
+"""Mergeable duration sketches, stored with the totals they summarize.
+
+A `DurationSketch` is a DDSketch: durations are counted in logarithmic bins,
+so quantiles are within `relative_accuracy` of the real ones and two sketches
+are merged by adding up their bins. It also keeps the count, sum and sum of
+squares, so mean and stdev of merged sketches are exact.
+Project (or any time window) totals merge their pipelines' sketches instead
+of going through every workflow run again.
+"""
+import math
+import struct
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+FORMAT_VERSION = 1
+# version, relative accuracy, count, zero count, sum, sum of squares,
+# min, max, number of bins. Then the bins' indexes and counts.
+_HEADER = struct.Struct("<BdQQddddI")
+_INDEX_DTYPE = np.dtype("<i4")
+_COUNT_DTYPE = np.dtype("<u4")
+
+
+class DurationSketch(object):
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # Bin i counts the durations in (gamma^(i-1), gamma^i]
+        self.bins: Dict[int, int] = {}
+        # Durations of 0s (or less) have no bin
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_of_squares = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def _indexes(self, durations: np.ndarray) -> np.ndarray:
+        return np.ceil(np.log(durations) / self._log_gamma).astype(np.int64)
+
+    def _value(self, index: int) -> float:
+        # Middle of the bin, relative to its bounds
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def add(self, durations: Iterable[float]) -> "DurationSketch":
+        durations = np.asarray(list(durations), dtype=float)
+        durations = durations[~np.isnan(durations)]
+        if len(durations) == 0:
+            return self
+        positive = durations[durations > 0]
+        indexes, counts = np.unique(self._indexes(positive), return_counts=True)
+        self._add_parts(
+            bins=zip(indexes.tolist(), counts.tolist()),
+            zero_count=len(durations) - len(positive),
+            count=len(durations),
+            total=float(durations.sum()),
+            total_of_squares=float((durations * durations).sum()),
+            minimum=float(durations.min()),
+            maximum=float(durations.max()),
+        )
+        return self
+
+    def _add_parts(
+        self, bins, zero_count, count, total, total_of_squares, minimum, maximum
+    ) -> None:
+        for index, bin_count in bins:
+            self.bins[index] = self.bins.get(index, 0) + bin_count
+        self.zero_count += zero_count
+        self.count += count
+        self.sum += total
+        self.sum_of_squares += total_of_squares
+        if minimum is not None:
+            self.min = minimum if self.min is None else min(self.min, minimum)
+        if maximum is not None:
+            self.max = maximum if self.max is None else max(self.max, maximum)
+
+    def _check_compatible(self, other: "DurationSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(
+                f"Can't merge sketches with relative accuracy {other.relative_accuracy}"
+                f" into one with {self.relative_accuracy}"
+            )
+
+    def merge(self, other: "DurationSketch") -> "DurationSketch":
+        self._check_compatible(other)
+        self._add_parts(
+            other.bins.items(),
+            other.zero_count,
+            other.count,
+            other.sum,
+            other.sum_of_squares,
+            other.min,
+            other.max,
+        )
+        return self
+
+    def subtract(self, other: "DurationSketch") -> "DurationSketch":
+        """Removes the durations of `other`, which must have been merged in before.
+        min and max can't be recovered, they stay as (looser) bounds."""
+        self._check_compatible(other)
+        for index, bin_count in other.bins.items():
+            remaining = self.bins.get(index, 0) - bin_count
+            if remaining < 0:
+                raise ValueError("Can't subtract a sketch that wasn't merged in")
+            if remaining:
+                self.bins[index] = remaining
+            else:
+                self.bins.pop(index, None)
+        self.zero_count -= other.zero_count
+        self.count -= other.count
+        self.sum -= other.sum
+        self.sum_of_squares -= other.sum_of_squares
+        if self.count == 0:
+            self.sum = self.sum_of_squares = 0.0
+            self.min = self.max = None
+        return self
+
+    @property
+    def mean(self) -> Optional[float]:
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    @property
+    def stdev(self) -> Optional[float]:
+        """Population stdev"""
+        if self.count == 0:
+            return None
+        mean = self.sum / self.count
+        return math.sqrt(max(self.sum_of_squares / self.count - mean**2, 0))
+
+    def quantile(self, quantile: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = quantile * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0)
+        cumulative = self.zero_count
+        value = self.max
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                value = self._value(index)
+                break
+        return min(max(value, self.min), self.max)
+
+    def statistics(self, percentiles: Iterable[int] = (90,)) -> dict:
+        """Same keys as `stats.calculate_statistics`.
+        Mean and stdev are exact, median and percentiles within the relative accuracy"""
+        has_spread = self.count > 1
+        return dict(
+            mean_duration=self.mean,
+            median_duration=self.quantile(0.5),
+            stdev_duration=self.stdev if has_spread else None,
+            **{
+                f"p{percentile}_duration": self.quantile(percentile / 100)
+                if has_spread
+                else None
+                for percentile in percentiles
+            },
+        )
+
+    def to_bytes(self) -> bytes:
+        indexes = sorted(self.bins)
+        return b"".join(
+            (
+                _HEADER.pack(
+                    FORMAT_VERSION,
+                    self.relative_accuracy,
+                    self.count,
+                    self.zero_count,
+                    self.sum,
+                    self.sum_of_squares,
+                    math.nan if self.min is None else self.min,
+                    math.nan if self.max is None else self.max,
+                    len(indexes),
+                ),
+                np.array(indexes, dtype=_INDEX_DTYPE).tobytes(),
+                np.array(
+                    [self.bins[index] for index in indexes], _COUNT_DTYPE
+                ).tobytes(),
+            )
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DurationSketch":
+        (
+            version,
+            relative_accuracy,
+            count,
+            zero_count,
+            total,
+            total_of_squares,
+            minimum,
+            maximum,
+            bin_count,
+        ) = _HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unknown sketch format version {version}")
+        sketch = cls(relative_accuracy)
+        offset = _HEADER.size
+        indexes = np.frombuffer(data, _INDEX_DTYPE, bin_count, offset)
+        offset += bin_count * _INDEX_DTYPE.itemsize
+        counts = np.frombuffer(data, _COUNT_DTYPE, bin_count, offset)
+        sketch._add_parts(
+            bins=zip(indexes.tolist(), counts.tolist()),
+            zero_count=zero_count,
+            count=count,
+            total=total,
+            total_of_squares=total_of_squares,
+            minimum=None if math.isnan(minimum) else minimum,
+            maximum=None if math.isnan(maximum) else maximum,
+        )
+        return sketch
+
+
+def calculate_grouped_sketches(
+    group_ids: np.ndarray,
+    durations: np.ndarray,
+    relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+) -> Dict[int, DurationSketch]:
+    """One sketch of `durations` per group, in a few vectorized passes"""
+    sketches = {}
+    if len(durations) == 0:
+        return sketches
+    order = np.argsort(group_ids, kind="stable")
+    group_ids = group_ids[order]
+    durations = np.asarray(durations, dtype=float)[order]
+    groups, starts, counts = np.unique(group_ids, return_index=True, return_counts=True)
+    sums = np.add.reduceat(durations, starts)
+    sums_of_squares = np.add.reduceat(durations * durations, starts)
+    mins = np.minimum.reduceat(durations, starts)
+    maxs = np.maximum.reduceat(durations, starts)
+
+    positive = durations > 0
+    zero_counts = counts - np.add.reduceat(positive.astype(np.int64), starts)
+    # Same bins as the sketches they go in
+    mapping = DurationSketch(relative_accuracy)
+    bin_keys, bin_counts = np.unique(
+        np.stack(
+            [group_ids[positive], mapping._indexes(durations[positive])], axis=1
+        ).reshape(-1, 2),
+        axis=0,
+        return_counts=True,
+    )
+    bins_by_group = {}
+    for (group, index), bin_count in zip(bin_keys.tolist(), bin_counts.tolist()):
+        bins_by_group.setdefault(group, []).append((index, bin_count))
+
+    for idx, group in enumerate(groups.tolist()):
+        sketch = DurationSketch(relative_accuracy)
+        sketch._add_parts(
+            bins=bins_by_group.get(group, []),
+            zero_count=int(zero_counts[idx]),
+            count=int(counts[idx]),
+            total=float(sums[idx]),
+            total_of_squares=float(sums_of_squares[idx]),
+            minimum=float(mins[idx]),
+            maximum=float(maxs[idx]),
+        )
+        sketches[group] = sketch
+    return sketches
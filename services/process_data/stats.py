@@ -0,0 +1,120 @@
+"""Vectorized duration statistics.
+
+The results match the `statistics` module as ProcessDataService used it:
+population stdev, median, and percentiles interpolated like
+`statistics.quantiles(method="inclusive")`.
+"""
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+DEFAULT_PERCENTILES = (90,)
+
+
+def _sorted_percentile(
+    values: np.ndarray, starts: np.ndarray, counts: np.ndarray, percentile: int
+) -> np.ndarray:
+    """`percentile` of each group of `values`, which are sorted within each group.
+    Groups start at `starts` and have `counts` values."""
+    # Same interpolation as statistics.quantiles(method="inclusive"), in integers
+    # so that it rounds the same way: position = percentile * (n - 1) / 100
+    lower, remainder = np.divmod(percentile * (counts - 1), 100)
+    upper = np.minimum(lower + 1, counts - 1)
+    return (
+        values[starts + lower] * (100 - remainder) + values[starts + upper] * remainder
+    ) / 100
+
+
+def _empty_statistics(percentiles: Iterable[int]) -> dict:
+    return dict(
+        mean_duration=None,
+        median_duration=None,
+        stdev_duration=None,
+        **{f"p{percentile}_duration": None for percentile in percentiles},
+    )
+
+
+def calculate_grouped_statistics(
+    group_ids: np.ndarray,
+    durations: np.ndarray,
+    percentiles: Iterable[int] = DEFAULT_PERCENTILES,
+) -> Dict[int, dict]:
+    """Mean, median, population stdev and `percentiles` of `durations` per group.
+    Groups with less than 2 durations have no stdev or percentiles."""
+    percentiles = list(percentiles)
+    if len(durations) == 0:
+        return {}
+    order = np.lexsort((durations, group_ids))
+    group_ids = group_ids[order]
+    durations = np.asarray(durations, dtype=float)[order]
+    groups, starts, counts = np.unique(group_ids, return_index=True, return_counts=True)
+    means = np.add.reduceat(durations, starts) / counts
+    deviations = durations - np.repeat(means, counts)
+    stdevs = np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+    medians = _sorted_percentile(durations, starts, counts, 50)
+    percentile_values = [
+        _sorted_percentile(durations, starts, counts, percentile)
+        for percentile in percentiles
+    ]
+
+    results = {}
+    for idx, group in enumerate(groups.tolist()):
+        has_spread = counts[idx] > 1
+        results[group] = dict(
+            mean_duration=float(means[idx]),
+            median_duration=float(medians[idx]),
+            stdev_duration=float(stdevs[idx]) if has_spread else None,
+            **{
+                f"p{percentile}_duration": float(values[idx]) if has_spread else None
+                for percentile, values in zip(percentiles, percentile_values)
+            },
+        )
+    return results
+
+
+def calculate_statistics(
+    durations: Iterable[float], percentiles: Iterable[int] = DEFAULT_PERCENTILES
+) -> dict:
+    percentiles = list(percentiles)
+    durations = np.asarray(list(durations), dtype=float)
+    group_ids = np.zeros(len(durations), dtype=np.int64)
+    return calculate_grouped_statistics(group_ids, durations, percentiles).get(
+        0, _empty_statistics(percentiles)
+    )
+
+
+def calculate_grouped_totals(
+    group_ids: np.ndarray,
+    success: np.ndarray,
+    durations: np.ndarray,
+    percentiles: Iterable[int] = DEFAULT_PERCENTILES,
+    groups: Optional[List[int]] = None,
+) -> Dict[int, dict]:
+    """Success / failure counts and statistics of the successful durations, per group.
+    `success` is 1 / 0, or NaN where there's no run. Groups in `groups` with no
+    runs at all are included too."""
+    percentiles = list(percentiles)
+    succeeded = success == 1
+    failed = success == 0
+    if groups is None:
+        groups = np.unique(group_ids).tolist()
+    totals = {
+        group: dict(success_count=0, failure_count=0, **_empty_statistics(percentiles))
+        for group in groups
+    }
+    if len(group_ids):
+        for flags, key in ((succeeded, "success_count"), (failed, "failure_count")):
+            flagged_groups, flagged_counts = np.unique(
+                group_ids[flags], return_counts=True
+            )
+            for group, count in zip(flagged_groups.tolist(), flagged_counts.tolist()):
+                if group in totals:
+                    totals[group][key] = count
+        with_duration = succeeded & ~np.isnan(durations)
+        grouped_statistics = calculate_grouped_statistics(
+            group_ids[with_duration], durations[with_duration], percentiles
+        )
+        for group, statistics in grouped_statistics.items():
+            if group in totals:
+                totals[group].update(statistics)
+    return totals
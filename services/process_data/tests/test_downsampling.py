@@ -0,0 +1,30 @@
+import numpy as np
+
+from services.process_data.downsampling import min_max_indexes
+
+
+class TestDownsampling(object):
+    def test_short_series(self):
+        assert min_max_indexes(np.arange(3), np.array([3, 1, 2]), 10).tolist() == [
+            0,
+            1,
+            2,
+        ]
+
+    def test_keeps_min_and_max_of_each_bin(self):
+        x = np.arange(12)
+        y = np.array([5, 1, 9, 4, 4, 4, 0, 7, 3, 2, 8, 6])
+        keep = min_max_indexes(x, y, 6)
+        # 3 bins of 4 points
+        assert keep.tolist() == [1, 2, 6, 7, 9, 10]
+
+    def test_large_series(self):
+        rng = np.random.default_rng(0)
+        x = np.sort(rng.uniform(0, 10**6, 100000))
+        y = rng.normal(600, 60, 100000)
+        y[12345] = 10000
+        keep = min_max_indexes(x, y, 2000)
+        assert len(keep) <= 2000
+        assert (np.diff(keep) > 0).all()
+        assert 12345 in keep
+        assert y[keep].min() == y.min()
@@ -1,7 +1,18 @@
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock
 
+import numpy as np
 import pytest
 
+import services.process_data
+from database import models
+from database.models.enums import JobKinds, JobPatternTypes, RollupGranularities
+from database.tests.factory import (
+    JobFactory,
+    PipelineFactory,
+    ProjectFactory,
+    WorkflowFactory,
+)
 from services.process_data import ProcessDataService
 
 
@@ -50,3 +61,498 @@ class TestProcessData(object):
     def test_calculate_statistics(self, durations, expected):
         process_data = ProcessDataService(MagicMock())
         assert process_data.calculate_statistics(durations) == expected
+
+    def test_calculate_workflow_run_durations_shards(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        workflow = WorkflowFactory(pipeline=PipelineFactory(project=project))
+        dbsession.add_all(
+            [
+                workflow,
+                models.JobClassification(
+                    project=project,
+                    kind=JobKinds.regular_tests,
+                    pattern="test-*",
+                    pattern_type=JobPatternTypes.glob,
+                ),
+                models.JobClassification(
+                    project=project, kind=JobKinds.label_analysis, pattern="ATS"
+                ),
+            ]
+        )
+
+        def job(name, number, started_minute, stopped_minute, status="success"):
+            return models.Job(
+                workflow=workflow,
+                name=name,
+                number=number,
+                status=status,
+                started_at=datetime(2023, 7, 30, 10, started_minute),
+                stopped_at=datetime(2023, 7, 30, 10, stopped_minute),
+            )
+
+        dbsession.add_all(
+            [
+                job("ATS", 1, 0, 2),
+                job("test-1", 2, 2, 10),
+                job("test-2", 3, 3, 15, status="failed"),
+                job("test-3", 4, 2, 8),
+                job("lint", 5, 0, 1),
+            ]
+        )
+        dbsession.flush()
+
+        process_data = ProcessDataService(dbsession)
+        assert process_data.calculate_workflow_run_durations(workflow) == dict(
+            label_analysis_success=True,
+            label_analysis_duration_seconds=120,
+            label_analysis_total_seconds=120,
+            label_analysis_max_seconds=120,
+            label_analysis_job_count=1,
+            regular_tests_success=False,
+            # From 10:02 to 10:15
+            regular_tests_duration_seconds=780,
+            regular_tests_total_seconds=480 + 720 + 360,
+            regular_tests_max_seconds=720,
+            regular_tests_job_count=3,
+        )
+        kinds = {job.name: job.kind for job in dbsession.query(models.Job)}
+        assert kinds == {
+            "ATS": JobKinds.label_analysis,
+            "test-1": JobKinds.regular_tests,
+            "test-2": JobKinds.regular_tests,
+            "test-3": JobKinds.regular_tests,
+            "lint": None,
+        }
+
+    def test_calculate_project_workflow_run_durations(self, dbsession, query_counter):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        pipelines = [PipelineFactory(project=project) for _ in range(3)]
+        workflows = [
+            WorkflowFactory(pipeline=pipeline)
+            for pipeline in pipelines
+            for _ in range(2)
+        ]
+        dbsession.add_all(workflows)
+        for idx, workflow in enumerate(workflows):
+            for number, name in enumerate(["ATS", "test", "lint"]):
+                dbsession.add(
+                    models.Job(
+                        workflow=workflow,
+                        name=name,
+                        number=number,
+                        status="failed" if idx == number else "success",
+                        started_at=datetime(2023, 7, 30, 10, idx),
+                        stopped_at=datetime(2023, 7, 30, 10, idx + number + 1),
+                    )
+                )
+        dbsession.flush()
+
+        process_data = ProcessDataService(dbsession)
+        with query_counter:
+            workflow_runs = process_data.calculate_project_workflow_run_durations(
+                project
+            )
+        # Classification rules, pipelines lookup, names lookup, 2 kind updates,
+        # aggregation, bulk update, dirty flags, read back.
+        # No matter how many workflows.
+        assert query_counter.count == 9
+
+        assert set(workflow_runs.keys()) == set(pipeline.id for pipeline in pipelines)
+        assert sum(len(runs) for runs in workflow_runs.values()) == 6
+        # Same results as one workflow at a time
+        for workflow in workflows:
+            expected = process_data.calculate_workflow_run_durations(workflow)
+            assert expected in workflow_runs[workflow.pipeline_id]
+            assert workflow.label_analysis_duration_seconds == 60
+            assert workflow.regular_tests_duration_seconds == 120
+        assert [workflow.label_analysis_success for workflow in workflows] == [
+            False,
+            True,
+            True,
+            True,
+            True,
+            True,
+        ]
+        assert [workflow.regular_tests_success for workflow in workflows] == [
+            True,
+            False,
+            True,
+            True,
+            True,
+            True,
+        ]
+
+    def test_update_workflow_run_durations_reclassified(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        pipeline = PipelineFactory(project=project)
+        both_kinds, tests_only = [WorkflowFactory(pipeline=pipeline) for _ in range(2)]
+        dbsession.add_all(
+            [
+                JobFactory(workflow=both_kinds, name="ATS"),
+                JobFactory(workflow=both_kinds, name="test"),
+                JobFactory(workflow=tests_only, name="test"),
+            ]
+        )
+        dbsession.flush()
+        process_data = ProcessDataService(dbsession)
+        process_data.sync_project_metrics(project)
+        assert tests_only.regular_tests_duration_seconds == 1800
+
+        # "test" jobs aren't regular tests anymore
+        dbsession.add(
+            models.JobClassification(
+                project=project, kind=JobKinds.label_analysis, pattern="ATS"
+            )
+        )
+        dbsession.flush()
+        dbsession.expire(project, ["job_classifications"])
+        process_data.sync_project_metrics(project, full=True)
+        for column in services.process_data.WORKFLOW_RUN_COLUMNS:
+            assert getattr(tests_only, column) is None
+            if column.startswith("regular_tests"):
+                assert getattr(both_kinds, column) is None
+        assert both_kinds.label_analysis_duration_seconds == 1800
+        assert not tests_only.metrics_dirty
+
+    def test_sync_project_metrics_incremental(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        pipelines = [PipelineFactory(project=project) for _ in range(2)]
+        workflows = [WorkflowFactory(pipeline=pipeline) for pipeline in pipelines]
+        dbsession.add_all(workflows)
+
+        def add_job(workflow, name, minutes):
+            dbsession.add(
+                models.Job(
+                    workflow=workflow,
+                    name=name,
+                    number=0,
+                    status="success",
+                    started_at=datetime(2023, 7, 30, 10),
+                    stopped_at=datetime(2023, 7, 30, 10, minutes),
+                )
+            )
+
+        for workflow in workflows:
+            add_job(workflow, "ATS", 1)
+            add_job(workflow, "test", 2)
+        dbsession.flush()
+
+        process_data = ProcessDataService(dbsession)
+        process_data.sync_project_metrics(project)
+        dbsession.flush()
+        assert all(not workflow.metrics_dirty for workflow in workflows)
+        first_totals = [pipeline.totals for pipeline in pipelines]
+        project_totals = project.totals
+        assert project_totals.regular_tests_mean_duration == 120
+
+        # Nothing changed
+        process_data.sync_project_metrics(project)
+        assert [pipeline.totals for pipeline in pipelines] == first_totals
+        assert project.totals is project_totals
+
+        # A job of the second workflow was synced
+        add_job(workflows[1], "test", 4)
+        workflows[1].metrics_dirty = True
+        dbsession.flush()
+        process_data.sync_project_metrics(project)
+        assert workflows[1].regular_tests_job_count == 2
+        # Totals are updated in place
+        assert [pipeline.totals for pipeline in pipelines] == first_totals
+        assert pipelines[0].totals.regular_tests_mean_duration == 120
+        assert pipelines[1].totals.regular_tests_mean_duration == 240
+        assert project.totals is project_totals
+        assert project.totals.regular_tests_mean_duration == 180
+
+        # Everything is recalculated on a full run
+        process_data.sync_project_metrics(project, full=True)
+        assert project.totals.regular_tests_mean_duration == 180
+        dbsession.flush()
+        assert dbsession.query(models.Totals).count() == 3
+
+    @pytest.mark.parametrize("pipeline_count", [2, 20])
+    def test_sync_project_metrics_query_budget(
+        self, dbsession, query_counter, pipeline_count
+    ):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        pipelines = [
+            PipelineFactory(project=project, created_at=datetime(2023, 7, idx + 1))
+            for idx in range(pipeline_count)
+        ]
+        workflows = [
+            WorkflowFactory(pipeline=pipeline, started_at=pipeline.created_at)
+            for pipeline in pipelines
+            for _ in range(2)
+        ]
+        dbsession.add_all(
+            [
+                JobFactory(workflow=workflow, name=name)
+                for workflow in workflows
+                for name in ("ATS", "test", "lint")
+            ]
+        )
+        dbsession.flush()
+        dbsession.expire_all()
+        process_data = ProcessDataService(dbsession)
+
+        with query_counter:
+            process_data.sync_project_metrics(project)
+            dbsession.flush()
+        # Plus an INSERT per new totals (pipelines' and the project's): SQLite
+        # can only return their ids one row at a time
+        query_counter.assert_at_most(20 + pipeline_count + 1)
+
+        # Nothing to do, once it's known that every pipeline has totals
+        with query_counter:
+            process_data.sync_project_metrics(project)
+            dbsession.flush()
+        query_counter.assert_at_most(3)
+
+        # Workflows of 2 pipelines synced again
+        workflows[0].metrics_dirty = True
+        workflows[-1].metrics_dirty = True
+        dbsession.flush()
+        with query_counter:
+            process_data.sync_project_metrics(project)
+            dbsession.flush()
+        query_counter.assert_at_most(14)
+
+        with query_counter:
+            process_data.sync_project_metrics(project, full=True)
+            dbsession.flush()
+        query_counter.assert_at_most(14)
+
+    def test_sync_project_metrics_pipeline_without_workflows(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        workflow = WorkflowFactory(pipeline__project=project)
+        dbsession.add_all([JobFactory(workflow=workflow, name="ATS")])
+        dbsession.flush()
+        process_data = ProcessDataService(dbsession)
+        process_data.sync_project_metrics(project)
+        dbsession.flush()
+
+        # Nothing dirty, but the new pipeline still needs its totals
+        pipeline = PipelineFactory(project=project)
+        dbsession.add(pipeline)
+        dbsession.flush()
+        process_data.sync_project_metrics(project)
+        dbsession.flush()
+        assert pipeline.totals is not None
+        assert pipeline.totals.label_analysis_success_count == 0
+
+    def test_project_totals_from_pipeline_sketches(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        pipelines = [
+            PipelineFactory(project=project, created_at=datetime(2023, 7, day))
+            for day in range(1, 5)
+        ]
+        workflows = [WorkflowFactory(pipeline=pipeline) for pipeline in pipelines]
+        dbsession.add_all(workflows)
+        for minutes, workflow in enumerate(workflows, start=1):
+            dbsession.add(
+                models.Job(
+                    workflow=workflow,
+                    name="test",
+                    number=0,
+                    status="success",
+                    started_at=datetime(2023, 7, 30, 10),
+                    stopped_at=datetime(2023, 7, 30, 10, minutes),
+                )
+            )
+        dbsession.flush()
+
+        process_data = ProcessDataService(dbsession)
+        process_data.sync_project_metrics(project)
+        totals = project.totals
+        assert totals.regular_tests_success_count == 4
+        assert totals.regular_tests_mean_duration == 150
+        assert totals.regular_tests_median_duration == pytest.approx(120, rel=0.01)
+        assert totals.regular_tests_duration_sketch is not None
+
+        # Incremental updates of the project totals match merging everything again
+        workflows[0].jobs[0].stopped_at = datetime(2023, 7, 30, 10, 9)
+        workflows[0].metrics_dirty = True
+        dbsession.flush()
+        process_data.sync_project_metrics(project)
+        columns = ("success_count", "mean_duration", "median_duration")
+        incremental = {
+            column: getattr(project.totals, f"regular_tests_{column}")
+            for column in columns
+        }
+        assert incremental["mean_duration"] == 270
+        process_data.sync_project_metrics(project, full=True)
+        for column in columns:
+            assert incremental[column] == pytest.approx(
+                getattr(project.totals, f"regular_tests_{column}")
+            )
+
+        window = process_data.calculate_window_totals(
+            project, since=datetime(2023, 7, 2), until=datetime(2023, 7, 4)
+        )
+        assert window.regular_tests_success_count == 2
+        assert window.regular_tests_mean_duration == 150
+        assert window not in dbsession
+
+    def test_sync_rollups(self, dbsession, mocker):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        pipeline = PipelineFactory(project=project)
+        workflows = []
+
+        def add_workflow(started_at, minutes, status="success", pipeline=pipeline):
+            workflow = WorkflowFactory(pipeline=pipeline, started_at=started_at)
+            dbsession.add(
+                models.Job(
+                    workflow=workflow,
+                    name="test",
+                    number=0,
+                    status=status,
+                    started_at=started_at,
+                    stopped_at=started_at + timedelta(minutes=minutes),
+                )
+            )
+            workflows.append(workflow)
+
+        # Sunday and Monday, different weeks
+        add_workflow(datetime(2023, 7, 30, 10), 1)
+        add_workflow(datetime(2023, 7, 30, 10, 30), 3)
+        add_workflow(datetime(2023, 7, 31, 9), 2, status="failed")
+        dbsession.flush()
+
+        process_data = ProcessDataService(dbsession)
+        process_data.sync_project_metrics(project)
+        trends = process_data.get_duration_trends(project)
+        assert trends[JobKinds.label_analysis] == []
+        assert [
+            (
+                item["bucket_start"],
+                item["success_count"],
+                item["failure_count"],
+                item["mean_duration"],
+            )
+            for item in trends[JobKinds.regular_tests]
+        ] == [
+            (datetime(2023, 7, 30), 2, 0, 120),
+            (datetime(2023, 7, 31), 0, 1, None),
+        ]
+        weekly = process_data.get_duration_trends(project, RollupGranularities.week)
+        assert [item["bucket_start"] for item in weekly[JobKinds.regular_tests]] == [
+            datetime(2023, 7, 24),
+            datetime(2023, 7, 31),
+        ]
+
+        # Only the buckets of the new pipeline's workflow are recalculated
+        add_workflow(
+            datetime(2023, 7, 31, 9, 30), 4, pipeline=PipelineFactory(project=project)
+        )
+        dbsession.flush()
+        update_rollups = mocker.spy(process_data, "_update_rollups")
+        process_data.sync_project_metrics(project)
+        assert [call.args[4] for call in update_rollups.call_args_list] == [
+            {datetime(2023, 7, 31, 9)},
+            {datetime(2023, 7, 31)},
+            {datetime(2023, 7, 31)},
+        ]
+        hourly = process_data.get_duration_trends(project, RollupGranularities.hour)
+        assert [
+            (item["bucket_start"], item["success_count"], item["failure_count"])
+            for item in hourly[JobKinds.regular_tests]
+        ] == [
+            (datetime(2023, 7, 30, 10), 2, 0),
+            (datetime(2023, 7, 31, 9), 1, 1),
+        ]
+
+        # Same as recalculating everything
+        incremental = {
+            granularity: process_data.get_duration_trends(project, granularity)
+            for granularity in RollupGranularities
+        }
+        process_data.sync_project_metrics(project, full=True)
+        for granularity, trends in incremental.items():
+            assert process_data.get_duration_trends(project, granularity) == trends
+
+    def test_plot_workflow_durations(self, dbsession, mocker):
+        plt = mocker.patch("services.process_data._pyplot").return_value
+        axes = plt.figure.return_value.add_subplot.return_value
+        axes.plot.return_value = [MagicMock()]
+        project = ProjectFactory()
+        process_data = ProcessDataService(dbsession)
+        trend = dict(
+            bucket_start=datetime(2023, 7, 30),
+            mean_duration=60,
+            p90_duration=None,
+        )
+        mocker.patch.object(
+            process_data,
+            "get_duration_trends",
+            return_value={
+                JobKinds.label_analysis: [trend],
+                JobKinds.regular_tests: [dict(trend, mean_duration=None)],
+            },
+        )
+        process_data.plot_workflow_durations(project)
+        process_data.get_duration_trends.assert_called_with(
+            project, RollupGranularities.day
+        )
+        assert axes.plot.call_count == 4
+        dates, means = axes.plot.call_args_list[0].args[:2]
+        assert dates.tolist() == [datetime(2023, 7, 30)]
+        assert means.tolist() == [60]
+        # Buckets without successful runs aren't plotted
+        assert len(axes.plot.call_args_list[2].args[0]) == 0
+        plt.show.assert_called_once()
+
+    @pytest.mark.parametrize("extension", ["png", "svg"])
+    def test_plot_workflow_durations_headless(
+        self, dbsession, mocker, tmp_path, extension
+    ):
+        plt = mocker.patch("services.process_data._pyplot").return_value
+        project = ProjectFactory(regular_tests_job_name="test")
+        pipeline = PipelineFactory(project=project)
+        for hour in range(10):
+            started_at = datetime(2023, 7, 30, hour)
+            dbsession.add(
+                models.Job(
+                    workflow=WorkflowFactory(pipeline=pipeline, started_at=started_at),
+                    name="test",
+                    number=0,
+                    status="success",
+                    started_at=started_at,
+                    stopped_at=started_at + timedelta(minutes=hour + 1),
+                )
+            )
+        dbsession.flush()
+        process_data = ProcessDataService(dbsession)
+        process_data.sync_project_metrics(project)
+
+        started_at, durations = process_data.get_workflow_durations(project)
+        assert len(started_at) == 10
+        assert durations[JobKinds.regular_tests][:2].tolist() == [60, 120]
+        assert np.isnan(durations[JobKinds.label_analysis]).all()
+
+        output_path = tmp_path / f"durations.{extension}"
+        process_data.plot_workflow_durations(
+            project,
+            RollupGranularities.hour,
+            output_path=str(output_path),
+            points=True,
+            max_points=4,
+        )
+        assert output_path.stat().st_size > 0
+        # pyplot isn't used at all
+        assert plt.mock_calls == []
+        services.process_data._pyplot.assert_not_called()
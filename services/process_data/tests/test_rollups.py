@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from database.models.enums import RollupGranularities
+from services.process_data.rollups import bucket_ranges, bucket_starts
+
+
+class TestRollups(object):
+    @pytest.mark.parametrize(
+        "granularity,expected",
+        [
+            (
+                RollupGranularities.hour,
+                ["2023-07-30T10:00:00", "2023-07-31T00:00:00", "2023-08-06T23:00:00"],
+            ),
+            (
+                RollupGranularities.day,
+                ["2023-07-30T00:00:00", "2023-07-31T00:00:00", "2023-08-06T00:00:00"],
+            ),
+            # Weeks start on Monday
+            (
+                RollupGranularities.week,
+                ["2023-07-24T00:00:00", "2023-07-31T00:00:00", "2023-07-31T00:00:00"],
+            ),
+        ],
+    )
+    def test_bucket_starts(self, granularity, expected):
+        started_at = np.array(
+            ["2023-07-30T10:15:00", "2023-07-31T00:00:00", "2023-08-06T23:59:59"],
+            dtype="datetime64[s]",
+        )
+        assert bucket_starts(started_at, granularity).tolist() == [
+            datetime.fromisoformat(item) for item in expected
+        ]
+
+    def test_bucket_ranges(self):
+        assert bucket_ranges(
+            [datetime(2023, 8, 14), datetime(2023, 7, 24), datetime(2023, 7, 31)],
+            RollupGranularities.week,
+        ) == [
+            (datetime(2023, 7, 24), datetime(2023, 8, 7)),
+            (datetime(2023, 8, 14), datetime(2023, 8, 21)),
+        ]
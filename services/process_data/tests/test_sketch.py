@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from services.process_data.sketch import DurationSketch, calculate_grouped_sketches
+
+
+def durations(size, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.lognormal(6, 1, size).round()
+
+
+class TestDurationSketch(object):
+    def test_empty(self):
+        sketch = DurationSketch()
+        assert sketch.statistics() == dict(
+            mean_duration=None,
+            median_duration=None,
+            stdev_duration=None,
+            p90_duration=None,
+        )
+        assert DurationSketch.from_bytes(sketch.to_bytes()).count == 0
+
+    def test_single_value(self):
+        sketch = DurationSketch().add([120])
+        assert sketch.statistics() == dict(
+            mean_duration=120,
+            median_duration=120,
+            stdev_duration=None,
+            p90_duration=None,
+        )
+
+    @pytest.mark.parametrize("quantile", [0, 0.5, 0.9, 0.99, 1])
+    def test_relative_accuracy(self, quantile):
+        values = durations(10000)
+        sketch = DurationSketch().add(values)
+        expected = np.sort(values)[int(quantile * (len(values) - 1))]
+        assert sketch.quantile(quantile) == pytest.approx(expected, rel=0.01)
+
+    def test_mean_and_stdev_are_exact(self):
+        values = durations(1000)
+        statistics = DurationSketch().add(values).statistics()
+        assert statistics["mean_duration"] == pytest.approx(values.mean())
+        assert statistics["stdev_duration"] == pytest.approx(values.std())
+
+    def test_zeros(self):
+        sketch = DurationSketch().add([0, 0, 0, 10])
+        assert sketch.quantile(0.5) == 0
+        assert sketch.quantile(1) == 10
+
+    def test_merge_and_subtract(self):
+        first, second = durations(500, seed=1), durations(300, seed=2)
+        merged = DurationSketch().add(first).merge(DurationSketch().add(second))
+        combined = DurationSketch().add(np.concatenate([first, second]))
+        assert merged.bins == combined.bins
+        assert merged.statistics() == pytest.approx(combined.statistics())
+
+        merged.subtract(DurationSketch().add(second))
+        assert merged.bins == DurationSketch().add(first).bins
+        assert merged.mean == pytest.approx(first.mean())
+        with pytest.raises(ValueError):
+            merged.subtract(DurationSketch().add([10**6]))
+
+    def test_merge_different_accuracy(self):
+        with pytest.raises(ValueError):
+            DurationSketch().merge(DurationSketch(relative_accuracy=0.02))
+
+    def test_serialization(self):
+        sketch = DurationSketch().add(durations(1000))
+        data = sketch.to_bytes()
+        loaded = DurationSketch.from_bytes(data)
+        assert loaded.__dict__ == sketch.__dict__
+        # A few hundred bytes, whatever the number of durations
+        assert len(data) < 2000
+
+    def test_grouped_sketches(self):
+        values = durations(100)
+        group_ids = np.arange(100) % 3
+        sketches = calculate_grouped_sketches(group_ids, values)
+        assert sorted(sketches) == [0, 1, 2]
+        for group, sketch in sketches.items():
+            expected = DurationSketch().add(values[group_ids == group])
+            assert sketch.bins == expected.bins
+            assert sketch.statistics() == pytest.approx(expected.statistics())
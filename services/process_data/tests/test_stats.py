@@ -0,0 +1,77 @@
+import random
+import statistics
+
+import numpy as np
+import pytest
+
+from services.process_data.stats import (
+    calculate_grouped_statistics,
+    calculate_grouped_totals,
+    calculate_statistics,
+)
+
+
+def reference_statistics(durations):
+    # What ProcessDataService.calculate_statistics used to do
+    return dict(
+        mean_duration=statistics.mean(durations) if durations else None,
+        median_duration=statistics.median(durations) if durations else None,
+        stdev_duration=statistics.pstdev(durations) if len(durations) > 1 else None,
+        p90_duration=(
+            statistics.quantiles(durations, n=10, method="inclusive")[-1]
+            if len(durations) > 1
+            else None
+        ),
+    )
+
+
+class TestStats(object):
+    @pytest.mark.parametrize("size", [0, 1, 2, 3, 10, 101, 1000])
+    def test_matches_statistics_module(self, size):
+        rng = random.Random(size)
+        durations = [rng.randint(30, 3600) for _ in range(size)]
+        result = calculate_statistics(durations)
+        expected = reference_statistics(durations)
+        assert result.keys() == expected.keys()
+        for key, value in expected.items():
+            if key == "stdev_duration" and value is not None:
+                assert result[key] == pytest.approx(value, rel=1e-12)
+            else:
+                assert result[key] == value
+
+    def test_percentiles(self):
+        result = calculate_statistics(range(101), percentiles=[50, 95, 99])
+        assert result["p50_duration"] == 50
+        assert result["p95_duration"] == 95
+        assert result["p99_duration"] == 99
+
+    def test_grouped_statistics(self):
+        rng = random.Random(0)
+        groups = {
+            group: [rng.randint(1, 100) for _ in range(group)] for group in [1, 5, 7]
+        }
+        group_ids = np.array([group for group, items in groups.items() for _ in items])
+        durations = np.array([item for items in groups.values() for item in items])
+        # Order doesn't matter
+        order = np.random.default_rng(0).permutation(len(durations))
+        result = calculate_grouped_statistics(group_ids[order], durations[order])
+        for group, items in groups.items():
+            assert result[group] == calculate_statistics(items)
+
+    def test_grouped_totals(self):
+        nan = float("nan")
+        totals = calculate_grouped_totals(
+            group_ids=np.array([1, 1, 1, 2, 2]),
+            success=np.array([1, 0, 1, nan, 0]),
+            durations=np.array([10, 100, 20, nan, 5]),
+            groups=[1, 2, 3],
+        )
+        assert totals[1] == dict(
+            success_count=2,
+            failure_count=1,
+            **calculate_statistics([10, 20]),
+        )
+        assert totals[2] == dict(
+            success_count=0, failure_count=1, **calculate_statistics([])
+        )
+        assert totals[3] == totals[2] | dict(failure_count=0)
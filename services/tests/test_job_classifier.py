@@ -0,0 +1,101 @@
+import re
+
+import pytest
+
+from database import models
+from database.models.enums import JobKinds, JobPatternTypes
+from database.tests.factory import ProjectFactory
+from services.job_classifier import JobClassifier, JobRule
+
+
+class TestJobClassifier(object):
+    def test_exact(self):
+        classifier = JobClassifier(
+            [
+                JobRule(JobKinds.label_analysis, "ATS"),
+                JobRule(JobKinds.regular_tests, "test"),
+            ]
+        )
+        assert classifier.classify("ATS") == JobKinds.label_analysis
+        assert classifier.classify("test") == JobKinds.regular_tests
+        assert classifier.classify("test-1") is None
+        assert classifier.classify(None) is None
+        assert classifier.matches("ATS")
+        assert not classifier.matches("lint")
+
+    def test_patterns(self):
+        classifier = JobClassifier(
+            [
+                JobRule(JobKinds.label_analysis, "ats-*", JobPatternTypes.glob),
+                JobRule(JobKinds.regular_tests, r"test-\d+", JobPatternTypes.regex),
+                JobRule(JobKinds.regular_tests, "ats-special"),
+            ]
+        )
+        assert classifier.classify("ats-1") == JobKinds.label_analysis
+        assert classifier.classify("test-12") == JobKinds.regular_tests
+        # Patterns must match the whole name
+        assert classifier.classify("test-12-lint") is None
+        assert classifier.classify("pre-ats-1") is None
+        # Exact names win over patterns
+        assert classifier.classify("ats-special") == JobKinds.regular_tests
+
+    def test_first_pattern_wins(self):
+        classifier = JobClassifier(
+            [
+                JobRule(JobKinds.regular_tests, "test-*", JobPatternTypes.glob),
+                JobRule(JobKinds.label_analysis, "test-ats*", JobPatternTypes.glob),
+            ]
+        )
+        assert classifier.classify("test-ats-1") == JobKinds.regular_tests
+
+    def test_regex_backreference(self):
+        classifier = JobClassifier(
+            [
+                JobRule(JobKinds.label_analysis, r"(ats)-\d+", JobPatternTypes.regex),
+                JobRule(JobKinds.regular_tests, r"(\w+)-\1", JobPatternTypes.regex),
+            ]
+        )
+        assert classifier.classify("ats-1") == JobKinds.label_analysis
+        # \1 is the rule's own first group
+        assert classifier.classify("test-test") == JobKinds.regular_tests
+        assert classifier.classify("test-lint") is None
+
+    def test_regex_inline_flags(self):
+        classifier = JobClassifier(
+            [
+                JobRule(JobKinds.label_analysis, "ats", JobPatternTypes.regex),
+                JobRule(JobKinds.regular_tests, "(?i)test-.*", JobPatternTypes.regex),
+            ]
+        )
+        assert classifier.classify("TEST-1") == JobKinds.regular_tests
+        # Only for its own rule
+        assert classifier.classify("ATS") is None
+        assert classifier.classify("ats") == JobKinds.label_analysis
+
+    def test_invalid_regex(self):
+        with pytest.raises(re.error):
+            JobClassifier([JobRule(JobKinds.regular_tests, "(", JobPatternTypes.regex)])
+
+    def test_for_project(self, dbsession):
+        project = ProjectFactory(
+            label_analysis_job_name="ATS", regular_tests_job_name="test"
+        )
+        dbsession.add(project)
+        dbsession.flush()
+        classifier = JobClassifier.for_project(project)
+        assert classifier.classify("ATS") == JobKinds.label_analysis
+        assert classifier.classify("test") == JobKinds.regular_tests
+
+        dbsession.add(
+            models.JobClassification(
+                project=project,
+                kind=JobKinds.regular_tests,
+                pattern="test-*",
+                pattern_type=JobPatternTypes.glob,
+            )
+        )
+        dbsession.flush()
+        # The job names are only used when there are no classifications
+        classifier = JobClassifier.for_project(project)
+        assert classifier.classify("ATS") is None
+        assert classifier.classify("test-3") == JobKinds.regular_tests
@@ -0,0 +1,136 @@
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+import main
+from database.tests.factory import ProjectFactory
+
+
+class TestParseArgs(object):
+    def test_fetch(self):
+        args = main.parse_args(
+            [
+                "fetch",
+                "--project",
+                "api",
+                "--no-incremental",
+                "--workflow-workers",
+                "5",
+                "--job-workers",
+                "8",
+                "--max-concurrency",
+                "10",
+                "--profile",
+            ]
+        )
+        assert args.command == "fetch"
+        assert args.organization == "codecov"
+        assert args.project == "api"
+        config = main.apply_arguments({"fetch": {"queue_size": 50}}, args)
+        assert config == {
+            "fetch": {
+                "queue_size": 50,
+                "workflow_workers": 5,
+                "job_workers": 8,
+                "incremental": False,
+            },
+            "datasources": {"circleci": {"scheduler": {"max_concurrency": 10}}},
+            "profiling": {"enabled": True},
+        }
+
+    def test_process_and_plot(self):
+        args = main.parse_args(["process", "--full"])
+        assert args.full is True
+        assert main.apply_arguments({}, args) == {}
+
+        args = main.parse_args(
+            ["plot", "--granularity", "week", "--output", "plot.png", "--points"]
+        )
+        assert main.apply_arguments({"plot": {"granularity": "day"}}, args) == {
+            "plot": {"granularity": "week", "output_path": "plot.png", "points": True}
+        }
+
+    def test_all(self):
+        args = main.parse_args(["all", "--full", "--job-workers", "4", "--points"])
+        assert args.full is True
+        assert main.apply_arguments({}, args) == {
+            "fetch": {"job_workers": 4},
+            "plot": {"points": True},
+        }
+
+    def test_command_arguments(self):
+        with pytest.raises(SystemExit):
+            main.parse_args(["process", "--job-workers", "4"])
+        with pytest.raises(SystemExit):
+            main.parse_args([])
+
+    def test_max_concurrency_raises_connection_limits(self):
+        args = main.parse_args(["fetch", "--max-concurrency", "50"])
+        config = main.apply_arguments(
+            {"datasources": {"circleci": {"http": {"max_connections": 100}}}}, args
+        )
+        assert config["datasources"]["circleci"] == {
+            "http": {"max_connections": 100, "max_keepalive_connections": 50},
+            "scheduler": {"max_concurrency": 50},
+        }
+
+
+class TestMain(object):
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "command,expected_phases",
+        [
+            ("fetch", ["fetch"]),
+            ("process", ["process"]),
+            ("plot", ["plot"]),
+            ("all", ["fetch", "process", "plot"]),
+        ],
+    )
+    @patch("main.plot_data")
+    @patch("main.process_data")
+    @patch("main.collect_data", new_callable=AsyncMock)
+    @patch("main.configure_logger_from_config", return_value=None)
+    @patch("main.load_config")
+    async def test_commands(
+        self,
+        mock_load_config,
+        mock_configure_logger,
+        mock_collect_data,
+        mock_process_data,
+        mock_plot_data,
+        dbsession,
+        command,
+        expected_phases,
+    ):
+        mock_load_config.return_value = {"fetch": {"job_workers": 2}}
+        project = ProjectFactory()
+        dbsession.add(project)
+        dbsession.flush()
+        phases = {
+            "fetch": mock_collect_data,
+            "process": mock_process_data,
+            "plot": mock_plot_data,
+        }
+
+        with patch("main.get_dbsession", return_value=dbsession):
+            await main.main(
+                [
+                    command,
+                    "--organization",
+                    project.organization.name,
+                    "--project",
+                    project.name,
+                ]
+            )
+
+        for phase, mock_phase in phases.items():
+            assert mock_phase.called == (phase in expected_phases)
+        config = {"fetch": {"job_workers": 2}}
+        if "fetch" in expected_phases:
+            mock_collect_data.assert_called_once_with(config, dbsession, project)
+        if "process" in expected_phases:
+            mock_process_data.assert_called_once_with(
+                config, dbsession, project, full=False
+            )
+        if "plot" in expected_phases:
+            mock_plot_data.assert_called_once_with(config, dbsession, project)
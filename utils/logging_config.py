@@ -1,5 +1,12 @@
+import copy
 import json
 import logging
+import logging.handlers
+import queue
+from logging.handlers import QueueListener
+from typing import Dict, Optional
+
+from config import get_config
 
 # Adapted from https://github.com/codecov/codecov-cli/blob/master/codecov_cli/helpers/logging_utils.py
 
@@ -36,10 +43,94 @@ class ColorFormatter(logging.Formatter):
         return super().format(record)
 
 
-def configure_logger(logger: logging.Logger, log_level=logging.INFO):
-    # This if exists to avoid an issue where extra handlers would be added by tests that use runner.invoke()
-    # Which would cause subsequent tests to failed due to repeated log lines
-    ch = logging.StreamHandler()
-    ch.setFormatter(ColorFormatter())
-    logger.addHandler(ch)
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line, with the extra log attributes as fields"""
+
+    def format(self, record):
+        data = dict(
+            time=self.formatTime(record, self.datefmt),
+            level=record.levelname.lower(),
+            logger=record.name,
+            message=record.getMessage(),
+        )
+        if hasattr(record, "extra_log_attributes"):
+            data.update(record.extra_log_attributes)
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, cls=JsonEncoder)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through 1 of every `every` records logged with `extra=dict(sampled=True)`,
+    per message. Other records always go through."""
+
+    def __init__(self, every: int = 1) -> None:
+        super().__init__()
+        self.every = every
+        self._counts: Dict[str, int] = {}
+
+    def filter(self, record):
+        if self.every <= 1 or not getattr(record, "sampled", False):
+            return True
+        count = self._counts.get(record.msg, 0)
+        self._counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted, so the listener's formatter does the work
+    (and still sees the exception info)"""
+
+    def prepare(self, record):
+        # The message is resolved now, its arguments could change before
+        # the listener gets to it
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+FORMATTERS = dict(color=ColorFormatter, json=JsonLinesFormatter)
+
+
+def configure_logger(
+    logger: logging.Logger,
+    log_level=logging.INFO,
+    log_format: str = "color",
+    use_queue: bool = False,
+    sample_every: int = 1,
+    stream=None,
+) -> Optional[QueueListener]:
+    """Logs to `stream` (stderr by default) in `log_format` (color or json lines).
+
+    With `use_queue`, records are only put in a queue by the thread that logs
+    them, a background thread formats and writes them. The returned listener
+    has to be stopped to flush the last records.
+    Records logged with `extra=dict(sampled=True)` (e.g. one per page) are
+    logged 1 of every `sample_every` times.
+    """
+    ch = logging.StreamHandler(stream)
+    ch.setFormatter(FORMATTERS[log_format]())
+    listener = None
+    handler = ch
+    if use_queue:
+        handler = RecordQueueHandler(queue.SimpleQueue())
+        listener = QueueListener(handler.queue, ch)
+        listener.start()
+    if sample_every > 1:
+        handler.addFilter(SamplingFilter(sample_every))
+    logger.addHandler(handler)
     logger.setLevel(log_level)
+    return listener
+
+
+def configure_logger_from_config(
+    logger: logging.Logger, config: dict
+) -> Optional[QueueListener]:
+    return configure_logger(
+        logger,
+        log_level=get_config(config, "logging", "level", default="INFO"),
+        log_format=get_config(config, "logging", "format", default="color"),
+        use_queue=get_config(config, "logging", "queue", default=False),
+        sample_every=get_config(config, "logging", "sample_every", default=1),
+    )
@@ -0,0 +1,199 @@
+"""Counters, timers and histograms of a run.
+
+Code records into the module's `metrics` registry, which does nothing
+(a single attribute check) until it's enabled, e.g. with `configure_metrics`.
+The registry is exported as a Prometheus text file and / or a JSON summary.
+"""
+import json
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Optional, Tuple
+
+from config import get_config
+
+METRIC_PREFIX = "ats_data_"
+
+# Seconds, like Prometheus clients' defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Counts, e.g. pages or rows
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_NULL_TIMER = nullcontext()
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram(object):
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        # One more for +Inf
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self) -> dict:
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            min=self.min if self.count else None,
+            max=self.max if self.count else None,
+            mean=self.sum / self.count if self.count else None,
+        )
+
+
+class MetricsRegistry(object):
+    def __init__(self, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.started_at = time.time()
+
+    def reset(self) -> None:
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        series = self.counters.setdefault(name, {})
+        key = _labels_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+        **labels,
+    ) -> None:
+        if not self.enabled:
+            return
+        series = self.histograms.setdefault(name, {})
+        key = _labels_key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def timer(self, name: str, **labels):
+        """Context manager observing the seconds its block takes in histogram `name`"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name: str, labels: dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            metric = f"{METRIC_PREFIX}{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{metric}{_format_labels(key)} {_format_value(value)}")
+        for name, series in sorted(self.histograms.items()):
+            metric = f"{METRIC_PREFIX}{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                bounds = [*map(_format_value, histogram.buckets), "+Inf"]
+                for bound, count in zip(bounds, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(
+                        f"{metric}_bucket{_format_labels(key + (('le', bound),))}"
+                        f" {cumulative}"
+                    )
+                lines.append(
+                    f"{metric}_sum{_format_labels(key)} {_format_value(histogram.sum)}"
+                )
+                lines.append(f"{metric}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self) -> dict:
+        return dict(
+            started_at=self.started_at,
+            duration=time.time() - self.started_at,
+            counters={
+                name: [
+                    dict(labels=dict(key), value=value)
+                    for key, value in sorted(series.items())
+                ]
+                for name, series in sorted(self.counters.items())
+            },
+            histograms={
+                name: [
+                    dict(labels=dict(key), **histogram.as_dict())
+                    for key, histogram in sorted(series.items())
+                ]
+                for name, series in sorted(self.histograms.items())
+            },
+        )
+
+    def write_prometheus(self, path: str) -> None:
+        with open(path, "w") as fd:
+            fd.write(self.to_prometheus())
+
+    def write_summary(self, path: str) -> None:
+        with open(path, "w") as fd:
+            json.dump(self.as_dict(), fd, indent=2)
+
+
+def _labels_key(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: Labels) -> str:
+    if not key:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in key
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+metrics = MetricsRegistry()
+
+
+def configure_metrics(config: dict) -> MetricsRegistry:
+    metrics.enabled = get_config(config, "metrics", "enabled", default=False)
+    metrics.reset()
+    return metrics
+
+
+def export_metrics(config: dict) -> Optional[dict]:
+    """Writes the files configured in `metrics`. Returns the run summary"""
+    if not metrics.enabled:
+        return None
+    prometheus_path = get_config(config, "metrics", "prometheus_path")
+    if prometheus_path is not None:
+        metrics.write_prometheus(prometheus_path)
+    summary_path = get_config(config, "metrics", "summary_path")
+    if summary_path is not None:
+        metrics.write_summary(summary_path)
+    return metrics.as_dict()
@@ -0,0 +1,176 @@
+"""cProfile (and tracemalloc) per phase of a run.
+
+`RunProfiler.phase` profiles its block and writes, in `output_dir`:
+- profile_<phase>.pstats, to load with `pstats` / snakeviz
+- profile_<phase>.txt, the top functions by cumulative and own time, after the
+  time spent in each of the fetch coroutines
+- memory_<phase>.txt, with `trace_memory`, the lines that allocated the most
+  during the phase
+Only the thread running the phase is profiled (not the db-writer thread).
+tracemalloc sees every thread but makes the run a few times slower.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+from config import get_config
+from utils.logging_config import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# Coroutines of the fetch phase, by the functions they run.
+# Each time a coroutine is resumed counts as a call in cProfile, and only the
+# time it spends running (not awaiting) is counted.
+COROUTINES = dict(
+    sync_pipelines=("sync_pipelines", "iter_synced_pipelines"),
+    sync_workflows=("sync_workflows", "iter_synced_workflows"),
+    sync_jobs=("sync_jobs",),
+)
+
+_NULL_PHASE = nullcontext()
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+
+
+def coroutine_stats(stats: pstats.Stats) -> Dict[str, dict]:
+    """Resumes and seconds running of each of the `COROUTINES`"""
+    functions = {}
+    for (_, _, function_name), (_, calls, _, cumulative, _) in stats.stats.items():
+        calls_so_far, seconds_so_far = functions.get(function_name, (0, 0.0))
+        functions[function_name] = (calls_so_far + calls, seconds_so_far + cumulative)
+    results = {}
+    for name, function_names in COROUTINES.items():
+        # sync_x only iterates iter_synced_x, so their times overlap.
+        # The outermost one has all of it.
+        calls, seconds = max(
+            (
+                functions.get(function_name, (0, 0.0))
+                for function_name in function_names
+            ),
+            key=lambda item: item[1],
+        )
+        results[name] = dict(resumes=calls, seconds=seconds)
+    return results
+
+
+class RunProfiler(object):
+    def __init__(
+        self,
+        output_dir: str = ".",
+        enabled: bool = False,
+        trace_memory: bool = False,
+        top: int = 50,
+    ) -> None:
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.top = top
+        self.reports: Dict[str, dict] = {}
+
+    def phase(self, name: str):
+        """Context manager profiling its block as phase `name`"""
+        if not self.enabled:
+            return _NULL_PHASE
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name: str):
+        memory_before = None
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = _take_snapshot()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            seconds = time.perf_counter() - start
+            memory_after = None
+            if memory_before is not None:
+                memory_after = _take_snapshot()
+            self.reports[name] = self._write_reports(
+                name, profile, seconds, memory_before, memory_after
+            )
+            logger.info(
+                "Profiled phase",
+                extra=dict(extra_log_attributes=dict(phase=name, **self.reports[name])),
+            )
+
+    def _write_reports(
+        self,
+        name: str,
+        profile: cProfile.Profile,
+        seconds: float,
+        memory_before: Optional[tracemalloc.Snapshot],
+        memory_after: Optional[tracemalloc.Snapshot],
+    ) -> dict:
+        os.makedirs(self.output_dir, exist_ok=True)
+        report = dict(
+            seconds=seconds,
+            pstats_path=os.path.join(self.output_dir, f"profile_{name}.pstats"),
+            report_path=os.path.join(self.output_dir, f"profile_{name}.txt"),
+        )
+        profile.dump_stats(report["pstats_path"])
+
+        text = io.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        text.write(f"Phase {name}: {seconds:.3f}s\n\n")
+        coroutines = coroutine_stats(stats)
+        if any(item["resumes"] for item in coroutines.values()):
+            text.write("Coroutines (resumes, seconds running)\n")
+            for coroutine, item in coroutines.items():
+                text.write(
+                    f"  {coroutine:<16}{item['resumes']:>10}{item['seconds']:>12.3f}\n"
+                )
+            text.write("\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top)
+        with open(report["report_path"], "w") as fd:
+            fd.write(text.getvalue())
+
+        if memory_after is not None:
+            report["memory_path"] = os.path.join(self.output_dir, f"memory_{name}.txt")
+            report["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            with open(report["memory_path"], "w") as fd:
+                fd.write(
+                    f"Phase {name}: peak {report['peak_memory'] / 2**20:.1f} MiB"
+                    " traced\n\n"
+                )
+                for diff in memory_after.compare_to(memory_before, "lineno")[
+                    : self.top
+                ]:
+                    fd.write(f"{diff}\n")
+        return report
+
+    def stop(self) -> None:
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def get_profiler(config: dict) -> RunProfiler:
+    """Profiler configured by the `profiling` section. Reports go next to the
+    run summary unless `profiling.output_dir` says otherwise"""
+    summary_path = get_config(config, "metrics", "summary_path")
+    default_output_dir = os.path.dirname(summary_path) if summary_path else ""
+    return RunProfiler(
+        output_dir=get_config(
+            config, "profiling", "output_dir", default=default_output_dir or "."
+        ),
+        enabled=get_config(config, "profiling", "enabled", default=False),
+        trace_memory=get_config(config, "profiling", "trace_memory", default=False),
+        top=get_config(config, "profiling", "top", default=50),
+    )
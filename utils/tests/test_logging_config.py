@@ -0,0 +1,93 @@
+import io
+import json
+import logging
+import time
+
+import pytest
+
+from utils.logging_config import configure_logger, configure_logger_from_config
+
+
+class SlowStream(io.StringIO):
+    def write(self, text):
+        time.sleep(0.01)
+        return super().write(text)
+
+
+@pytest.fixture
+def logger(request):
+    logger = logging.getLogger(f"test-{request.node.name}")
+    yield logger
+    logger.handlers.clear()
+
+
+class TestConfigureLogger(object):
+    def test_json_lines(self, logger):
+        stream = io.StringIO()
+        configure_logger(logger, log_format="json", stream=stream)
+        logger.info(
+            "Synced all jobs",
+            extra=dict(extra_log_attributes=dict(workflow=1, job_count=3)),
+        )
+        logger.warning("Done")
+        first, second = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert first["message"] == "Synced all jobs"
+        assert first["level"] == "info"
+        assert first["workflow"] == 1
+        assert first["job_count"] == 3
+        assert second["level"] == "warning"
+
+    def test_sampling(self, logger):
+        stream = io.StringIO()
+        configure_logger(logger, sample_every=3, stream=stream)
+        for idx in range(7):
+            logger.info("Synced all jobs %s", idx, extra=dict(sampled=True))
+            logger.info("Not sampled")
+        lines = stream.getvalue().splitlines()
+        assert [line.rsplit(" ", 1)[-1] for line in lines if "jobs" in line] == [
+            "0",
+            "3",
+            "6",
+        ]
+        assert sum("Not sampled" in line for line in lines) == 7
+
+    def test_queue(self, logger):
+        stream = SlowStream()
+        listener = configure_logger(logger, use_queue=True, stream=stream)
+        start = time.perf_counter()
+        for idx in range(20):
+            logger.info("Page %s", idx)
+        # Writing takes 0.2s, in the listener's thread
+        assert time.perf_counter() - start < 0.1
+        listener.stop()
+        assert len(stream.getvalue().splitlines()) == 20
+
+    def test_queue_exception(self, logger):
+        stream = io.StringIO()
+        listener = configure_logger(
+            logger, log_format="json", use_queue=True, stream=stream
+        )
+        try:
+            raise ValueError("Bad page")
+        except ValueError:
+            logger.exception(
+                "Failed to sync %s",
+                "jobs",
+                extra=dict(extra_log_attributes=dict(workflow=1)),
+            )
+        listener.stop()
+        (line,) = stream.getvalue().splitlines()
+        data = json.loads(line)
+        assert data["message"] == "Failed to sync jobs"
+        assert data["level"] == "error"
+        assert data["workflow"] == 1
+        assert "ValueError: Bad page" in data["exc_info"]
+
+    def test_from_config(self, logger):
+        listener = configure_logger_from_config(
+            logger, dict(logging=dict(level="WARNING", queue=True))
+        )
+        assert logger.level == logging.WARNING
+        assert isinstance(logger.handlers[0], logging.handlers.QueueHandler)
+        listener.stop()
+        assert configure_logger_from_config(logger, {}) is None
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from utils.metrics import (
+    COUNT_BUCKETS,
+    MetricsRegistry,
+    configure_metrics,
+    export_metrics,
+    metrics,
+)
+
+
+class TestMetricsRegistry(object):
+    def test_disabled(self):
+        registry = MetricsRegistry()
+        registry.inc("requests_total")
+        registry.observe("pages_per_call", 3)
+        with registry.timer("flush_seconds"):
+            pass
+        assert registry.counters == {}
+        assert registry.histograms == {}
+        assert registry.to_prometheus() == "\n"
+
+    def test_counters(self):
+        registry = MetricsRegistry(enabled=True)
+        registry.inc("rows_total", 3, table="jobs")
+        registry.inc("rows_total", 2, table="jobs")
+        registry.inc("rows_total", table="workflows")
+        assert registry.as_dict()["counters"] == dict(
+            rows_total=[
+                dict(labels=dict(table="jobs"), value=5),
+                dict(labels=dict(table="workflows"), value=1),
+            ]
+        )
+
+    def test_timer(self, mocker):
+        mocker.patch("utils.metrics.time.perf_counter", side_effect=[10, 10.2])
+        registry = MetricsRegistry(enabled=True)
+        with registry.timer("flush_seconds", table="jobs"):
+            pass
+        histogram = registry.histograms["flush_seconds"][(("table", "jobs"),)]
+        assert histogram.count == 1
+        assert histogram.sum == pytest.approx(0.2)
+
+    def test_prometheus(self):
+        registry = MetricsRegistry(enabled=True)
+        registry.inc("http_requests_total", endpoint="jobs", status=200)
+        for pages in (1, 1, 3):
+            registry.observe(
+                "pages_per_call", pages, buckets=COUNT_BUCKETS[:3], endpoint="jobs"
+            )
+        assert registry.to_prometheus() == "\n".join(
+            [
+                "# TYPE ats_data_http_requests_total counter",
+                'ats_data_http_requests_total{endpoint="jobs",status="200"} 1',
+                "# TYPE ats_data_pages_per_call histogram",
+                'ats_data_pages_per_call_bucket{endpoint="jobs",le="1"} 2',
+                'ats_data_pages_per_call_bucket{endpoint="jobs",le="2"} 2',
+                'ats_data_pages_per_call_bucket{endpoint="jobs",le="5"} 3',
+                'ats_data_pages_per_call_bucket{endpoint="jobs",le="+Inf"} 3',
+                'ats_data_pages_per_call_sum{endpoint="jobs"} 5',
+                'ats_data_pages_per_call_count{endpoint="jobs"} 3',
+                "",
+            ]
+        )
+
+    def test_export(self, tmp_path):
+        config = dict(
+            metrics=dict(
+                enabled=True,
+                prometheus_path=str(tmp_path / "metrics.prom"),
+                summary_path=str(tmp_path / "summary.json"),
+            )
+        )
+        configure_metrics(config)
+        try:
+            metrics.inc("rows_total", 4)
+            summary = export_metrics(config)
+        finally:
+            configure_metrics({})
+        assert summary["counters"]["rows_total"] == [dict(labels={}, value=4)]
+        assert (
+            (tmp_path / "metrics.prom").read_text().endswith("ats_data_rows_total 4\n")
+        )
+        assert json.loads((tmp_path / "summary.json").read_text())["counters"] == (
+            summary["counters"]
+        )
+        assert export_metrics({}) is None
@@ -0,0 +1,96 @@
+import asyncio
+import pstats
+
+from utils.profiling import RunProfiler, coroutine_stats, get_profiler
+
+
+async def sync_jobs(count):
+    for _ in range(count):
+        sum(range(1000))
+        await asyncio.sleep(0)
+
+
+async def iter_synced_workflows(count):
+    for idx in range(count):
+        await asyncio.sleep(0)
+        yield idx
+
+
+async def sync_workflows(count):
+    return [item async for item in iter_synced_workflows(count)]
+
+
+async def fetch():
+    await asyncio.gather(sync_jobs(5), sync_jobs(5), sync_workflows(3))
+
+
+class TestRunProfiler(object):
+    def test_disabled(self, tmp_path):
+        profiler = RunProfiler(output_dir=str(tmp_path))
+        with profiler.phase("process"):
+            pass
+        assert profiler.reports == {}
+        assert list(tmp_path.iterdir()) == []
+
+    def test_phase(self, tmp_path):
+        profiler = RunProfiler(output_dir=str(tmp_path / "profiles"), enabled=True)
+        with profiler.phase("fetch"):
+            asyncio.run(fetch())
+        report = profiler.reports["fetch"]
+        assert report["pstats_path"] == str(tmp_path / "profiles/profile_fetch.pstats")
+        assert "memory_path" not in report
+
+        coroutines = coroutine_stats(pstats.Stats(report["pstats_path"]))
+        assert coroutines["sync_pipelines"] == dict(resumes=0, seconds=0.0)
+        # Started, then resumed after each sleep
+        assert coroutines["sync_jobs"]["resumes"] == 2 * 6
+        assert coroutines["sync_workflows"]["resumes"] == 4
+        assert coroutines["sync_jobs"]["seconds"] > 0
+
+        with open(report["report_path"]) as fd:
+            text = fd.read()
+        assert text.startswith("Phase fetch: ")
+        assert "sync_jobs" in text
+        assert "cumulative" in text
+
+    def test_trace_memory(self, tmp_path):
+        profiler = RunProfiler(
+            output_dir=str(tmp_path), enabled=True, trace_memory=True
+        )
+        try:
+            with profiler.phase("process"):
+                kept = [str(idx) * 10 for idx in range(10000)]
+        finally:
+            profiler.stop()
+        report = profiler.reports["process"]
+        assert report["peak_memory"] > 10000 * 10
+        with open(report["memory_path"]) as fd:
+            text = fd.read()
+        assert text.startswith("Phase process: peak ")
+        assert "test_profiling.py" in text
+        assert len(kept) == 10000
+
+
+class TestGetProfiler(object):
+    def test_defaults(self):
+        profiler = get_profiler({})
+        assert profiler.enabled is False
+        assert profiler.output_dir == "."
+
+    def test_next_to_summary(self):
+        profiler = get_profiler(
+            dict(
+                metrics=dict(summary_path="runs/run_summary.json"),
+                profiling=dict(enabled=True, trace_memory=True),
+            )
+        )
+        assert profiler.enabled is True
+        assert profiler.trace_memory is True
+        assert profiler.output_dir == "runs"
+        profiler = get_profiler(
+            dict(
+                metrics=dict(summary_path="runs/run_summary.json"),
+                profiling=dict(output_dir="profiles"),
+            )
+        )
+        assert profiler.output_dir == "profiles"